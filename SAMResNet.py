@@ -7,16 +7,24 @@ Original file is located at
     https://colab.research.google.com/drive/1277jMyUf63Nhn0GSIVholsr6I0yXUWzw
 """
 
-!pip install thop
+# Colab: !pip install thop  (optional; profile_model cross-checks its FLOP counts with it)
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torchvision
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import SGD
-from collections import defaultdict
+from torch.func import stack_module_state, functional_call, vmap
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from collections import Counter, defaultdict, deque
+from PIL import Image
 from pathlib import Path
 import numpy as np
 import pandas as pd
@@ -24,8 +32,24 @@ import os
 import sys
 import pickle
 from datetime import datetime
-from google.colab import drive
+try:
+    from google.colab import drive
+except ImportError:  # outside Colab, e.g. worker processes on a local machine
+    drive = None
 import random
+import copy
+import hashlib
+import inspect
+import json
+import time
+import tempfile
+import subprocess
+import threading
+import queue
+import glob
+import sqlite3
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def set_random_seeds(seed=42):
     """Set random seeds for reproducibility across all libraries."""
@@ -41,23 +65,26 @@ def set_random_seeds(seed=42):
     print(f"Random seeds set to {seed} for reproducibility")
 
 
-set_random_seeds(84)
-
-
-drive.mount('/content/drive')
 DRIVE_PATH = '/content/drive/MyDrive/3_DL_Project1_CIFAR10'
-os.makedirs(DRIVE_PATH, exist_ok=True)
-print(f"Google Drive mounted. Files will be saved to {DRIVE_PATH}")
+# Side effects only in the process running the script: mp.spawn and ProcessPoolExecutor children
+# re-import this file (as __mp_main__ or by module name) and must not reseed or remount Drive
+if __name__ == "__main__":
+    set_random_seeds(84)
+    if drive is not None:
+        drive.mount('/content/drive')
+    os.makedirs(DRIVE_PATH, exist_ok=True)
+    print(f"Google Drive mounted. Files will be saved to {DRIVE_PATH}")
 
 # MODEL ARCHITECTURE COMPONENTS
 class SEBlock(nn.Module):
-    def __init__(self, channels, reduction=16):
+    def __init__(self, channels, reduction=16, hidden=None):
         super().__init__()
+        hidden = hidden if hidden else channels//reduction
         self.se = nn.Sequential(
             nn.AdaptiveAvgPool2d(1),
-            nn.Conv2d(channels, channels//reduction, 1, bias=True),
+            nn.Conv2d(channels, hidden, 1, bias=True),
             nn.SiLU(inplace=True),
-            nn.Conv2d(channels//reduction, channels, 1, bias=True),
+            nn.Conv2d(hidden, channels, 1, bias=True),
             nn.Sigmoid()
         )
 
@@ -65,13 +92,15 @@ class SEBlock(nn.Module):
 
 class BasicBlock(nn.Module):
     expansion = 1
-    def __init__(self, in_channels, out_channels, stride=1, se=True):
+    def __init__(self, in_channels, out_channels, stride=1, se=True, mid_channels=None, se_hidden=None):
         super().__init__()
-        self.conv1 = nn.Conv2d(in_channels, out_channels, 3, stride=stride, padding=1, bias=False)
-        self.bn1 = nn.BatchNorm2d(out_channels)
-        self.conv2 = nn.Conv2d(out_channels, out_channels, 3, stride=1, padding=1, bias=False)
+        # mid_channels < out_channels is a pruned block (see prune_resnet); residual width is unchanged
+        mid_channels = mid_channels if mid_channels else out_channels
+        self.conv1 = nn.Conv2d(in_channels, mid_channels, 3, stride=stride, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(mid_channels)
+        self.conv2 = nn.Conv2d(mid_channels, out_channels, 3, stride=1, padding=1, bias=False)
         self.bn2 = nn.BatchNorm2d(out_channels)
-        self.se = SEBlock(out_channels) if se else None
+        self.se = SEBlock(mid_channels, hidden=se_hidden) if se else None
         self.shortcut = nn.Sequential()
         if stride != 1 or in_channels != out_channels:
             self.shortcut = nn.Sequential(
@@ -87,14 +116,18 @@ class BasicBlock(nn.Module):
         return F.silu(out)
 
 class ResNet(nn.Module):
-    def __init__(self, num_blocks, num_channels=64, num_classes=10):
+    def __init__(self, num_blocks, num_channels=64, num_classes=10, mid_channels=None, se_hidden=None):
         super().__init__()
         self.in_channels = num_channels
+        # Optional per-block inner widths / SE hidden sizes, in block order (pruned models)
+        self._mid_channels = list(mid_channels) if mid_channels else None
+        self._se_hidden = list(se_hidden) if se_hidden else None
         self.conv1 = nn.Conv2d(3, num_channels, 3, stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(num_channels)
         self.layer1 = self._make_layer(num_channels, num_blocks[0], 1)
         self.layer2 = self._make_layer(num_channels*2, num_blocks[1], 2)
         self.layer3 = self._make_layer(num_channels*4, num_blocks[2], 2)
+        del self._mid_channels, self._se_hidden
         self.avgpool = nn.AdaptiveAvgPool2d(1)
         self.linear = nn.Linear(num_channels*4 * BasicBlock.expansion, num_classes)
 
@@ -106,10 +139,18 @@ class ResNet(nn.Module):
                 nn.init.constant_(m.bias, 0)
 
     def _make_layer(self, out_channels, num_blocks, stride):
+        if num_blocks == 0:
+            # A layer pruned away entirely (prune_resnet drop_blocks) is the identity; only valid if shapes match
+            if stride != 1 or self.in_channels != out_channels * BasicBlock.expansion:
+                raise ValueError(f"A layer with 0 blocks cannot map {self.in_channels} to "
+                                 f"{out_channels * BasicBlock.expansion} channels at stride {stride}")
+            return nn.Sequential()
         strides = [stride] + [1]*(num_blocks-1)
         layers = []
         for stride in strides:
-            layers.append(BasicBlock(self.in_channels, out_channels, stride, se=True))
+            mid = self._mid_channels.pop(0) if self._mid_channels else None
+            hidden = self._se_hidden.pop(0) if self._se_hidden else None
+            layers.append(BasicBlock(self.in_channels, out_channels, stride, se=True, mid_channels=mid, se_hidden=hidden))
             self.in_channels = out_channels * BasicBlock.expansion
         return nn.Sequential(*layers)
 
@@ -123,30 +164,77 @@ class ResNet(nn.Module):
 
 # EMA MODEL IMPLEMENTATION
 class ModelEMA:
-    """ Model Exponential Moving Average """
-    def __init__(self, model, decay=0.9999, device=None):
-        self.ema = {k: v.clone().detach() for k, v in model.state_dict().items()}
+    """ Model Exponential Moving Average
+
+    Shadow weights are updated in place with foreach ops. ``update_every=k`` folds k steps into
+    one update with decay**k, and ``cpu_shadow`` keeps the shadow copy in host memory.
+    apply()/restore() swap tensor pointers instead of copying state dicts.
+    """
+    def __init__(self, model, decay=0.9999, device=None, update_every=1, cpu_shadow=False):
         self.decay = decay
+        self.update_every = max(1, int(update_every))
+        if cpu_shadow:
+            device = torch.device('cpu')
         self.device = device if device else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.ema = {k: v.to(device) for k, v in self.ema.items()}
+        self.ema = {k: v.detach().clone().to(self.device) for k, v in model.state_dict().items()}
         self.model = model
         self.training_mode = False
+        self.applied = False
+        self.num_updates = 0
+        # Floating point parameters and buffers, e.g. BN running stats; integer counters are left alone
+        self.keys = [k for k, v in self.ema.items() if v.dtype.is_floating_point]
+        self.shadow = [self.ema[k] for k in self.keys]
+        self._slots = self._resolve(model)
+        self._stash = None
+
+    def _resolve(self, model):
+        slots = []
+        for k in self.keys:
+            module_name, _, attr = k.rpartition('.')
+            slots.append((model.get_submodule(module_name), attr))
+        return slots
+
+    def _live_tensors(self, slots):
+        return [getattr(module, attr).data for module, attr in slots]
 
     def update(self, model):
+        assert not self.applied, "EMA weights are applied; call restore() before update()"
+        self.num_updates += 1
+        if self.num_updates % self.update_every:
+            return
+        slots = self._slots if model is self.model else self._resolve(model)
+        decay = self.decay ** self.update_every
         with torch.no_grad():
-            for k, v in model.state_dict().items():
-                if v.dtype.is_floating_point:
-                    self.ema[k] = self.ema[k] * self.decay + v.detach() * (1 - self.decay)
+            live = self._live_tensors(slots)
+            if live[0].device != self.device:
+                # Blocking into a CPU shadow: the host lerp below would read a pending async D2H copy
+                live = [t.to(self.device, non_blocking=self.device.type != 'cpu') for t in live]
+            # ema * decay + v * (1 - decay)
+            torch._foreach_lerp_(self.shadow, live, 1 - decay)
+
+    def _set(self, module, attr, tensor):
+        if isinstance(getattr(module, attr), nn.Parameter):
+            getattr(module, attr).data = tensor
+        else:
+            setattr(module, attr, tensor)
 
     def apply(self):
         self.training_mode = self.model.training
-        self.ema_state_dict = self.model.state_dict()
-        self.model.load_state_dict({k: v.clone() for k, v in self.ema.items()})
+        if not self.applied:
+            self._stash = self._live_tensors(self._slots)
+            for (module, attr), live, shadow in zip(self._slots, self._stash, self.shadow):
+                # Pointer swap when the shadow lives on the model's device, a single copy otherwise
+                self._set(module, attr, shadow if shadow.device == live.device else shadow.to(live.device))
+            self.applied = True
         self.model.eval()
 
     def restore(self):
+        if self.applied:
+            for (module, attr), live in zip(self._slots, self._stash):
+                self._set(module, attr, live)
+            self._stash = None
+            self.applied = False
         if self.training_mode:
-            self.model.load_state_dict(self.ema_state_dict)
             self.model.train()
 
 # MIXUP/CUTMIX IMPLEMENTATION
@@ -164,6 +252,13 @@ def mixup_data(x, y, alpha=1.0):
     y_a, y_b = y, y[index]
     return mixed_x, y_a, y_b, lam
 
+def mixup_ramp_factor(ramp, epoch):
+    """Alpha multiplier at ``epoch`` for a ramp ((until_epoch, factor), ...); 1 after the last stage."""
+    for until_epoch, factor in ramp:
+        if epoch < until_epoch:
+            return factor
+    return 1.0
+
 def cutmix_data(x, y, alpha=1.0):
     '''Returns cutmix inputs, pairs of targets, and lambda'''
     if alpha > 0:
@@ -222,25 +317,228 @@ class Cutout:
             mask[y1:y2, x1:x2] = 0.
         return img * torch.from_numpy(mask)
 
+# BATCHED AUGMENTATION
+CIFAR10_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR10_STD = (0.2023, 0.1994, 0.2010)
+
+class BatchAugment:
+    """ RandomCrop + HorizontalFlip + Cutout + Normalize applied to a whole uint8 [B, 3, H, W] batch
+
+    Same distributions as the per-image torchvision pipeline: zero-padded crop offsets uniform
+    in [0, 2*padding], flip with probability 0.5 and Cutout centres uniform over the image.
+    Cutout zeroes pixels before normalization, exactly like Cutout on a ToTensor image.
+    """
+    def __init__(self, train=True, padding=4, flip=True, n_holes=1, length=16,
+                 mean=CIFAR10_MEAN, std=CIFAR10_STD):
+        self.train = train
+        self.padding = padding
+        self.flip = flip
+        self.n_holes = n_holes
+        self.length = length
+        self.mean = torch.tensor(mean)
+        self.std = torch.tensor(std)
+
+    def crop_flip(self, x, generator=None):
+        b, _, h, w = x.shape
+        p = self.padding
+        dev = x.device
+        if p > 0:
+            x = F.pad(x, (p, p, p, p))
+        oy = torch.randint(0, 2 * p + 1, (b,), device=dev, generator=generator)
+        ox = torch.randint(0, 2 * p + 1, (b,), device=dev, generator=generator)
+        rows = oy[:, None] + torch.arange(h, device=dev)
+        cols = ox[:, None] + torch.arange(w, device=dev)
+        if self.flip:
+            flipped = torch.rand(b, device=dev, generator=generator) < 0.5
+            cols = torch.where(flipped[:, None], cols.flip(1), cols)
+        # One gather for crop and flip: [B, H, W, C] -> [B, C, H, W]
+        batch_idx = torch.arange(b, device=dev)[:, None, None]
+        return x[batch_idx, :, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+    def cutout(self, x, generator=None):
+        b, _, h, w = x.shape
+        dev = x.device
+        ys = torch.arange(h, device=dev)
+        xs = torch.arange(w, device=dev)
+        mask = torch.zeros(b, h, w, dtype=torch.bool, device=dev)
+        for _ in range(self.n_holes):
+            cy = torch.randint(0, h, (b, 1), device=dev, generator=generator)
+            cx = torch.randint(0, w, (b, 1), device=dev, generator=generator)
+            in_y = (ys >= (cy - self.length // 2).clamp(0, h)) & (ys < (cy + self.length // 2).clamp(0, h))
+            in_x = (xs >= (cx - self.length // 2).clamp(0, w)) & (xs < (cx + self.length // 2).clamp(0, w))
+            mask |= in_y[:, :, None] & in_x[:, None, :]
+        return x.masked_fill(mask[:, None], 0)
+
+    def normalize(self, x):
+        # uint8 -> float and Normalize in one affine step: x / (255 * std) - mean / std
+        scale = (1.0 / (255.0 * self.std)).to(x.device).view(1, -1, 1, 1)
+        shift = (self.mean / self.std).to(x.device).view(1, -1, 1, 1)
+        return torch.addcmul(-shift, x.float(), scale)
+
+    def __call__(self, x, generator=None):
+        if self.train:
+            x = self.crop_flip(x, generator)
+            if self.n_holes > 0:
+                x = self.cutout(x, generator)
+        return self.normalize(x)
+
+class AugmentedLoader:
+    """ Wraps a loader of uint8 batches; moves them to ``device`` and augments in the main process """
+    def __init__(self, loader, augment, device=None):
+        self.loader = loader
+        self.augment = augment
+        self.device = device if device else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    def __len__(self):
+        return len(self.loader)
+
+    def set_epoch(self, epoch):
+        set_loader_epoch(self.loader, epoch)
+
+    def __iter__(self):
+        for inputs, targets in self.loader:
+            inputs = inputs.to(self.device, non_blocking=True)
+            yield self.augment(inputs), targets.to(self.device, non_blocking=True)
+
+def set_loader_epoch(loader, epoch):
+    """Reseed the per-epoch shuffle of a sharded loader (FastLoader, AugmentedLoader or DistributedSampler)."""
+    if hasattr(loader, "set_epoch"):
+        loader.set_epoch(epoch)
+    elif isinstance(getattr(loader, "sampler", None), DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+def cifar10_uint8_tensors(dataset):
+    """CIFAR10 dataset -> (uint8 [N, 3, 32, 32], int64 [N]) tensors without going through PIL."""
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    return images, torch.as_tensor(dataset.targets, dtype=torch.long)
+
+def download_cifar10(root='./data'):
+    """Fetch both CIFAR-10 splits once in the parent, so spawned workers find them instead of all downloading."""
+    for train in (True, False):
+        torchvision.datasets.CIFAR10(root=root, train=train, download=True)
+
+# IN-MEMORY DATA LOADING
+class InMemoryCIFAR10:
+    """ Full CIFAR-10 split held as one contiguous uint8 [N, 3, 32, 32] tensor (~150 MB for train) """
+    def __init__(self, root='./data', train=True, download=True, device=None):
+        dataset = torchvision.datasets.CIFAR10(root=root, train=train, download=download)
+        self.images, self.targets = cifar10_uint8_tensors(dataset)
+        if device is not None:
+            self.images, self.targets = self.images.to(device), self.targets.to(device)
+
+    def __len__(self):
+        return len(self.targets)
+
+class FastLoader:
+    """ Zero-worker loader: shuffles by index permutation and yields batches by slicing
+
+    With ``num_replicas`` > 1 it behaves like a DistributedSampler: every rank draws the same
+    permutation from ``seed`` + epoch (see set_epoch) and keeps every ``num_replicas``-th index.
+    """
+    def __init__(self, images, targets, batch_size=128, shuffle=False, drop_last=False, generator=None,
+                 num_replicas=1, rank=0, seed=0):
+        self.images = images
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _num_samples(self):
+        return len(self.targets) // self.num_replicas
+
+    def __len__(self):
+        n = self._num_samples()
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def _indices(self):
+        n = len(self.targets)
+        if self.num_replicas == 1:
+            return torch.randperm(n, generator=self.generator).to(self.images.device) if self.shuffle else None
+        if self.shuffle:
+            perm = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed + self.epoch))
+        else:
+            perm = torch.arange(n)
+        return perm[self.rank:self._num_samples() * self.num_replicas:self.num_replicas].to(self.images.device)
+
+    def __iter__(self):
+        perm = self._indices()
+        for i in range(len(self)):
+            start = i * self.batch_size
+            if perm is None:
+                yield self.images[start:start + self.batch_size], self.targets[start:start + self.batch_size]
+            else:
+                idx = perm[start:start + self.batch_size]
+                yield self.images[idx], self.targets[idx]
+
 # DATA PIPELINE
-def get_cifar10_loaders(batch_size=128):
+def get_cifar10_loaders(batch_size=128, batch_augment=False, device=None, num_replicas=1, rank=0):
+    """Train/test loaders; ``batch_augment`` serves preloaded uint8 tensors and augments whole batches
+    in the main process instead of decoding images through PIL in worker processes.
+
+    With ``num_replicas`` > 1 the train loader only yields this ``rank``'s shard; call
+    set_loader_epoch() before every epoch. The test loader is never sharded."""
+    if batch_augment:
+        train_set = InMemoryCIFAR10(train=True)
+        test_set = InMemoryCIFAR10(train=False)
+        train_loader = FastLoader(train_set.images, train_set.targets, batch_size, shuffle=True,
+                                  num_replicas=num_replicas, rank=rank)
+        test_loader = FastLoader(test_set.images, test_set.targets, batch_size, shuffle=False)
+        return AugmentedLoader(train_loader, BatchAugment(train=True), device), \
+               AugmentedLoader(test_loader, BatchAugment(train=False), device)
+
     transform_train = transforms.Compose([
         transforms.RandomCrop(32, padding=4),
         transforms.RandomHorizontalFlip(),
         transforms.ToTensor(),
         Cutout(n_holes=1, length=16),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+        transforms.Normalize(CIFAR10_MEAN, CIFAR10_STD)
     ])
 
     transform_test = transforms.Compose([
         transforms.ToTensor(),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+        transforms.Normalize(CIFAR10_MEAN, CIFAR10_STD)
     ])
 
     train_set = torchvision.datasets.CIFAR10(root='./data', train=True, download=True, transform=transform_train)
     test_set = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=transform_test)
-    return DataLoader(train_set, batch_size, shuffle=True, num_workers=4, pin_memory=True), \
-           DataLoader(test_set, batch_size, shuffle=False, num_workers=2, pin_memory=True)
+    if num_replicas > 1:
+        sampler = DistributedSampler(train_set, num_replicas=num_replicas, rank=rank, shuffle=True)
+        train_loader = DataLoader(train_set, batch_size, sampler=sampler, num_workers=4, pin_memory=True)
+    else:
+        train_loader = DataLoader(train_set, batch_size, shuffle=True, num_workers=4, pin_memory=True)
+    return train_loader, DataLoader(test_set, batch_size, shuffle=False, num_workers=2, pin_memory=True)
+
+def benchmark_cifar10_loaders(batch_size=128, num_batches=100, device=None):
+    """Images/sec of the torchvision worker loader vs. the in-memory loader, augmentation included."""
+    results = {}
+    for name, batch_augment in [("torchvision", False), ("in-memory", True)]:
+        start = time.perf_counter()
+        train_loader, _ = get_cifar10_loaders(batch_size, batch_augment=batch_augment, device=device)
+        setup_time = time.perf_counter() - start
+
+        images, first_batch_time = 0, None
+        start = time.perf_counter()
+        for i, (inputs, _) in enumerate(train_loader):
+            if first_batch_time is None:
+                first_batch_time = time.perf_counter() - start
+            images += inputs.size(0)
+            if i + 1 >= num_batches:
+                break
+        elapsed = time.perf_counter() - start
+
+        results[name] = {"setup_s": setup_time, "first_batch_s": first_batch_time,
+                         "images_per_sec": images / elapsed}
+        print(f"{name:>12}: {images / elapsed:10.0f} img/s | first batch {first_batch_time:.2f}s | "
+              f"setup {setup_time:.2f}s")
+    return results
 
 # Custom dataset for competition test data
 class CustomCIFAR10TestDataset(Dataset):
@@ -306,10 +604,75 @@ class CustomCIFAR10TestDataset(Dataset):
 
         return img, img_id
 
-def get_competition_test_loader(file_path, batch_size=128):
+# Memory-mapped competition test data
+def convert_test_pickle(file_path, out_path=None, chunk_size=65536):
+    """One-time conversion of the test pickle into a uint8 [N, 3, 32, 32] .npy file.
+
+    Skipped when ``out_path`` is already newer than the pickle. Returns ``out_path``.
+    """
+    out_path = out_path if out_path else os.path.splitext(file_path)[0] + ".npy"
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(file_path):
+        return out_path
+
+    with open(file_path, 'rb') as f:
+        data_dict = pickle.load(f, encoding='bytes')
+    if isinstance(data_dict, np.ndarray):
+        data = data_dict
+    else:
+        data = data_dict['data'] if 'data' in data_dict else data_dict[b'data']
+    if len(data.shape) == 2:  # [N, 3072] format
+        data = data.reshape(-1, 3, 32, 32)
+    elif data.shape[-1] == 3:  # [N, 32, 32, 3] format
+        data = data.transpose(0, 3, 1, 2)
+
+    tmp_path = out_path + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=data.shape)
+    for start in range(0, len(data), chunk_size):
+        out[start:start + chunk_size] = data[start:start + chunk_size]
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+    print(f"Converted {file_path} to {out_path} ({len(data)} images)")
+    return out_path
+
+class MemmapTestDataset:
+    """ Competition test images read lazily from a uint8 .npy memmap; IDs come from indices """
+    def __init__(self, npy_path):
+        self.data = np.load(npy_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.data)
+
+    def ids(self, start, stop):
+        return [f"{i:05d}" for i in range(start, stop)]
+
+    def batch(self, start, stop):
+        return torch.from_numpy(np.array(self.data[start:stop]))
+
+class MemmapTestLoader:
+    """ Yields (normalized float batch, IDs) straight from the mapped file, one slice per batch """
+    def __init__(self, dataset, batch_size=128, device=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device if device else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.normalize = BatchAugment(train=False)
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            stop = min(start + self.batch_size, len(self.dataset))
+            inputs = self.dataset.batch(start, stop).to(self.device, non_blocking=True)
+            yield self.normalize(inputs), self.dataset.ids(start, stop)
+
+def get_competition_test_loader(file_path, batch_size=128, memmap=False):
+    if memmap:
+        return MemmapTestLoader(MemmapTestDataset(convert_test_pickle(file_path)), batch_size)
+
     transform_test = transforms.Compose([
         transforms.ToTensor(),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+        transforms.Normalize(CIFAR10_MEAN, CIFAR10_STD)
     ])
 
     test_set = CustomCIFAR10TestDataset(file_path, transform=transform_test)
@@ -326,204 +689,1749 @@ from shutil import copyfile
 
 # Copy from Drive to current directory
 drive_test_file = os.path.join('/content/drive/MyDrive/3_DL_Project1_CIFAR10', 'cifar_test_nolabel.pkl')
-if os.path.exists(drive_test_file):
+if __name__ == "__main__" and os.path.exists(drive_test_file):
     copyfile(drive_test_file, 'cifar_test_nolabel.pkl')
     print("Test file copied from Google Drive backup")
 
-def tta_predict(model, img, num_aug=10):
-    """Enhanced Test-time augmentation with more diverse but controlled transformations."""
+# Declarative TTA configuration: each view names an op from TTA_OPS, its extra
+# keyword arguments and its weight in the final weighted average.
+def _tta_identity(img):
+    return img
+
+def _tta_hflip(img):
+    return torch.flip(img, dims=[3])
+
+def _tta_shift_h(img):
+    return F.pad(img[:, :, 1:, :], (0, 0, 0, 1), mode='replicate')
+
+def _tta_shift_w(img):
+    return F.pad(img[:, :, :, 1:], (1, 0, 0, 0), mode='replicate')
+
+def _tta_scale(img, factor=1.0, clamp=False):
+    out = img * factor
+    return torch.clamp(out, 0, 1) if clamp else out
+
+TTA_OPS = {
+    "identity": _tta_identity,
+    "hflip": _tta_hflip,
+    "shift_h": _tta_shift_h,
+    "shift_w": _tta_shift_w,
+    "scale": _tta_scale,
+}
+
+DEFAULT_TTA_CONFIG = {
+    "temperature": 1.2,  # Soften predictions with temperature
+    "views": [
+        {"op": "identity", "weight": 1.5},  # higher weight for original prediction
+        {"op": "hflip", "weight": 1.0},
+        {"op": "shift_h", "weight": 1.0},
+        {"op": "shift_w", "weight": 1.0},
+        {"op": "scale", "factor": 1.05, "clamp": True, "weight": 1.0},  # +5% brightness
+        {"op": "scale", "factor": 0.95, "weight": 1.0},  # -5% brightness
+    ],
+}
+
+def build_tta_batch(img, views):
+    """Stack every TTA view of ``img`` into one [V*B, C, H, W] batch (view-major)."""
+    batch = []
+    for view in views:
+        params = {k: v for k, v in view.items() if k not in ("op", "weight")}
+        batch.append(TTA_OPS[view["op"]](img, **params))
+    return torch.cat(batch)
+
+def tta_weights(views, device=None):
+    weights = torch.tensor([float(v["weight"]) for v in views], device=device)
+    return weights / weights.sum()
+
+def tta_predict(model, img, num_aug=10, tta_config=None, max_batch=None):
+    """Test-time augmentation with all views evaluated in a single stacked forward.
+
+    ``max_batch`` bounds the number of images per forward call; the stacked batch
+    is split into chunks of that size when it would otherwise exceed it. ``model`` may be a
+    CompiledModel warmed up for the stacked batch sizes (see loader_batch_sizes). A config with
+    an "adaptive" entry (see ADAPTIVE_TTA_CONFIG) runs adaptive_tta_predict instead.
+    """
+    cfg = tta_config if tta_config is not None else DEFAULT_TTA_CONFIG
+    if "adaptive" in cfg:
+        return adaptive_tta_predict(model, img, cfg, max_batch)[0]
+    views = cfg["views"]
     model.eval()
-    img = img.clone()
-    predictions = []
-
-    # Original prediction (with temperature scaling to reduce overconfidence)
-    with torch.no_grad():
-        outputs = model(img) / 1.2  # Soften predictions with temperature
-        predictions.append(outputs)
-
-    # Horizontal flip (essential for CIFAR-10)
-    with torch.no_grad():
-        flipped = torch.flip(img, dims=[3])
-        outputs = model(flipped) / 1.2
-        predictions.append(outputs)
-
-    # Small shifts (1 pixel in each direction)
     with torch.no_grad():
-        shifted = F.pad(img[:, :, 1:, :], (0, 0, 0, 1), mode='replicate')
-        outputs = model(shifted) / 1.2
-        predictions.append(outputs)
-
-        shifted = F.pad(img[:, :, :, 1:], (1, 0, 0, 0), mode='replicate')
-        outputs = model(shifted) / 1.2
-        predictions.append(outputs)
-
-    # Small brightness adjustments
+        batch = build_tta_batch(img, views)
+        if max_batch is None or batch.size(0) <= max_batch:
+            logits = model(batch)
+        else:
+            logits = torch.cat([model(chunk) for chunk in batch.split(max_batch)])
+        logits = logits.view(len(views), img.size(0), -1) / cfg.get("temperature", 1.0)
+        weights = tta_weights(views, device=logits.device).to(logits.dtype)
+        return torch.tensordot(weights, logits, dims=1)
+
+
+# Confidence-adaptive TTA: a tta_config with an "adaptive" entry runs the plain forward first and
+# only sends samples whose softmax margin falls below (or entropy rises above) the threshold
+# through the remaining views. Without a "threshold" the criterion's default below is used.
+ADAPTIVE_TTA_CONFIG = dict(DEFAULT_TTA_CONFIG, adaptive={"criterion": "margin"})
+
+# Each criterion on its own scale: the top-2 margin lies in [0, 1], the entropy in [0, ln 10 = 2.30] nats
+ESCALATION_THRESHOLDS = {"margin": 0.3, "entropy": 0.6}
+ESCALATION_SWEEPS = {"margin": (0.05, 0.1, 0.2, 0.3, 0.5, 0.7), "entropy": (0.1, 0.25, 0.5, 0.75, 1.0, 1.5)}
+
+def _check_criterion(criterion):
+    if criterion not in ESCALATION_THRESHOLDS:
+        raise ValueError(f"Unknown escalation criterion {criterion}, expected one of {tuple(ESCALATION_THRESHOLDS)}")
+
+def escalation_mask(logits, criterion="margin", threshold=None):
+    """Samples the plain forward is unsure about: top-2 softmax margin below ``threshold`` or entropy
+    (nats) above it; ``threshold`` defaults to ESCALATION_THRESHOLDS[criterion]."""
+    _check_criterion(criterion)
+    threshold = ESCALATION_THRESHOLDS[criterion] if threshold is None else threshold
+    probs = F.softmax(logits.float(), dim=1)
+    if criterion == "margin":
+        top2 = probs.topk(2, dim=1).values
+        return top2[:, 0] - top2[:, 1] < threshold
+    return -(probs * probs.clamp_min(1e-12).log()).sum(1) > threshold
+
+def _plain_view_index(views):
+    return next((i for i, v in enumerate(views) if v["op"] == "identity" and set(v) <= {"op", "weight"}), None)
+
+def adaptive_tta_predict(model, img, tta_config=None, max_batch=None):
+    """TTA on the uncertain samples only; returns (logits, escalated) with ``escalated`` a bool [B] mask.
+
+    Confident samples keep the plain logits divided by the TTA temperature, so both groups are on
+    the scale tta_predict produces. The identity view's logits are reused for escalated samples.
+    """
+    cfg = tta_config if tta_config is not None else ADAPTIVE_TTA_CONFIG
+    adaptive = cfg.get("adaptive", ADAPTIVE_TTA_CONFIG["adaptive"])
+    views = cfg["views"]
+    model.eval()
     with torch.no_grad():
-        brightened = img * 1.05  # +5% brightness
-        brightened = torch.clamp(brightened, 0, 1)
-        outputs = model(brightened) / 1.2
-        predictions.append(outputs)
-
-        darkened = img * 0.95  # -5% brightness
-        outputs = model(darkened) / 1.2
-        predictions.append(outputs)
-
-    # weighted average with higher weight for original prediction
-    weights = torch.tensor([1.5] + [1.0] * (len(predictions) - 1)).to(img.device)
-    weights = weights / weights.sum()
-
-    weighted_preds = torch.stack([(w * p) for w, p in zip(weights, predictions)])
-    return weighted_preds.sum(0)
-
-    # Average predictions
-    return torch.stack(predictions).mean(0)
+        plain = model(img)
+        escalated = escalation_mask(plain, adaptive.get("criterion", "margin"), adaptive.get("threshold"))
+        logits = plain / cfg.get("temperature", 1.0)
+        idx = escalated.nonzero().squeeze(1)
+        if idx.numel() == 0:
+            return logits, escalated
+        plain_view = _plain_view_index(views)
+        extra_views = [v for i, v in enumerate(views) if i != plain_view]
+        if not extra_views:
+            return logits, escalated
+        extra_cfg = {"temperature": cfg.get("temperature", 1.0), "views": extra_views}
+        refined = tta_predict(model, img[idx], tta_config=extra_cfg, max_batch=max_batch)
+        if plain_view is not None:
+            # tta_predict normalized the weights over the extra views only; fold the plain view back in
+            weights = tta_weights(views, device=logits.device).to(logits.dtype)
+            refined = refined * (1 - weights[plain_view]) + logits[idx] * weights[plain_view]
+        logits[idx] = refined.to(logits.dtype)
+        return logits, escalated
+
+# TRAINING METRICS
+class EpochMetrics:
+    """ Training statistics accumulated in on-device tensors; read() is the only host sync """
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        # [loss * batch, mixup-weighted correct, grad norm]
+        self.sums = torch.zeros(3, device=self.device)
+        self.samples = 0
+        self.steps = 0
+        self.lr = 0.0
+
+    def update(self, loss, outputs, targets_a, targets_b, lam, grad_norm, lr):
+        with torch.no_grad():
+            predicted = outputs.argmax(1)
+            correct = lam * predicted.eq(targets_a).sum() + (1 - lam) * predicted.eq(targets_b).sum()
+            self.sums += torch.stack([loss.detach().float() * outputs.size(0), correct.float(),
+                                      grad_norm.detach().float().to(self.device)])
+        self.samples += outputs.size(0)
+        self.steps += 1
+        self.lr = lr
+
+    def all_reduce(self):
+        """Sum the statistics over every rank of the default process group (collective call)."""
+        counts = torch.tensor([self.samples, self.steps], dtype=torch.float64, device=self.device)
+        dist.all_reduce(self.sums)
+        dist.all_reduce(counts)
+        self.samples, self.steps = (int(c) for c in counts.tolist())
+
+    def read(self):
+        loss_sum, correct, grad_norm_sum = self.sums.tolist()
+        samples, steps = max(self.samples, 1), max(self.steps, 1)
+        return {"loss": loss_sum / samples, "train_acc": 100. * correct / samples,
+                "grad_norm": grad_norm_sum / steps, "lr": self.lr, "samples": self.samples, "steps": self.steps}
+
+class StepTimer:
+    """ Per-phase time totals; on CUDA device phases use events so only summary() synchronizes """
+    def __init__(self, device):
+        self.cuda = device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.host = defaultdict(float)
+        self.events = defaultdict(list)
+
+    def now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def add(self, phase, start, end):
+        if self.cuda:
+            self.events[phase].append((start, end))
+        else:
+            self.host[phase] += end - start
+
+    def add_host(self, phase, seconds):
+        self.host[phase] += seconds
+
+    def summary(self):
+        totals = dict(self.host)
+        if self.events:
+            torch.cuda.synchronize()
+            for phase, pairs in self.events.items():
+                totals[phase] = totals.get(phase, 0.0) + sum(s.elapsed_time(e) for s, e in pairs) / 1e3
+        return totals
+
+def append_jsonl(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+# CHECKPOINTING
+def snapshot_to_cpu(obj):
+    """Deep copy of a (nested) state with every tensor cloned to CPU, safe to write while training continues."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def atomic_torch_save(obj, path):
+    """torch.save to a temp file in the same directory, fsync, then rename over ``path``."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class AsyncCheckpointWriter:
+    """ Background-thread checkpoint writer with atomic writes and retention of the last N epochs
+
+    save() snapshots tensors to CPU on the calling thread and returns; the disk write happens on
+    the writer thread. A write error is re-raised on the next save(), wait() or close().
+    """
+    def __init__(self, directory, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path, prune = item
+                atomic_torch_save(obj, path)
+                if prune:
+                    self._prune()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _prune(self):
+        for old in sorted(glob.glob(os.path.join(self.directory, "checkpoint_epoch*.pt")))[:-self.keep_last]:
+            os.remove(old)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"Checkpoint write failed: {error}") from error
+
+    def save(self, obj, path=None, epoch=None):
+        """Queue ``obj`` for ``path``, or for the rotating checkpoint_epochNNNN.pt when ``epoch`` is given."""
+        self._check()
+        prune = path is None
+        if path is None:
+            path = os.path.join(self.directory, f"checkpoint_epoch{epoch:04d}.pt")
+        self.queue.put((snapshot_to_cpu(obj), path, prune))
+        return path
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+def latest_checkpoint(directory):
+    paths = sorted(glob.glob(os.path.join(directory, "checkpoint_epoch*.pt")))
+    return paths[-1] if paths else None
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def training_state(epoch, best_acc, model, ema_model, optimizer, schedulers, scaler, config=None):
+    return {"epoch": epoch, "best_acc": best_acc, "config": config, "model": model.state_dict(),
+            "ema": ema_model.ema, "ema_num_updates": ema_model.num_updates,
+            "optimizer": optimizer.state_dict(),
+            "schedulers": [sch.state_dict() for sch in schedulers],
+            "scaler": scaler.state_dict(), "rng": rng_state()}
+
+def restore_training_state(path, model, ema_model, optimizer, schedulers, scaler, restore_rng=True, config=None):
+    """Load a training_state() checkpoint in place; returns (next_epoch, best_acc).
+
+    ``ema_model`` may be None (non-zero ranks keep no EMA); ``restore_rng`` False keeps the
+    current RNG streams, e.g. on ranks whose streams were not the ones checkpointed. A checkpoint
+    saved with a training config other than ``config`` raises ValueError.
+    """
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    if config is not None and state.get("config") is not None:
+        # Compared as JSON so tuples and lists (e.g. a config read back from a trial store) match
+        saved, current = json.loads(json.dumps(state["config"])), json.loads(json.dumps(config))
+        if saved != current:
+            changed = sorted(k for k in saved.keys() | current.keys() if saved.get(k) != current.get(k))
+            raise ValueError(f"{path} was saved with a different training config (differs in {changed}); "
+                             f"pass resume=False or another checkpoint_dir to start over")
+    model.load_state_dict(state["model"])
+    if ema_model is not None:
+        with torch.no_grad():
+            for k, v in state["ema"].items():
+                ema_model.ema[k].copy_(v)
+        ema_model.num_updates = state["ema_num_updates"]
+    optimizer.load_state_dict(state["optimizer"])
+    for sch, sch_state in zip(schedulers, state["schedulers"]):
+        sch.load_state_dict(sch_state)
+    scaler.load_state_dict(state["scaler"])
+    if restore_rng:
+        set_rng_state(state["rng"])
+    print(f"Resumed from {path} (epoch {state['epoch'] + 1}, best accuracy {state['best_acc']:.2f}%)")
+    return state["epoch"] + 1, state["best_acc"]
 
 # OPTIMIZATION AND TRAINING
-class Lookahead(torch.optim.Optimizer):
+class Lookahead:
+    """ Lookahead wrapper: every ``k`` base steps the slow weights move ``alpha`` towards the fast ones
+
+    All slow weights live in one contiguous buffer (created at the first sync from the fast
+    weights) and are updated with multi-tensor foreach ops over views into it, so a sync costs a
+    few kernel launches instead of three per parameter tensor.
+    """
     def __init__(self, base_optimizer, k=5, alpha=0.5):
         self.optimizer = base_optimizer
         self.k = k
         self.alpha = alpha
-        self.param_groups = self.optimizer.param_groups
-        self.defaults = self.optimizer.defaults
-        self.state = defaultdict(dict)
-        for group in self.param_groups:
-            group["counter"] = 0
+        self.counter = 0
+        self.params = [p for group in base_optimizer.param_groups for p in group["params"]]
+        if len({(p.dtype, p.device) for p in self.params}) > 1:
+            raise ValueError("Lookahead keeps one flat slow-weight buffer; parameters must share dtype and device")
+        self.slow = None
+        self.slow_views = None
+
+    # The base optimizer owns the hyperparameters; schedulers, GradScaler and clipping see its groups
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def defaults(self):
+        return self.optimizer.defaults
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def _bind_slow(self, flat):
+        self.slow = flat
+        self.slow_views = [v.view_as(p) for v, p in zip(flat.split([p.numel() for p in self.params]), self.params)]
+
+    @torch.no_grad()
+    def sync(self):
+        fast = [p.detach() for p in self.params]
+        if self.slow is None:
+            # First sync: slow weights start at the current fast weights, nothing moves
+            self._bind_slow(torch.cat([p.reshape(-1) for p in fast]))
+            return
+        torch._foreach_lerp_(self.slow_views, fast, self.alpha)
+        torch._foreach_copy_(fast, self.slow_views)
 
     def step(self, closure=None):
         loss = self.optimizer.step(closure)
-        for group in self.param_groups:
-            group["counter"] += 1
-            if group["counter"] >= self.k:
-                for p in group["params"]:
-                    param_state = self.state[p]
-                    if "slow_param" not in param_state:
-                        param_state["slow_param"] = p.data.clone()
-                    param_state["slow_param"].add_(p.data - param_state["slow_param"], alpha=self.alpha)
-                    p.data.copy_(param_state["slow_param"])
-                group["counter"] = 0
+        self.counter += 1
+        if self.counter >= self.k:
+            self.sync()
+            self.counter = 0
         return loss
 
-    def zero_grad(self):
-        self.optimizer.zero_grad()
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
 
-def train_model():
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    train_loader, test_loader = get_cifar10_loaders()
+    def state_dict(self):
+        return {"base": self.optimizer.state_dict(), "k": self.k, "alpha": self.alpha,
+                "counter": self.counter, "slow": self.slow}
 
-    model = ResNet([4, 4, 3]).to(device)
-    base_optimizer = SGD(model.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True)
-    optimizer = Lookahead(base_optimizer)
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict["base"])
+        self.k, self.alpha, self.counter = state_dict["k"], state_dict["alpha"], state_dict["counter"]
+        slow = state_dict["slow"]
+        if slow is None:
+            self.slow = self.slow_views = None
+        else:
+            if slow.numel() != sum(p.numel() for p in self.params):
+                raise ValueError(f"Slow-weight buffer has {slow.numel()} elements, parameters have "
+                                 f"{sum(p.numel() for p in self.params)}")
+            self._bind_slow(slow.to(device=self.params[0].device, dtype=self.params[0].dtype, copy=True))
+
+# Training hyperparameters; train_model(config=...) overrides any subset of them
+TRAIN_DEFAULTS = {
+    "arch": (4, 4, 3),
+    "num_channels": 64,
+    "num_epochs": 200,
+    "batch_size": 128,
+    "lr": 0.1,
+    "weight_decay": 5e-4,
+    "warmup_epochs": 10,      # Extended from 5 to 10 epochs
+    "pct_start": 0.4,         # Increased from 0.3 to 0.4
+    "mixup_alpha": 0.3,       # Reduced from 0.8 to 0.3
+    "mixup_ramp": ((50, 0.5), (100, 0.75)),  # Half strength at the beginning, 75% in the middle
+    "ema_decay": 0.999,       # Reduced from 0.9995
+    "lookahead_k": 5,
+    "lookahead_alpha": 0.5,
+}
+
+def train_model(compiled=False, log_every=None, log_path=None, eval_every=1, subset_epochs=0, subset_per_class=100,
+                resume=False, checkpoint_dir=None, keep_last=3, rank=0, world_size=1, bucket_cap_mb=25,
+                config=None, stop_epoch=None, output_dir=None, batch_augment=False,
+                teacher_logits=None, kd_temperature=4.0, kd_alpha=0.9):
+    """Train a ResNet configured by TRAIN_DEFAULTS updated with ``config``; per-epoch metrics and
+    step-time breakdown go to ``log_path`` (JSON lines).
+
+    ``log_every`` additionally reads and prints the running metrics every N steps. The test set is
+    scored every ``eval_every`` epochs (always after the last one); during the first
+    ``subset_epochs`` epochs only a fixed stratified subset is scored, and checkpoints are
+    only selected on full evaluations.
+
+    The full training state is written to ``checkpoint_dir`` after every epoch by a background
+    writer (last ``keep_last`` kept). With ``resume`` training continues from the latest one, which
+    must have been saved with the same config; without it earlier checkpoints there are removed.
+
+    With ``world_size`` > 1 this is one rank of a gloo process group (see train_distributed): the
+    global batch of 128 is sharded across ranks, gradients are all-reduced by DDP in
+    ``bucket_cap_mb`` buckets, and EMA, evaluation, checkpoints and logging live on rank 0 only.
+
+    ``stop_epoch`` ends the run early (with an evaluation) while keeping the LR schedule of the
+    full ``num_epochs``; a later call with ``resume`` continues it. Checkpoints and logs go to
+    ``output_dir`` (default DRIVE_PATH). ``batch_augment`` selects the in-memory loader, which
+    augments in this process instead of in DataLoader workers.
+
+    ``teacher_logits`` [50000, 10] (one row per training image, see teacher_soft_targets) turns this
+    into knowledge distillation: the loss becomes distillation_loss() with ``kd_temperature`` and
+    ``kd_alpha``. It requires ``batch_augment``. Returns the best and the last EMA accuracy.
+    """
+    cfg = {**TRAIN_DEFAULTS, **(config or {})}
+    output_dir = output_dir if output_dir else DRIVE_PATH
+    distributed = world_size > 1
+    is_main = rank == 0
+    if distributed and compiled:
+        raise ValueError("compiled=True is not supported together with world_size > 1")
+    distill = teacher_logits is not None
+    if distill and not batch_augment:
+        raise ValueError("teacher_logits are looked up by training-image index and need batch_augment=True")
+    device = torch.device("cpu" if distributed else "cuda" if torch.cuda.is_available() else "cpu")
+    train_loader, test_loader = get_cifar10_loaders(batch_size=cfg["batch_size"] // world_size,
+                                                    batch_augment=batch_augment, device=device,
+                                                    num_replicas=world_size, rank=rank)
+    if distill:
+        # The train loader yields sample indices as targets, so labels and teacher logits can be looked up after mixup
+        labels = train_loader.loader.targets.to(device)
+        teacher_logits = teacher_logits.to(device)
+        train_loader.loader.targets = torch.arange(len(labels), device=train_loader.loader.targets.device)
+    num_epochs = cfg["num_epochs"]
+    stop_epoch = min(stop_epoch, num_epochs) if stop_epoch else num_epochs
+
+    model = ResNet(list(cfg["arch"]), num_channels=cfg["num_channels"]).to(device)
+    forward_model = model
+    # Cached eval batches use the test loader's batch size, so a compiled run evaluates on warmed shapes
+    eval_batch_size = max(loader_batch_sizes(test_loader))
+    if compiled:
+        # channels_last + torch.compile; train and eval graphs for every batch size are built up front
+        batch_sizes = set(loader_batch_sizes(train_loader)) | set(loader_batch_sizes(test_loader))
+        forward_model, _ = compile_model(model, tuple(batch_sizes), training=True)
+    base_optimizer = SGD(model.parameters(), lr=cfg["lr"], momentum=0.9, weight_decay=cfg["weight_decay"], nesterov=True)
+    optimizer = Lookahead(base_optimizer, k=cfg["lookahead_k"], alpha=cfg["lookahead_alpha"])
 
     # EMA model with reduced decay rate
-    ema_model = ModelEMA(model, decay=0.999, device=device)  # Reduced from 0.9995
+    ema_model = ModelEMA(model, decay=cfg["ema_decay"], device=device) if is_main else None
 
     # Warmup period for better stability with MixUp
+    warmup_epochs = cfg["warmup_epochs"]
     warmup_scheduler = torch.optim.lr_scheduler.LinearLR(
-        optimizer.optimizer, start_factor=0.01, total_iters=10*len(train_loader)  # Extended from 5 to 10 epochs
+        optimizer.optimizer, start_factor=0.01, total_iters=warmup_epochs*len(train_loader)
     )
 
     # OneCycleLR for better compatibility with MixUp
     main_scheduler = torch.optim.lr_scheduler.OneCycleLR(
-        optimizer.optimizer, max_lr=0.1, total_steps=200*len(train_loader), pct_start=0.4  # Increased from 0.3 to 0.4
+        optimizer.optimizer, max_lr=cfg["lr"], total_steps=num_epochs*len(train_loader), pct_start=cfg["pct_start"]
     )
 
     criterion = nn.CrossEntropyLoss()
     scaler = torch.cuda.amp.GradScaler()
     best_acc = 0.0
-    model_save_path = os.path.join(DRIVE_PATH, "best_model.pth")
-    ema_model_save_path = os.path.join(DRIVE_PATH, "best_ema_model.pth")
+    last_acc = None
+    model_save_path = os.path.join(output_dir, "best_model.pth")
+    ema_model_save_path = os.path.join(output_dir, "best_ema_model.pth")
+    log_path = log_path if log_path else os.path.join(output_dir, "train_log.jsonl")
+    metrics = EpochMetrics(device)
+    timer = StepTimer(device)
+
+    checkpoint_dir = checkpoint_dir if checkpoint_dir else os.path.join(output_dir, "checkpoints")
+    writer = AsyncCheckpointWriter(checkpoint_dir, keep_last=keep_last) if is_main else None
+    schedulers = [warmup_scheduler, main_scheduler]
+
+    # Pre-normalized test set, decoded once; live and EMA weights are scored from it in one loop.
+    # Cached before the restore: iterating a DataLoader draws from the global RNG, which the
+    # checkpoint's RNG state must be the last thing to set before the epoch loop.
+    if is_main:
+        eval_images, eval_targets = cache_eval_set(test_loader, device)
+        eval_subset = stratified_indices(eval_targets, subset_per_class) if subset_epochs > 0 else None
+
+    start_epoch = 0
+    if resume and latest_checkpoint(checkpoint_dir):
+        # Every rank restores the same rank-0 checkpoint; the RNG streams saved are rank 0's
+        start_epoch, best_acc = restore_training_state(latest_checkpoint(checkpoint_dir), model, ema_model,
+                                                       optimizer, schedulers, scaler, restore_rng=is_main,
+                                                       config=cfg)
+    elif is_main:
+        # A fresh run replaces an earlier run's checkpoints; higher epochs would outrank its own and get them pruned
+        for stale in glob.glob(os.path.join(checkpoint_dir, "checkpoint_epoch*.pt")):
+            os.remove(stale)
+    eval_model = forward_model
+    if distributed:
+        # Wrapped after the restore so the broadcast from rank 0 carries the resumed weights
+        forward_model = DistributedDataParallel(model, bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True)
 
     # Training configurations - We use only MixUp with reduced alpha
     use_mixup = True
-    use_cutmix = False  # Disabled CutMix
-    mixup_alpha = 0.3   # Reduced from 0.8 to 0.3
-    cutmix_alpha = 0.0  # Not used
-    mixup_prob = 1.0    # we use MixUp
-
-    for epoch in range(200):
-        model.train()
-        total_loss, correct, total = 0.0, 0, 0
-
-        for inputs, targets in train_loader:
+    mixup_alpha = cfg["mixup_alpha"]
+
+    for epoch in range(start_epoch, stop_epoch):
+        forward_model.train()
+        set_loader_epoch(train_loader, epoch)
+        metrics.reset()
+        timer.reset()
+        epoch_start = time.perf_counter()
+        wait_start = time.perf_counter()
+
+        for step, (inputs, targets) in enumerate(train_loader):
+            timer.add_host("data_wait", time.perf_counter() - wait_start)
             inputs, targets = inputs.to(device), targets.to(device)
-
+            t_forward = timer.now()
 
             # We start with a lower alpha and gradually increase it
-            if epoch < 50:
-                current_mixup_alpha = mixup_alpha * 0.5  # Half strength at the beginning
-            elif epoch < 100:
-                current_mixup_alpha = mixup_alpha * 0.75  # 75% strength in the middle
-            else:
-                current_mixup_alpha = mixup_alpha  # Full strength later
+            current_mixup_alpha = mixup_alpha * mixup_ramp_factor(cfg["mixup_ramp"], epoch)
 
             # we apply only MixUp (no CutMix)
             if use_mixup:
                 inputs, targets_a, targets_b, lam = mixup_data(inputs, targets, current_mixup_alpha)
             else:
                 targets_a, targets_b, lam = targets, targets, 1.0
+            if distill:
+                teacher_a, teacher_b = teacher_logits[targets_a], teacher_logits[targets_b]
+                targets_a, targets_b = labels[targets_a], labels[targets_b]
 
             with torch.cuda.amp.autocast(dtype=torch.float16):
-                outputs = model(inputs)
-                if use_mixup:
+                outputs = forward_model(inputs)
+                if distill:
+                    loss = distillation_loss(criterion, outputs.float(), teacher_a, teacher_b, targets_a, targets_b,
+                                             lam, kd_temperature, kd_alpha)
+                elif use_mixup:
                     loss = mixup_criterion(criterion, outputs, targets_a, targets_b, lam)
                 else:
                     loss = criterion(outputs, targets)
+            t_backward = timer.now()
 
             scaler.scale(loss).backward()
             scaler.unscale_(optimizer)
-            nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            grad_norm = nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            t_optimizer = timer.now()
 
             scaler.step(optimizer)
             scaler.update()
             optimizer.zero_grad()
+            t_ema = timer.now()
 
             # EMA model updated
-            ema_model.update(model)
+            if ema_model is not None:
+                ema_model.update(model)
+            t_end = timer.now()
+
+            timer.add("forward", t_forward, t_backward)
+            timer.add("backward", t_backward, t_optimizer)
+            timer.add("optimizer", t_optimizer, t_ema)
+            timer.add("ema", t_ema, t_end)
 
             # Extended warmup period
-            if epoch < 10:  # Extended from 5 to 10 epochs
+            if epoch < warmup_epochs:
                 warmup_scheduler.step()
             main_scheduler.step()
 
-            total_loss += loss.item() * inputs.size(0)
-
-            # For accuracy calculation with mixup or cutmix
-            if use_mixup or use_cutmix:
-                _, predicted = outputs.max(1)
-                correct += (lam * predicted.eq(targets_a).sum().float()
-                          + (1 - lam) * predicted.eq(targets_b).sum().float()).item()
+            # Loss and mixup-weighted accuracy stay on device; no .item() per step
+            metrics.update(loss, outputs, targets_a, targets_b, lam, grad_norm,
+                           optimizer.optimizer.param_groups[0]['lr'])
+            if log_every and is_main and (step + 1) % log_every == 0:
+                running = metrics.read()
+                print(f"  step {step+1}/{len(train_loader)}: Loss: {running['loss']:.4f} | "
+                      f"Train Acc: {running['train_acc']:.2f}% | Grad norm: {running['grad_norm']:.3f}")
+            wait_start = time.perf_counter()
+
+        train_time = time.perf_counter() - epoch_start
+        if distributed:
+            metrics.all_reduce()
+        stats = metrics.read()
+        if not is_main:
+            continue
+        eval_start = time.perf_counter()
+
+        last_epoch = epoch == stop_epoch - 1
+        test_acc = regular_test_acc = None
+        if last_epoch or (epoch + 1) % eval_every == 0:
+            full_eval = last_epoch or epoch >= subset_epochs
+            regular_test_acc, test_acc = evaluate_with_ema(eval_model, ema_model, eval_images, eval_targets,
+                                                           eval_batch_size, None if full_eval else eval_subset)
+            if full_eval:
+                # Evaluate with EMA model
+                if test_acc > best_acc:
+                    best_acc = test_acc
+                    writer.save(ema_model.ema, ema_model_save_path)
+                    print(f"New best EMA model saved at epoch {epoch+1} with accuracy {best_acc:.2f}%")
+
+                # Also save the regular model
+                if regular_test_acc > best_acc - 0.5:  # We allow slightly worse performance for diversity
+                    writer.save(model.state_dict(), model_save_path)
+                    print(f"Regular model saved at epoch {epoch+1} with accuracy {regular_test_acc:.2f}%")
+            last_acc = test_acc
+
+        writer.save(training_state(epoch, best_acc, model, ema_model, optimizer, schedulers, scaler, cfg), epoch=epoch)
+        timings = timer.summary()
+        timings["eval"] = time.perf_counter() - eval_start
+        append_jsonl(log_path, {"epoch": epoch + 1, **stats, "test_acc_ema": test_acc,
+                                "test_acc": regular_test_acc, "eval_subset": not (last_epoch or epoch >= subset_epochs),
+                                "train_s": train_time,
+                                "images_per_sec": stats["samples"] / train_time, "timings_s": timings})
+
+        test_str = "skipped" if test_acc is None else f"{test_acc:.2f}% (EMA) / {regular_test_acc:.2f}%" + \
+            ("" if last_epoch or epoch >= subset_epochs else " [subset]")
+        print(f"Epoch {epoch+1}/{num_epochs}: Loss: {stats['loss']:.4f} | "
+              f"Train Acc: {stats['train_acc']:.2f}% | Test Acc: {test_str} | "
+              f"LR: {optimizer.optimizer.param_groups[0]['lr']:.5f} | {stats['samples'] / train_time:.0f} img/s | "
+              + " ".join(f"{k} {v:.1f}s" for k, v in timings.items()))
+
+    if not is_main:
+        return None
+    if start_epoch >= stop_epoch:
+        # Resumed a run that already reached stop_epoch: score the restored EMA weights
+        _, last_acc = evaluate_with_ema(eval_model, ema_model, eval_images, eval_targets, eval_batch_size)
+    writer.close()
+    print(f"\nTraining Complete. Best Accuracy: {best_acc:.2f}%")
+    print(f"Best EMA model saved to {ema_model_save_path}")
+    print(f"Regular model saved to {model_save_path}")
+    return {"best_acc": best_acc, "ema_acc": last_acc, "epoch": max(start_epoch, stop_epoch)}
+
+# DISTRIBUTED CPU TRAINING
+def pin_rank_threads(rank, world_size, threads_per_rank=None, pin=True):
+    """Give each rank its own block of cores: intra-op threads = block size, affinity = block."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    threads_per_rank = threads_per_rank or max(1, len(cores) // world_size)
+    torch.set_num_threads(threads_per_rank)
+    block = cores[rank * threads_per_rank:(rank + 1) * threads_per_rank]
+    if pin and block and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, block)
+    return block
+
+def init_distributed(rank, world_size, port, threads_per_rank=None, pin_threads=True):
+    pin_rank_threads(rank, world_size, threads_per_rank, pin_threads)
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    # Same weights on every rank (DDP also broadcasts them), different augmentation/mixup streams
+    set_random_seeds(84 + rank)
+
+def _train_worker(rank, world_size, port, threads_per_rank, pin_threads, train_kwargs):
+    init_distributed(rank, world_size, port, threads_per_rank, pin_threads)
+    try:
+        train_model(rank=rank, world_size=world_size, **train_kwargs)
+    finally:
+        dist.destroy_process_group()
+
+def check_spawnable(fn):
+    """Spawned processes import ``fn`` by module name, which fails for code defined in a notebook cell."""
+    if fn.__module__ == "__main__" and not getattr(sys.modules["__main__"], "__file__", None):
+        raise RuntimeError(f"{fn.__name__} is defined in an interactive session and spawned processes cannot "
+                           f"import it; save this script as SAMResNet.py and call it through `import SAMResNet`")
+
+def train_distributed(world_size, threads_per_rank=None, pin_threads=True, port=29500, **train_kwargs):
+    """Run train_model on ``world_size`` CPU processes (gloo); remaining kwargs go to train_model."""
+    if world_size == 1:
+        return train_model(**train_kwargs)
+    check_spawnable(_train_worker)
+    download_cifar10()
+    mp.spawn(_train_worker, args=(world_size, port, threads_per_rank, pin_threads, train_kwargs),
+             nprocs=world_size, join=True)
+
+# VECTORIZED HYPERPARAMETER SWEEP
+# One sweep point = these keys; mixup_ramp is ((until_epoch, alpha_factor), ...), factor 1 afterwards
+SWEEP_DEFAULTS = {
+    **{k: TRAIN_DEFAULTS[k] for k in ("mixup_alpha", "mixup_ramp", "ema_decay", "lookahead_k", "lookahead_alpha")},
+    "lr_scale": 1.0,
+}
+
+def _per_model(values, like):
+    """[M] tensor -> [M, 1, ..., 1] broadcastable against a stacked tensor ``like``."""
+    return values.view(-1, *[1] * (like.dim() - 1))
+
+class StackedSGD(torch.optim.Optimizer):
+    """ SGD (momentum, weight decay, Nesterov) over stacked [M, ...] parameters
+
+    ``group["lr"]`` is driven by the usual LR schedulers; model m steps with lr * lr_scale[m].
+    """
+    def __init__(self, params, lr_scale, lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True):
+        super().__init__(params, dict(lr=lr, momentum=momentum, weight_decay=weight_decay, nesterov=nesterov))
+        self.lr_scale = lr_scale
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for group in self.param_groups:
+            params = [p for p in group["params"] if p.grad is not None]
+            if not params:
+                continue
+            grads = torch._foreach_add([p.grad for p in params], params, alpha=group["weight_decay"])
+            bufs = []
+            for p, g in zip(params, grads):
+                state = self.state[p]
+                if "momentum_buffer" not in state:
+                    state["momentum_buffer"] = g.clone()
+                else:
+                    state["momentum_buffer"].mul_(group["momentum"]).add_(g)
+                bufs.append(state["momentum_buffer"])
+            if group["nesterov"]:
+                torch._foreach_add_(grads, bufs, alpha=group["momentum"])
             else:
-                _, predicted = outputs.max(1)
-                correct += predicted.eq(targets).sum().item()
+                grads = bufs
+            steps = [_per_model(self.lr_scale, g) * group["lr"] for g in grads]
+            torch._foreach_sub_(params, torch._foreach_mul(grads, steps))
+        return loss
 
-            total += targets.size(0)
+class StackedLookahead:
+    """ Lookahead over stacked parameters with per-model ``k`` and ``alpha`` ([M] tensors)
+
+    Model m syncs every k[m] of its steps; like Lookahead, its slow weights start at the fast
+    weights on its first sync.
+    """
+    def __init__(self, base_optimizer, k, alpha):
+        self.optimizer = base_optimizer
+        self.k = k
+        self.alpha = alpha
+        self.counter = 0
+        self.params = [p for group in base_optimizer.param_groups for p in group["params"]]
+        self.slow = [torch.zeros_like(p, requires_grad=False) for p in self.params]
+        self.started = torch.zeros_like(k, dtype=torch.bool)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def defaults(self):
+        return self.optimizer.defaults
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    @torch.no_grad()
+    def sync(self, due):
+        first = due & ~self.started
+        weight = torch.where(self.started, self.alpha, 0.0) * due
+        for p, slow in zip(self.params, self.slow):
+            slow.copy_(torch.where(_per_model(first, p), p, slow))
+            slow.lerp_(p, _per_model(weight, p))
+            p.copy_(torch.where(_per_model(due, p), slow, p))
+        self.started |= due
 
-        # Evaluate with EMA model
-        ema_model.apply()  # Apply EMA weights
-        test_acc = evaluate(model, test_loader, device)
-        if test_acc > best_acc:
-            best_acc = test_acc
-            torch.save(model.state_dict(), ema_model_save_path)
-            print(f"New best EMA model saved at epoch {epoch+1} with accuracy {best_acc:.2f}%")
-        ema_model.restore()  # Restore original weights
-
-        # Also evaluate and save the regular model
-        regular_test_acc = evaluate(model, test_loader, device)
-        if regular_test_acc > best_acc - 0.5:  # We allow slightly worse performance for diversity
-            torch.save(model.state_dict(), model_save_path)
-            print(f"Regular model saved at epoch {epoch+1} with accuracy {regular_test_acc:.2f}%")
-
-        print(f"Epoch {epoch+1}/200: Loss: {total_loss/total:.4f} | "
-              f"Train Acc: {100.*correct/total:.2f}% | Test Acc: {test_acc:.2f}% (EMA) / {regular_test_acc:.2f}% | "
-              f"LR: {optimizer.optimizer.param_groups[0]['lr']:.5f}")
+    def step(self, closure=None):
+        loss = self.optimizer.step(closure)
+        self.counter += 1
+        due = self.counter % self.k == 0
+        if due.any():
+            self.sync(due)
+        return loss
 
-    print(f"\nTraining Complete. Best Accuracy: {best_acc:.2f}%")
-    print(f"Best EMA model saved to {ema_model_save_path}")
-    print(f"Regular model saved to {model_save_path}")
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+
+    def state_dict(self):
+        return {"base": self.optimizer.state_dict(), "counter": self.counter, "slow": self.slow,
+                "started": self.started}
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict["base"])
+        self.counter = state_dict["counter"]
+        with torch.no_grad():
+            for slow, saved in zip(self.slow, state_dict["slow"]):
+                slow.copy_(saved)
+        self.started.copy_(state_dict["started"])
+
+class StackedModels:
+    """ M same-architecture models as stacked [M, ...] parameters/buffers run through one vmap call """
+    def __init__(self, models):
+        self.num_models = len(models)
+        self.params, self.buffers = stack_module_state(models)
+        self.base = copy.deepcopy(models[0]).to('meta')
+
+    def _call_one(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def __call__(self, x, params=None, buffers=None, shared_input=False):
+        """``x`` is [M, B, ...] (one batch per model) or, with ``shared_input``, one [B, ...] batch."""
+        params = self.params if params is None else params
+        buffers = self.buffers if buffers is None else buffers
+        return vmap(self._call_one, in_dims=(0, 0, None if shared_input else 0),
+                    randomness='different')(params, buffers, x)
+
+    def train(self):
+        self.base.train()
+        return self
+
+    def eval(self):
+        self.base.eval()
+        return self
+
+    def state_dict(self, m, tensors=None):
+        """Plain ResNet state dict of model ``m``, from the live weights or a stacked ``tensors`` dict."""
+        tensors = tensors if tensors is not None else {**self.params, **self.buffers}
+        return {k: v[m].detach().clone() for k, v in tensors.items()}
+
+class StackedEMA:
+    """ ModelEMA for stacked models with a per-model ``decay`` ([M] tensor) """
+    def __init__(self, models, decay):
+        self.ema = {k: v.detach().clone() for k, v in {**models.params, **models.buffers}.items()}
+        self.keys = [k for k, v in self.ema.items() if v.dtype.is_floating_point]
+        self.shadow = [self.ema[k] for k in self.keys]
+        self.weights = [_per_model(1 - decay, t) for t in self.shadow]
+        self.num_updates = 0
+
+    @torch.no_grad()
+    def update(self, models):
+        self.num_updates += 1
+        live = {**models.params, **models.buffers}
+        torch._foreach_lerp_(self.shadow, [live[k].detach() for k in self.keys], self.weights)
+
+    def split(self, models):
+        return ({k: self.ema[k] for k in models.params}, {k: self.ema[k] for k in models.buffers})
+
+def stacked_mixup(x, y, alpha):
+    """Mixup with a per-model ``alpha`` ([M]); returns [M, B, ...] inputs, y_a, y_b and lam [M].
+
+    The pairing permutation is shared, lam is drawn per model (alpha <= 0 disables mixup)."""
+    concentration = alpha.clamp(min=1e-3)
+    lam = torch.distributions.Beta(concentration, concentration).sample()
+    lam = torch.where(alpha > 0, lam, torch.ones_like(lam))
+    index = torch.randperm(x.size(0), device=x.device)
+    lam_x = _per_model(lam, x.unsqueeze(0))
+    return lam_x * x + (1 - lam_x) * x[index], y, y[index], lam
+
+def evaluate_stacked(models, ema, images, targets, batch_size=500):
+    """Per-model accuracy of the live and the EMA weights; returns two [M] tensors."""
+    models.eval()
+    ema_params, ema_buffers = ema.split(models)
+    correct = torch.zeros(2, models.num_models, device=images.device)
+    with torch.no_grad():
+        for start in range(0, len(targets), batch_size):
+            x, y = images[start:start + batch_size], targets[start:start + batch_size]
+            correct[0] += models(x, shared_input=True).argmax(-1).eq(y).sum(1)
+            correct[1] += models(x, ema_params, ema_buffers, shared_input=True).argmax(-1).eq(y).sum(1)
+    models.train()
+    return 100. * correct[0] / len(targets), 100. * correct[1] / len(targets)
+
+def train_sweep(configs, arch=(4, 4, 3), num_epochs=200, eval_every=1, sweep_dir=None):
+    """Train one model per config in lockstep on the same data stream; one vmap forward/backward per step.
+
+    Each config overrides SWEEP_DEFAULTS. Model m gets its own JSON-lines log and best live/EMA
+    checkpoints under ``sweep_dir``/model_<m>/. Returns the best EMA accuracy of every model.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    configs = [{**SWEEP_DEFAULTS, **c} for c in configs]
+    num_models = len(configs)
+    train_loader, test_loader = get_cifar10_loaders()
+    sweep_dir = sweep_dir if sweep_dir else os.path.join(DRIVE_PATH, "sweep")
+    model_dirs = [os.path.join(sweep_dir, f"model_{m}") for m in range(num_models)]
+    for m, model_dir in enumerate(model_dirs):
+        os.makedirs(model_dir, exist_ok=True)
+        with open(os.path.join(model_dir, "config.json"), 'w') as f:
+            json.dump(configs[m], f, indent=2)
+
+    def hyper(key, dtype=torch.float32):
+        return torch.tensor([c[key] for c in configs], dtype=dtype, device=device)
+
+    models = StackedModels([ResNet(list(arch)).to(device) for _ in range(num_models)]).train()
+    # Schedule shared by all models, the same as train_model's
+    max_lr, warmup_epochs = TRAIN_DEFAULTS["lr"], TRAIN_DEFAULTS["warmup_epochs"]
+    optimizer = StackedLookahead(StackedSGD(models.params.values(), hyper("lr_scale"), lr=max_lr,
+                                            weight_decay=TRAIN_DEFAULTS["weight_decay"]),
+                                 k=hyper("lookahead_k", torch.long), alpha=hyper("lookahead_alpha"))
+    ema = StackedEMA(models, hyper("ema_decay"))
+    warmup_scheduler = torch.optim.lr_scheduler.LinearLR(
+        optimizer.optimizer, start_factor=0.01, total_iters=warmup_epochs*len(train_loader))
+    main_scheduler = torch.optim.lr_scheduler.OneCycleLR(
+        optimizer.optimizer, max_lr=max_lr, total_steps=num_epochs*len(train_loader),
+        pct_start=TRAIN_DEFAULTS["pct_start"])
+    criterion = nn.CrossEntropyLoss(reduction='none')
+    eval_images, eval_targets = cache_eval_set(test_loader, device)
+    mixup_alpha = hyper("mixup_alpha")
+    best_acc = torch.zeros(num_models)
+
+    for epoch in range(num_epochs):
+        alpha = mixup_alpha * torch.tensor([mixup_ramp_factor(c["mixup_ramp"], epoch) for c in configs], device=device)
+        # [loss * batch, mixup-weighted correct, grad norm] per model
+        sums = torch.zeros(num_models, 3, device=device)
+        samples = 0
+        epoch_start = time.perf_counter()
+
+        for inputs, targets in train_loader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            inputs, targets_a, targets_b, lam = stacked_mixup(inputs, targets, alpha)
+            outputs = models(inputs)  # [M, B, C]
+            flat = outputs.flatten(0, 1)
+            lam_b = lam[:, None]
+            loss = (lam_b * criterion(flat, targets_a.repeat(num_models)).view(num_models, -1) +
+                    (1 - lam_b) * criterion(flat, targets_b.repeat(num_models)).view(num_models, -1)).mean(1)
+            # Models are independent, so the summed loss gives every model its own gradient
+            loss.sum().backward()
+
+            params = list(models.params.values())
+            grad_norm = torch.stack([p.grad.flatten(1).pow(2).sum(1) for p in params]).sum(0).sqrt()
+            clip = (1.0 / (grad_norm + 1e-6)).clamp(max=1.0)
+            torch._foreach_mul_([p.grad for p in params], [_per_model(clip, p) for p in params])
+            optimizer.step()
+            optimizer.zero_grad()
+            ema.update(models)
+
+            if epoch < warmup_epochs:
+                warmup_scheduler.step()
+            main_scheduler.step()
+
+            with torch.no_grad():
+                predicted = outputs.argmax(-1)
+                correct = lam * predicted.eq(targets_a).sum(1) + (1 - lam) * predicted.eq(targets_b).sum(1)
+                sums += torch.stack([loss.detach() * targets.size(0), correct, grad_norm], 1)
+            samples += targets.size(0)
+
+        train_time = time.perf_counter() - epoch_start
+        steps = len(train_loader)
+        stats = sums.cpu()
+        live_acc = ema_acc = None
+        if epoch == num_epochs - 1 or (epoch + 1) % eval_every == 0:
+            live_acc, ema_acc = (acc.cpu() for acc in evaluate_stacked(models, ema, eval_images, eval_targets))
+            ema_params, ema_buffers = ema.split(models)
+            for m in range(num_models):
+                if ema_acc[m] > best_acc[m]:
+                    best_acc[m] = ema_acc[m]
+                    torch.save(models.state_dict(m, {**ema_params, **ema_buffers}),
+                               os.path.join(model_dirs[m], "best_ema_model.pth"))
+                if live_acc[m] > best_acc[m] - 0.5:
+                    torch.save(models.state_dict(m), os.path.join(model_dirs[m], "best_model.pth"))
+
+        lr = optimizer.param_groups[0]['lr']
+        for m in range(num_models):
+            append_jsonl(os.path.join(model_dirs[m], "train_log.jsonl"), {
+                "epoch": epoch + 1, "loss": stats[m, 0].item() / samples, "train_acc": 100. * stats[m, 1].item() / samples,
+                "grad_norm": stats[m, 2].item() / steps, "lr": lr * configs[m]["lr_scale"],
+                "test_acc_ema": None if ema_acc is None else ema_acc[m].item(),
+                "test_acc": None if live_acc is None else live_acc[m].item(), "train_s": train_time})
+        print(f"Epoch {epoch+1}/{num_epochs}: {num_models} models | {num_models * samples / train_time:.0f} img/s | "
+              f"EMA acc: " + ("skipped" if ema_acc is None else " ".join(f"{a:.2f}" for a in ema_acc.tolist())))
+
+    print("\nSweep complete. Best EMA accuracy per model: " + " ".join(f"{a:.2f}%" for a in best_acc.tolist()))
+    return best_acc.tolist()
+
+# HYPERPARAMETER SEARCH (ASHA)
+def sample_config(search_space, rng):
+    """One config from ``search_space``: lists are choices, ("uniform", low, high) and ("log", low, high)
+    are (log-)uniform ranges; anything else, e.g. a fixed mixup_ramp tuple, is used as is."""
+    config = {}
+    for key, space in search_space.items():
+        kind = space[0] if isinstance(space, tuple) and len(space) == 3 else None
+        if isinstance(space, list):
+            config[key] = space[rng.randrange(len(space))]
+        elif kind == "uniform":
+            config[key] = rng.uniform(space[1], space[2])
+        elif kind == "log":
+            config[key] = float(np.exp(rng.uniform(np.log(space[1]), np.log(space[2]))))
+        else:
+            config[key] = space
+    return config
+
+def asha_rungs(min_epochs, max_epochs, reduction_factor=3):
+    """Epoch budgets min_epochs * eta**i, capped by (and always ending at) max_epochs."""
+    rungs = []
+    budget = min_epochs
+    while budget < max_epochs:
+        rungs.append(budget)
+        budget *= reduction_factor
+    return rungs + [max_epochs]
+
+class TrialStore:
+    """ SQLite file with one row per trial and one row per finished (trial, rung); query it directly
+    or through leaderboard() """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS trials (
+                trial_id INTEGER PRIMARY KEY, config TEXT, status TEXT, rung INTEGER, created TEXT);
+            CREATE TABLE IF NOT EXISTS results (
+                trial_id INTEGER, rung INTEGER, epochs INTEGER, ema_acc REAL, best_acc REAL,
+                train_s REAL, finished TEXT, PRIMARY KEY (trial_id, rung));
+        """)
+        self.conn.commit()
+
+    def add_trial(self, config):
+        cur = self.conn.execute("INSERT INTO trials (config, status, rung, created) VALUES (?, 'running', 0, ?)",
+                                (json.dumps(config), datetime.now().isoformat()))
+        self.conn.commit()
+        return cur.lastrowid
+
+    def set_status(self, trial_id, status, rung=None):
+        if rung is None:
+            self.conn.execute("UPDATE trials SET status = ? WHERE trial_id = ?", (status, trial_id))
+        else:
+            self.conn.execute("UPDATE trials SET status = ?, rung = ? WHERE trial_id = ?", (status, rung, trial_id))
+        self.conn.commit()
+
+    def add_result(self, trial_id, rung, epochs, ema_acc, best_acc, train_s):
+        self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (trial_id, rung, epochs, ema_acc, best_acc, train_s, datetime.now().isoformat()))
+        self.conn.commit()
+
+    def config(self, trial_id):
+        return json.loads(self.conn.execute("SELECT config FROM trials WHERE trial_id = ?", (trial_id,)).fetchone()[0])
+
+    def trials(self, status=None):
+        query = "SELECT trial_id, rung FROM trials" + (" WHERE status = ?" if status else "")
+        return self.conn.execute(query, (status,) if status else ()).fetchall()
+
+    def num_trials(self):
+        return self.conn.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+
+    def promotable(self, rung, reduction_factor):
+        """Paused trials at ``rung`` that rank in the top 1/eta of everything finished at that rung."""
+        ranked = self.conn.execute(
+            "SELECT r.trial_id, t.status, t.rung FROM results r JOIN trials t USING (trial_id) "
+            "WHERE r.rung = ? ORDER BY r.ema_acc DESC", (rung,)).fetchall()
+        top = ranked[:len(ranked) // reduction_factor]
+        return [trial_id for trial_id, status, trial_rung in top if status == "paused" and trial_rung == rung]
+
+    def leaderboard(self, top=10):
+        """Every trial at its furthest rung, longest budget and best EMA accuracy first."""
+        return pd.read_sql_query(
+            "SELECT t.trial_id, t.status, r.rung, r.epochs, r.ema_acc, r.best_acc, r.train_s, t.config "
+            "FROM trials t JOIN results r ON r.trial_id = t.trial_id "
+            "AND r.rung = (SELECT MAX(rung) FROM results WHERE trial_id = t.trial_id) "
+            "ORDER BY r.epochs DESC, r.ema_acc DESC LIMIT ?", self.conn, params=(top,))
+
+    def close(self):
+        self.conn.close()
+
+def _init_trial_worker(threads_per_trial):
+    torch.set_num_threads(threads_per_trial)
+
+def _run_trial(trial_dir, config, stop_epoch, eval_every, seed):
+    set_random_seeds(seed)
+    start = time.perf_counter()
+    # In-memory loader: no DataLoader worker processes, so a trial uses only its own threads
+    result = train_model(config=config, stop_epoch=stop_epoch, output_dir=trial_dir, resume=True,
+                         eval_every=eval_every, batch_augment=True)
+    return {**result, "train_s": time.perf_counter() - start}
+
+def run_asha(search_space, num_trials=27, min_epochs=10, max_epochs=200, reduction_factor=3,
+             core_budget=None, threads_per_trial=1, study_dir=None, seed=0):
+    """Asynchronous successive halving over train_model in a process pool.
+
+    Trials start at ``min_epochs``; whenever a worker frees up, a paused trial in the top
+    1/``reduction_factor`` of its rung (by EMA accuracy) is resumed from its checkpoint up to the
+    next rung, otherwise a new config is sampled. Every trial trains under the LR schedule of
+    ``max_epochs``. Trials load data in process (batch_augment, no DataLoader workers), so
+    ``core_budget // threads_per_trial`` pool workers keep CPU use within ``core_budget``.
+    Trial state lives in ``study_dir``/trials.db and per-trial directories, so calling run_asha
+    again on the same ``study_dir`` picks the study up where it stopped. Returns the leaderboard
+    as a DataFrame.
+    """
+    study_dir = study_dir if study_dir else os.path.join(DRIVE_PATH, "asha")
+    os.makedirs(study_dir, exist_ok=True)
+    rungs = asha_rungs(min_epochs, max_epochs, reduction_factor)
+    core_budget = core_budget or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count())
+    max_workers = max(1, core_budget // threads_per_trial)
+    check_spawnable(_run_trial)
+    download_cifar10()
+    store = TrialStore(os.path.join(study_dir, "trials.db"))
+    # Trials interrupted mid-rung are rerun first; they resume from their own checkpoints
+    pending = store.trials(status="running")
+    print(f"ASHA: rungs {rungs} epochs, {max_workers} workers x {threads_per_trial} threads, "
+          f"{store.num_trials()} trials so far ({len(pending)} to resume)")
+
+    def next_job():
+        if pending:
+            return pending.pop(0)
+        for rung in reversed(range(len(rungs) - 1)):
+            promotable = store.promotable(rung, reduction_factor)
+            if promotable:
+                store.set_status(promotable[0], "running", rung + 1)
+                return promotable[0], rung + 1
+        if store.num_trials() < num_trials:
+            trial_id = store.add_trial({**sample_config(search_space, random.Random(seed * 100003 + store.num_trials())),
+                                        "num_epochs": max_epochs})
+            return trial_id, 0
+        return None
+
+    def submit(pool, trial_id, rung):
+        trial_dir = os.path.join(study_dir, f"trial_{trial_id:04d}")
+        os.makedirs(trial_dir, exist_ok=True)
+        return pool.submit(_run_trial, trial_dir, store.config(trial_id), rungs[rung], min_epochs, seed + trial_id)
+
+    running = {}
+    with ProcessPoolExecutor(max_workers, mp_context=mp.get_context("spawn"),
+                             initializer=_init_trial_worker, initargs=(threads_per_trial,)) as pool:
+        while True:
+            while len(running) < max_workers:
+                job = next_job()
+                if job is None:
+                    break
+                running[submit(pool, *job)] = job
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial_id, rung = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Trial {trial_id} failed at rung {rung}: {str(e)}")
+                    store.set_status(trial_id, "failed")
+                    continue
+                store.add_result(trial_id, rung, result["epoch"], result["ema_acc"], result["best_acc"], result["train_s"])
+                store.set_status(trial_id, "complete" if rung == len(rungs) - 1 else "paused")
+                print(f"Trial {trial_id} rung {rung} ({result['epoch']} epochs): EMA acc {result['ema_acc']:.2f}%")
+
+    leaderboard = store.leaderboard()
+    store.close()
+    print(leaderboard.to_string(index=False))
+    return leaderboard
+
+# ENSEMBLE INFERENCE
+class StackedEnsemble:
+    """ Weighted ensemble of same-architecture models evaluated in one vmap call """
+    def __init__(self, models, weights=None):
+        self.num_models = len(models)
+        self.params, self.buffers = stack_module_state(models)
+        # Stateless copy of the architecture; only its structure is used by functional_call
+        self.base = copy.deepcopy(models[0]).to('meta').eval()
+        if weights is None:
+            weights = [1.0 / self.num_models] * self.num_models
+        if len(weights) != self.num_models:
+            raise ValueError(f"Got {len(weights)} weights for {self.num_models} models")
+        device = next(iter(self.params.values())).device
+        self.weights = torch.tensor(weights, dtype=torch.float32, device=device)
+
+    def _call_one(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def forward_all(self, x):
+        """Per-model logits with shape [N, B, num_classes]."""
+        return vmap(self._call_one, in_dims=(0, 0, None))(self.params, self.buffers, x)
+
+    def __call__(self, x):
+        logits = self.forward_all(x)
+        return torch.tensordot(self.weights.to(logits.dtype), logits, dims=1)
+
+    def eval(self):
+        return self
+
+def load_resnet_checkpoint(path, device, name="Model"):
+    """Build ResNet([4, 4, 3]) and load ``path``; returns None if it cannot be loaded."""
+    model = ResNet([4, 4, 3]).to(device)
+    try:
+        model.load_state_dict(torch.load(path, map_location=device, weights_only=True))
+        print(f"{name} loaded successfully from {path} with weights_only=True")
+    except Exception as e1:
+        print(f"Error loading {name} with weights_only=True: {str(e1)}")
+        try:
+            model.load_state_dict(torch.load(path, map_location=device))
+            print(f"{name} loaded successfully from {path} with standard loading")
+        except Exception as e2:
+            print(f"Error loading {name} with standard loading: {str(e2)}")
+            return None
+    return model.eval()
+
+# LOGIT CACHE
+_HASH_CACHE = {}
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Content hash of ``path``, memoized per (path, size, mtime) for the session."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _HASH_CACHE:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        _HASH_CACHE[key] = h.hexdigest()
+    return _HASH_CACHE[key]
+
+def tta_view_key(view):
+    """Stable key for one TTA view; the weight is not part of it since logits are stored unweighted."""
+    params = {k: v for k, v in view.items() if k != "weight"}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+class LogitStore:
+    """ Memory-mapped on-disk cache of raw logits per (checkpoint, TTA view) over one test file """
+    def __init__(self, test_file_path, cache_dir=None, device=None, batch_size=128, backend="fp32"):
+        self.test_file_path = test_file_path
+        self.backend = backend
+        self.cache_dir = cache_dir if cache_dir else os.path.join(DRIVE_PATH, "logit_cache")
+        self.device = device if device else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.batch_size = batch_size
+        self.data_hash = file_sha256(test_file_path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, checkpoint_hash, view):
+        backend = "" if self.backend == "fp32" else f"{self.backend}_"
+        return os.path.join(self.cache_dir,
+                            f"{self.data_hash[:16]}_{checkpoint_hash[:16]}_{backend}{tta_view_key(view)}.npy")
+
+    def get(self, checkpoint_path, views):
+        """Raw logits [V, N, num_classes] for ``views``; only uncached views are computed, in one pass."""
+        checkpoint_hash = file_sha256(checkpoint_path)
+        paths = [self._path(checkpoint_hash, v) for v in views]
+        missing = [(v, p) for v, p in zip(views, paths) if not os.path.exists(p)]
+        if missing:
+            self._compute(checkpoint_path, missing)
+        return np.stack([np.load(p, mmap_mode='r') for p in paths])
+
+    def _compute(self, checkpoint_path, missing):
+        model = load_resnet_checkpoint(checkpoint_path, self.device, name="Model")
+        if model is None:
+            raise RuntimeError(f"Could not load checkpoint {checkpoint_path}")
+        model, device = prepare_backend(model, self.backend)
+        views = [v for v, _ in missing]
+        test_loader = get_competition_test_loader(self.test_file_path, self.batch_size, memmap=True)
+        num_samples = len(test_loader.dataset)
+        print(f"Caching {len(views)} view(s) of logits for {checkpoint_path}...")
+
+        tmp_paths = [p + ".tmp.npy" for _, p in missing]
+        outs = None
+        start = 0
+        with torch.no_grad():
+            for inputs, _ in test_loader:
+                inputs = inputs.to(device)
+                logits = model(build_tta_batch(inputs, views)).view(len(views), inputs.size(0), -1)
+                if outs is None:
+                    outs = [np.lib.format.open_memmap(tp, mode='w+', dtype=np.float32,
+                                                      shape=(num_samples, logits.size(-1))) for tp in tmp_paths]
+                logits = logits.float().cpu().numpy()
+                for out, view_logits in zip(outs, logits):
+                    out[start:start + inputs.size(0)] = view_logits
+                start += inputs.size(0)
+
+        for out in outs:
+            out.flush()
+        outs = None
+        # Publish atomically so an interrupted pass never leaves a partial cache entry behind
+        for tmp_path, (_, path) in zip(tmp_paths, missing):
+            os.replace(tmp_path, path)
+
+def combine_cached_logits(per_model_logits, ensemble_weights, use_tta=True, tta_config=None):
+    """Reduce cached raw logits exactly as tta_predict and the weighted ensemble would."""
+    cfg = tta_config if tta_config is not None else DEFAULT_TTA_CONFIG
+    combined = None
+    for model_logits, weight in zip(per_model_logits, ensemble_weights):
+        if use_tta:
+            view_weights = tta_weights(cfg["views"]).numpy()
+            outputs = np.tensordot(view_weights, model_logits, axes=1) / cfg.get("temperature", 1.0)
+        else:
+            outputs = np.asarray(model_logits[0])
+        combined = weight * outputs if combined is None else combined + weight * outputs
+    return combined
+
+def cached_predictions(logit_store, checkpoint_paths, ensemble_weights, use_tta=True, tta_config=None):
+    """Ensemble/TTA logits for the store's test file computed from cached raw logits."""
+    cfg = tta_config if tta_config is not None else DEFAULT_TTA_CONFIG
+    views = cfg["views"] if use_tta else [{"op": "identity"}]
+    per_model_logits = [logit_store.get(path, views) for path in checkpoint_paths]
+    outputs = combine_cached_logits(per_model_logits, ensemble_weights, use_tta, cfg)
+    ids = [f"{i:05d}" for i in range(len(outputs))]
+    return outputs, ids
+
+# INFERENCE GRAPH OPTIMIZATION
+def fold_conv_bn(conv, bn):
+    """Conv2d followed by eval-mode BatchNorm2d -> a single Conv2d with bias."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    with torch.no_grad():
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused.to(conv.weight.device)
+
+def _conv1x1_to_linear(conv):
+    linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight.view(conv.out_channels, conv.in_channels))
+        if conv.bias is not None:
+            linear.bias.copy_(conv.bias)
+    return linear.to(conv.weight.device)
+
+class FusedSEBlock(nn.Module):
+    """ SE excitation as dense ops on the pooled [B, C] vector """
+    def __init__(self, se_block):
+        super().__init__()
+        self.fc1 = _conv1x1_to_linear(se_block.se[1])
+        self.fc2 = _conv1x1_to_linear(se_block.se[3])
+
+    def forward(self, x):
+        s = torch.sigmoid(self.fc2(F.silu(self.fc1(x.mean((2, 3))))))
+        return x * s[:, :, None, None]
+
+class FusedBasicBlock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.conv1 = fold_conv_bn(block.conv1, block.bn1)
+        self.se = FusedSEBlock(block.se) if block.se else None
+        self.conv2 = fold_conv_bn(block.conv2, block.bn2)
+        self.shortcut = fold_conv_bn(block.shortcut[0], block.shortcut[1]) if len(block.shortcut) else None
+
+    def forward(self, x):
+        out = F.silu(self.conv1(x))
+        if self.se: out = self.se(out)
+        out = self.conv2(out)
+        out = out + (self.shortcut(x) if self.shortcut is not None else x)
+        return F.silu(out)
+
+class FusedResNet(nn.Module):
+    """ Inference-only ResNet with BatchNorm folded into every convolution """
+    def __init__(self, model):
+        super().__init__()
+        self.conv1 = fold_conv_bn(model.conv1, model.bn1)
+        self.layer1 = nn.Sequential(*[FusedBasicBlock(b) for b in model.layer1])
+        self.layer2 = nn.Sequential(*[FusedBasicBlock(b) for b in model.layer2])
+        self.layer3 = nn.Sequential(*[FusedBasicBlock(b) for b in model.layer3])
+        self.linear = copy.deepcopy(model.linear)
+
+    def forward(self, x):
+        out = F.silu(self.conv1(x))
+        out = self.layer3(self.layer2(self.layer1(out)))
+        return self.linear(out.mean((2, 3)))
+
+def optimize_for_inference(model, check_input=None, rtol=1e-4, atol=1e-4):
+    """Fold BN and simplify SE for a trained ResNet (regular or EMA weights).
+
+    The result is checked against the original on ``check_input`` (random by default) and an
+    AssertionError is raised if outputs differ beyond ``atol + rtol * max|logit|``.
+    """
+    model.eval()
+    fused = FusedResNet(model).eval()
+    device = next(model.parameters()).device
+    if check_input is None:
+        check_input = torch.randn(8, 3, 32, 32, device=device)
+    with torch.no_grad():
+        reference = model(check_input)
+        max_diff = (fused(check_input) - reference).abs().max().item()
+    tolerance = atol + rtol * reference.abs().max().item()
+    assert max_diff <= tolerance, f"Fused model deviates by {max_diff:.3e} (tolerance {tolerance:.3e})"
+    print(f"Inference graph optimized: max |logit diff| {max_diff:.3e} (tolerance {tolerance:.3e})")
+    return fused
+
+# INT8 QUANTIZATION
+INFERENCE_BACKENDS = ("fp32", "fused", "int8")
+
+def get_calibration_loader(num_samples=1024, batch_size=128, seed=0):
+    """Un-augmented random subset of the CIFAR-10 training set for observer calibration."""
+    train_set = InMemoryCIFAR10(train=True)
+    generator = torch.Generator().manual_seed(seed)
+    idx = torch.randperm(len(train_set), generator=generator)[:num_samples]
+    loader = FastLoader(train_set.images[idx], train_set.targets[idx], batch_size)
+    return AugmentedLoader(loader, BatchAugment(train=False), torch.device('cpu'))
+
+def quantize_model(model, calib_loader, num_batches=None, engine='x86'):
+    """Static INT8 post-training quantization in FX graph mode.
+
+    FX handles SEBlock's ``x * self.se(x)`` and the residual ``out += self.shortcut(x)`` as
+    quantized mul/add; SiLU stays in float between dequantize/quantize pairs.
+    """
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = (next(iter(calib_loader))[0][:1].cpu(),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+    with torch.no_grad():
+        for i, (inputs, _) in enumerate(calib_loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            prepared(inputs.cpu())
+    return convert_fx(prepared)
+
+def prepare_backend(model, backend="fp32", calib_loader=None):
+    """Return ``model`` converted for an inference backend and the device it must run on."""
+    assert backend in INFERENCE_BACKENDS, f"Unknown backend {backend}, expected one of {INFERENCE_BACKENDS}"
+    device = next(model.parameters()).device
+    if backend == "fused":
+        return optimize_for_inference(model), device
+    if backend == "int8":
+        calib_loader = calib_loader if calib_loader is not None else get_calibration_loader()
+        return quantize_model(model, calib_loader), torch.device('cpu')
+    return model.eval(), device
+
+class SequentialEnsemble:
+    """ Weighted ensemble evaluated member by member, for modules vmap cannot batch (e.g. INT8) """
+    def __init__(self, models, weights):
+        if len(weights) != len(models):
+            raise ValueError(f"Got {len(weights)} weights for {len(models)} models")
+        self.models = models
+        self.weights = weights
+
+    def __call__(self, x):
+        return sum(w * m(x) for w, m in zip(self.weights, self.models))
+
+    def eval(self):
+        return self
+
+def measure_throughput(model, device, batch_size=128, num_batches=10, warmup=2):
+    """Images/sec of ``model`` on random CIFAR-sized batches."""
+    x = torch.randn(batch_size, 3, 32, 32, device=device)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            model(x)
+    return batch_size * num_batches / (time.perf_counter() - start)
+
+def quantization_report(model, test_loader=None, calib_samples=1024, use_tta=False):
+    """Accuracy delta and CPU throughput of INT8 vs FP32 on the labeled CIFAR-10 test set."""
+    cpu = torch.device('cpu')
+    fp32_model = copy.deepcopy(model).cpu().eval()
+    int8_model = quantize_model(fp32_model, get_calibration_loader(calib_samples))
+    if test_loader is None:
+        _, test_loader = get_cifar10_loaders(batch_augment=True, device=cpu)
+
+    report = {}
+    for name, m in [("fp32", fp32_model), ("int8", int8_model)]:
+        report[name] = {"accuracy": evaluate(m, test_loader, cpu, use_tta=use_tta),
+                        "images_per_sec": measure_throughput(m, cpu)}
+    report["accuracy_delta"] = report["int8"]["accuracy"] - report["fp32"]["accuracy"]
+    report["speedup"] = report["int8"]["images_per_sec"] / report["fp32"]["images_per_sec"]
+    print(f"FP32: {report['fp32']['accuracy']:.2f}% @ {report['fp32']['images_per_sec']:.0f} img/s | "
+          f"INT8: {report['int8']['accuracy']:.2f}% @ {report['int8']['images_per_sec']:.0f} img/s | "
+          f"delta {report['accuracy_delta']:+.2f}% | speedup {report['speedup']:.2f}x")
+    return report
+
+# COMPILED EXECUTION
+class CompiledModel(nn.Module):
+    """ channels_last + torch.compile wrapper around a model
+
+    In eval mode a batch smaller than a warmed-up size is zero-padded to that size and the
+    output sliced back, so the last partial batch reuses an existing graph instead of recompiling.
+    """
+    def __init__(self, model, forward_fn, batch_sizes=(), channels_last=True):
+        super().__init__()
+        self.model = model
+        self.forward_fn = forward_fn
+        self.batch_sizes = sorted(batch_sizes)
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        n = x.size(0)
+        if not self.training and n not in self.batch_sizes:
+            target = next((b for b in self.batch_sizes if b > n), None)
+            if target is not None:
+                x = torch.cat([x, x.new_zeros((target - n,) + tuple(x.shape[1:]))])
+                return self.forward_fn(x)[:n]
+        return self.forward_fn(x)
+
+def _time_steps(fn, num_steps=3):
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+def compile_model(model, batch_sizes=(128,), training=False, channels_last=True, mode=None, input_shape=(3, 32, 32)):
+    """Wrap ``model`` for compiled channels_last execution.
+
+    Every size in ``batch_sizes`` is compiled up front (train and eval graphs when ``training``),
+    with BN statistics and gradients restored afterwards. Falls back to eager on any failure.
+    Returns the wrapper and a report with compile time and eager vs compiled step times.
+    """
+    device = next(model.parameters()).device
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    was_training = model.training
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    report = {"compiled": False, "compile_s": 0.0}
+
+    def step(fn, x, train):
+        model.train(train)
+        if train:
+            with torch.autocast(device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+                out = fn(x)
+            out.float().sum().backward()
+        else:
+            with torch.no_grad():
+                fn(x)
+
+    modes = [True, False] if training else [False]
+    x = torch.randn((max(batch_sizes),) + tuple(input_shape), device=device).contiguous(memory_format=memory_format)
+    report["eager_step_s"] = _time_steps(lambda: step(model, x, training))
+    try:
+        compiled = torch.compile(model, mode=mode, dynamic=False)
+        start = time.perf_counter()
+        for train in modes:
+            for bs in batch_sizes:
+                step(compiled, torch.randn((bs,) + tuple(input_shape), device=device)
+                     .contiguous(memory_format=memory_format), train)
+        report["compile_s"] = time.perf_counter() - start
+        report["compiled_step_s"] = _time_steps(lambda: step(compiled, x, training))
+        report["compiled"] = True
+        forward_fn = compiled
+    except Exception as e:
+        print(f"torch.compile failed, falling back to eager: {str(e)}")
+        forward_fn = model
+    finally:
+        model.load_state_dict(state)
+        model.zero_grad(set_to_none=True)
+        model.train(was_training)
+
+    if report["compiled"]:
+        print(f"Compiled for batch sizes {sorted(batch_sizes)} in {report['compile_s']:.1f}s; "
+              f"step {report['eager_step_s'] * 1e3:.1f}ms eager -> {report['compiled_step_s'] * 1e3:.1f}ms compiled "
+              f"({report['eager_step_s'] / report['compiled_step_s']:.2f}x)")
+    wrapper = CompiledModel(model, forward_fn, batch_sizes, channels_last)
+    wrapper.train(was_training)
+    return wrapper, report
+
+def loader_batch_sizes(loader, views=1):
+    """Full and trailing partial batch sizes of a loader, scaled by the number of TTA views."""
+    inner = getattr(loader, 'loader', loader)
+    num_samples = len(inner.dataset) if hasattr(inner, 'dataset') else len(inner.targets)
+    batch_size = inner.batch_size
+    sizes = {batch_size * views}
+    if num_samples % batch_size:
+        sizes.add((num_samples % batch_size) * views)
+    return tuple(sorted(sizes))
+
+# AOT INFERENCE ARTIFACT
+# An artifact directory holds the program (model.ts from TorchScript or program.pt2 from torch.export),
+# whose graph takes the weights as an input, weights.pt with those weights, manifest.json and
+# loader.py, a copy of load_inference_artifact that only needs torch.
+ARTIFACT_FORMATS = ("export", "torchscript")
+
+class InferenceGraph(nn.Module):
+    """ Normalize + TTA views + weighted ensemble as one module from uint8 [N, 3, 32, 32] images to logits
+
+    Matches ImagePredictor before the softmax: tta_predict over a StackedEnsemble when ``use_tta``,
+    otherwise the weighted sum of member logits.
+    """
+    def __init__(self, models, weights, use_tta=True, tta_config=None, mean=CIFAR10_MEAN, std=CIFAR10_STD):
+        super().__init__()
+        cfg = tta_config if tta_config is not None else DEFAULT_TTA_CONFIG
+        self.members = nn.ModuleList(models)
+        self.views = cfg["views"] if use_tta else [{"op": "identity", "weight": 1.0}]
+        self.temperature = float(cfg.get("temperature", 1.0)) if use_tta else 1.0
+        std = torch.tensor(std)
+        self.register_buffer("scale", (1.0 / (255.0 * std)).view(1, -1, 1, 1))
+        self.register_buffer("shift", (torch.tensor(mean) / std).view(1, -1, 1, 1))
+        self.register_buffer("member_weights", torch.tensor(weights, dtype=torch.float32))
+        self.register_buffer("view_weights", tta_weights(self.views))
+
+    def forward(self, images):
+        x = torch.addcmul(-self.shift, images.float(), self.scale)
+        batch = build_tta_batch(x, self.views)
+        logits = sum(self.member_weights[i] * m(batch) for i, m in enumerate(self.members))
+        logits = logits.view(len(self.views), images.size(0), -1) / self.temperature
+        return torch.tensordot(self.view_weights, logits, dims=1)
+
+class _StatelessGraph(nn.Module):
+    """ forward(state, images) with ``state`` swapped in for the graph's tensors, keeping weights out of the program
+
+    functional_call refuses to run under torch.jit.trace, so the swap is done directly on the
+    submodules' parameter and buffer dicts.
+    """
+    def __init__(self, graph):
+        super().__init__()
+        self._graph = [graph]  # a plain list hides it from parameters(), nothing gets lifted as a constant
+
+    def forward(self, state, images):
+        graph, saved = self._graph[0], []
+        for name, tensor in state.items():
+            module_name, _, leaf = name.rpartition('.')
+            module = graph.get_submodule(module_name)
+            store = module._parameters if leaf in module._parameters else module._buffers
+            saved.append((store, leaf, store[leaf]))
+            store[leaf] = tensor
+        try:
+            return graph(images)
+        finally:
+            for store, leaf, tensor in saved:
+                store[leaf] = tensor
+
+def load_inference_artifact(artifact_dir):
+    """Callable mapping uint8 [N, 3, 32, 32] images to logits, from an export_inference_artifact directory.
+
+    Needs only torch and the standard library. weights.pt is memory-mapped, so loading does not
+    copy the weights and concurrent processes share their pages.
+    """
+    with open(os.path.join(artifact_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    program_path = os.path.join(artifact_dir, manifest["program"])
+    if manifest["format"] == "torchscript":
+        program = torch.jit.load(program_path, map_location="cpu")
+    else:
+        program = torch.export.load(program_path).module()
+    weights = torch.load(os.path.join(artifact_dir, manifest["weights"]), mmap=True, weights_only=True)
+
+    def predict(images):
+        with torch.inference_mode():
+            return program(weights, images)
+    predict.manifest = manifest
+    return predict
+
+_ARTIFACT_LOADER_MAIN = '''
+if __name__ == "__main__":
+    # Cold start of a fresh process: torch import, artifact load and the first prediction
+    predict = load_inference_artifact(os.path.dirname(os.path.abspath(__file__)))
+    loaded = time.perf_counter()
+    logits = predict(torch.zeros(1, 3, 32, 32, dtype=torch.uint8))
+    print(json.dumps({"import_s": _IMPORTED - _START, "load_s": loaded - _IMPORTED,
+                      "first_predict_s": time.perf_counter() - loaded, "cold_start_s": time.perf_counter() - _START,
+                      "num_classes": logits.shape[1]}))
+'''
+
+def write_artifact_loader(path):
+    """Standalone loader.py: the source of load_inference_artifact plus a cold-start timing entry point."""
+    header = ("import time\n_START = time.perf_counter()\nimport json\nimport os\n\nimport torch\n"
+              "_IMPORTED = time.perf_counter()\n\n\n")
+    with open(path, 'w') as f:
+        f.write(header + inspect.getsource(load_inference_artifact) + _ARTIFACT_LOADER_MAIN)
+
+def export_inference_artifact(output_dir, checkpoint_paths=None, ensemble_weights=None, use_tta=True, tta_config=None,
+                              fuse=True, artifact_format="torchscript", max_batch=4096, rtol=1e-4, atol=1e-4):
+    """Export ResNet([4, 4, 3]) checkpoints with their ensemble weights and TTA reduction to ``output_dir``.
+
+    ``artifact_format`` is one of ARTIFACT_FORMATS. TorchScript is the default since torch.export.load
+    pays for graph deserialization and a torch._dynamo import, which makes its cold start several times
+    slower (see bench_artifact); ``max_batch`` bounds the batch dimension of a torch.export program.
+    Members are BN-folded with optimize_for_inference when ``fuse``. The reloaded artifact is checked
+    against the eager InferenceGraph on a batch size other than the export example and an
+    AssertionError is raised beyond ``atol + rtol * max|logit|``. Returns the manifest.
+    """
+    assert artifact_format in ARTIFACT_FORMATS, f"Unknown format {artifact_format}, expected one of {ARTIFACT_FORMATS}"
+    cpu = torch.device('cpu')
+    if checkpoint_paths is None:
+        checkpoint_paths = [p for p in (os.path.join(DRIVE_PATH, "best_model.pth"),
+                                        os.path.join(DRIVE_PATH, "best_ema_model.pth")) if os.path.exists(p)]
+    if ensemble_weights is None:
+        ensemble_weights = [0.4, 0.6] if len(checkpoint_paths) == 2 else [1.0 / len(checkpoint_paths)] * len(checkpoint_paths)
+    models = [load_resnet_checkpoint(p, cpu, name=os.path.basename(p)) for p in checkpoint_paths]
+    if not models or any(m is None for m in models):
+        raise RuntimeError(f"Could not load checkpoints {checkpoint_paths}")
+    if fuse:
+        models = [optimize_for_inference(m) for m in models]
+    graph = InferenceGraph(models, list(ensemble_weights), use_tta, tta_config).eval()
+    for p in graph.parameters():
+        p.requires_grad_(False)
+
+    os.makedirs(output_dir, exist_ok=True)
+    example = torch.randint(0, 256, (8, 3, 32, 32), dtype=torch.uint8)
+    manifest = {"format": artifact_format, "checkpoints": [os.path.basename(p) for p in checkpoint_paths],
+                "checkpoint_sha256": [file_sha256(p) for p in checkpoint_paths],
+                "ensemble_weights": list(ensemble_weights), "tta": use_tta, "views": graph.views,
+                "temperature": graph.temperature, "fused": fuse, "max_batch": max_batch,
+                "input": {"dtype": "uint8", "shape": [None, 3, 32, 32]}, "output": "logits",
+                "torch": torch.__version__, "created": datetime.now().isoformat()}
+    state = dict(graph.state_dict())
+    start = time.perf_counter()
+    if artifact_format == "export":
+        batch = torch.export.Dim("batch", min=1, max=max_batch)
+        program = torch.export.export(_StatelessGraph(graph), (state, example),
+                                      dynamic_shapes=({k: None for k in state}, {0: batch}))
+        program.example_inputs = None  # would otherwise serialize a copy of the weights into the program
+        manifest.update(program="program.pt2", weights="weights.pt")
+        torch.export.save(program, os.path.join(output_dir, manifest["program"]))
+    else:
+        with torch.no_grad():
+            program = torch.jit.trace(_StatelessGraph(graph), (state, example))
+        manifest.update(program="model.ts", weights="weights.pt")
+        torch.jit.save(program, os.path.join(output_dir, manifest["program"]))
+    atomic_torch_save(state, os.path.join(output_dir, manifest["weights"]))
+    manifest["export_s"] = time.perf_counter() - start
+    write_artifact_loader(os.path.join(output_dir, "loader.py"))
+    # The manifest goes last: a directory without one is an incomplete export
+    with open(os.path.join(output_dir, "manifest.json.tmp"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(output_dir, "manifest.json.tmp"), os.path.join(output_dir, "manifest.json"))
+
+    check_input = torch.randint(0, 256, (3, 3, 32, 32), dtype=torch.uint8)
+    with torch.no_grad():
+        reference = graph(check_input)
+    max_diff = (load_inference_artifact(output_dir)(check_input) - reference).abs().max().item()
+    tolerance = atol + rtol * reference.abs().max().item()
+    assert max_diff <= tolerance, f"Exported artifact deviates by {max_diff:.3e} (tolerance {tolerance:.3e})"
+    size_mb = sum(os.path.getsize(os.path.join(output_dir, n)) for n in os.listdir(output_dir)) / 2**20
+    print(f"Exported {len(models)}-model {'TTA ' if use_tta else ''}artifact ({artifact_format}, {size_mb:.1f} MB) to "
+          f"{output_dir} in {manifest['export_s']:.1f}s; max |logit diff| {max_diff:.3e}")
+    return manifest
 
 # EVALUATION AND SUBMISSION
-def evaluate(model, loader, device, use_tta=False):
+def evaluate(model, loader, device, use_tta=False, backend="fp32", compiled=False, tta_config=None):
+    """Top-1 accuracy (%) on a labeled ``loader``; with ``use_tta`` through tta_predict with ``tta_config``
+    (default DEFAULT_TTA_CONFIG), so an adaptive config is scored adaptively."""
+    cfg = tta_config if tta_config is not None else DEFAULT_TTA_CONFIG
+    if backend != "fp32":
+        model, device = prepare_backend(model, backend)
+    if compiled and not isinstance(model, CompiledModel):
+        views = len(cfg["views"])
+        if not use_tta:
+            batch_sizes = loader_batch_sizes(loader)
+        elif "adaptive" in cfg:
+            # Plain forward, then the other views for the escalated samples (padded up to a whole batch)
+            extra = views - (_plain_view_index(cfg["views"]) is not None)
+            batch_sizes = tuple(sorted(set(loader_batch_sizes(loader)) | set(loader_batch_sizes(loader, extra))))
+        else:
+            batch_sizes = loader_batch_sizes(loader, views)
+        model, _ = compile_model(model.eval(), batch_sizes)
     model.eval()
     correct, total = 0, 0
     with torch.no_grad():
@@ -533,7 +2441,7 @@ def evaluate(model, loader, device, use_tta=False):
             inputs, targets = inputs.to(device), targets.to(device)
 
             if use_tta:
-                outputs = tta_predict(model, inputs)
+                outputs = tta_predict(model, inputs, tta_config=cfg)
             else:
                 outputs = model(inputs)
 
@@ -541,7 +2449,126 @@ def evaluate(model, loader, device, use_tta=False):
             total += targets.size(0)
     return 100. * correct / total if total > 0 else 0.0
 
-def create_submission(test_file_path="cifar_test_nolabel.pkl", use_tta=True, use_ensemble=True, ensemble_weights=None):
+def adaptive_tta_report(model, test_loader=None, thresholds=None, criterion="margin",
+                        tta_config=None, timing_threshold=None, timing_batches=10, device=None):
+    """Accuracy vs compute of adaptive TTA across ``thresholds`` on the labeled CIFAR-10 test set.
+
+    Thresholds are on the ``criterion``'s scale and default to ESCALATION_SWEEPS[criterion] and
+    ESCALATION_THRESHOLDS[criterion]. Every view's logits are computed once and each threshold is
+    scored on them offline; compute is counted as forwards per image (the plain one plus the extra
+    views of escalated samples). Images/sec of plain, full and adaptive TTA at ``timing_threshold``
+    are measured on the first ``timing_batches`` batches. Returns a DataFrame with the plain, full
+    and per-threshold rows.
+    """
+    device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    cfg = {k: v for k, v in (tta_config or DEFAULT_TTA_CONFIG).items() if k != "adaptive"}
+    views, temperature = cfg["views"], cfg.get("temperature", 1.0)
+    plain_view = _plain_view_index(views)
+    assert plain_view is not None, "Adaptive TTA needs an identity view to reuse as the plain forward"
+    _check_criterion(criterion)
+    thresholds = ESCALATION_SWEEPS[criterion] if thresholds is None else thresholds
+    timing_threshold = ESCALATION_THRESHOLDS[criterion] if timing_threshold is None else timing_threshold
+    thresholds = sorted(set(thresholds) | {timing_threshold})
+    if test_loader is None:
+        _, test_loader = get_cifar10_loaders(batch_augment=True, device=device)
+
+    model.eval()
+    view_logits, targets, timing_inputs = [], [], []
+    with torch.no_grad():
+        for inputs, batch_targets in test_loader:
+            inputs = inputs.to(device)
+            view_logits.append(model(build_tta_batch(inputs, views)).view(len(views), inputs.size(0), -1).float().cpu())
+            targets.append(batch_targets.cpu())
+            if len(timing_inputs) < timing_batches:
+                timing_inputs.append(inputs)
+    view_logits, targets = torch.cat(view_logits, dim=1), torch.cat(targets)
+    plain = view_logits[plain_view] / temperature
+    full = torch.tensordot(tta_weights(views), view_logits, dims=1) / temperature
+
+    def accuracy(logits):
+        return 100. * logits.argmax(1).eq(targets).float().mean().item()
+
+    def images_per_sec(fn):
+        with torch.no_grad():
+            fn(timing_inputs[0])
+            start = time.perf_counter()
+            for x in timing_inputs:
+                fn(x)
+        return sum(x.size(0) for x in timing_inputs) / (time.perf_counter() - start)
+
+    rows = [{"mode": "plain", "threshold": None, "escalated": 0.0, "forwards_per_image": 1.0, "accuracy": accuracy(plain),
+             "images_per_sec": images_per_sec(model)},
+            {"mode": "full", "threshold": None, "escalated": 1.0, "forwards_per_image": float(len(views)),
+             "accuracy": accuracy(full), "images_per_sec": images_per_sec(lambda x: tta_predict(model, x, tta_config=cfg))}]
+    for threshold in thresholds:
+        escalated = escalation_mask(plain, criterion, threshold)
+        fraction = escalated.float().mean().item()
+        row = {"mode": "adaptive", "threshold": threshold, "escalated": fraction,
+               "forwards_per_image": 1 + fraction * (len(views) - 1),
+               "accuracy": accuracy(torch.where(escalated[:, None], full, plain)), "images_per_sec": None}
+        if threshold == timing_threshold:
+            adaptive_cfg = dict(cfg, adaptive={"criterion": criterion, "threshold": threshold})
+            row["images_per_sec"] = images_per_sec(lambda x: tta_predict(model, x, tta_config=adaptive_cfg))
+        rows.append(row)
+
+    report = pd.DataFrame(rows)
+    tta_gain = rows[1]["accuracy"] - rows[0]["accuracy"]
+    report["relative_cost"] = report["forwards_per_image"] / len(views)
+    report["gain_kept"] = (report["accuracy"] - rows[0]["accuracy"]) / tta_gain if tta_gain else float("nan")
+    print(f"Adaptive TTA ({criterion}) on {len(targets)} images: plain {rows[0]['accuracy']:.2f}%, "
+          f"full TTA {rows[1]['accuracy']:.2f}% ({len(views)} forwards/image)")
+    print(report.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+    return report
+
+def cache_eval_set(loader, device):
+    """Materialize a labeled loader once as pre-normalized (images, targets) tensors on ``device``."""
+    images, targets = [], []
+    for inputs, batch_targets in loader:
+        images.append(inputs.to(device))
+        targets.append(batch_targets.to(device))
+    return torch.cat(images), torch.cat(targets)
+
+def stratified_indices(targets, per_class, seed=0):
+    """Fixed random subset with ``per_class`` samples of every class."""
+    generator = torch.Generator().manual_seed(seed)
+    targets = targets.cpu()
+    picks = []
+    for c in targets.unique():
+        idx = (targets == c).nonzero().flatten()
+        picks.append(idx[torch.randperm(len(idx), generator=generator)[:per_class]])
+    return torch.cat(picks).sort().values
+
+def evaluate_with_ema(model, ema_model, images, targets, batch_size=500, indices=None):
+    """Accuracy of the live and the EMA weights in one pass over a cached eval tensor.
+
+    EMA weights are swapped in by pointer for the second forward of every batch.
+    Returns (live_acc, ema_acc).
+    """
+    if indices is not None:
+        indices = indices.to(images.device)
+        images, targets = images[indices], targets[indices]
+    model.eval()
+    correct = torch.zeros(2, device=images.device)
+    with torch.no_grad():
+        for start in range(0, len(targets), batch_size):
+            x, y = images[start:start + batch_size], targets[start:start + batch_size]
+            correct[0] += model(x).argmax(1).eq(y).sum()
+            ema_model.apply()
+            correct[1] += model(x).argmax(1).eq(y).sum()
+            ema_model.restore()
+    live_correct, ema_correct = correct.tolist()
+    return 100. * live_correct / len(targets), 100. * ema_correct / len(targets)
+
+def create_submission(test_file_path="cifar_test_nolabel.pkl", use_tta=True, use_ensemble=True, ensemble_weights=None,
+                      snapshot_paths=None, logit_store=None, backend="fp32", compiled=False):
+    """Write submission.csv; ``snapshot_paths`` adds further ResNet([4, 4, 3]) checkpoints to the ensemble.
+
+    With a ``logit_store`` predictions are reduced from cached per-view logits, so inference only
+    runs for (checkpoint, view) pairs the store has not seen yet. ``backend`` is one of
+    INFERENCE_BACKENDS; "int8" runs on CPU. ``compiled`` runs each member through compile_model.
+    ``ensemble_weights`` needs one weight per member (regular, EMA, then snapshots), else ValueError.
+    A snapshot or EMA checkpoint that fails to load is left out and the other weights renormalized.
+    """
     # Define paths for model and submission
     model_path = os.path.join(DRIVE_PATH, "best_model.pth")
     ema_model_path = os.path.join(DRIVE_PATH, "best_ema_model.pth")
@@ -549,92 +2576,100 @@ def create_submission(test_file_path="cifar_test_nolabel.pkl", use_tta=True, use
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # Load models
-    model = ResNet([4, 4, 3]).to(device)
-    ema_model = None
-
-    if use_ensemble and os.path.exists(ema_model_path):
-        ema_model = ResNet([4, 4, 3]).to(device)
-        try:
-            ema_model.load_state_dict(torch.load(ema_model_path, map_location=device, weights_only=True))
-            print(f"EMA model loaded successfully from {ema_model_path} with weights_only=True")
-        except Exception as e1:
-            print(f"Error loading EMA model with weights_only=True: {str(e1)}")
-            try:
-                ema_model.load_state_dict(torch.load(ema_model_path, map_location=device))
-                print(f"EMA model loaded successfully from {ema_model_path} with standard loading")
-            except Exception as e2:
-                print(f"Error loading EMA model with standard loading: {str(e2)}")
-                ema_model = None
+    if not os.path.exists(model_path):
+        print(f"Model checkpoint not found at {model_path}")
+        return
 
-    try:
-        model.load_state_dict(torch.load(model_path, map_location=device, weights_only=True))
-        print(f"Model loaded successfully from {model_path} with weights_only=True")
-    except Exception as e1:
-        print(f"Error loading model with weights_only=True: {str(e1)}")
-        try:
-            model.load_state_dict(torch.load(model_path, map_location=device))
-            print(f"Model loaded successfully from {model_path} with standard loading")
-        except Exception as e2:
-            print(f"Error loading model with standard loading: {str(e2)}")
-            return
-
-    model.eval()
-    if ema_model:
-        ema_model.eval()
+    has_ema = use_ensemble and os.path.exists(ema_model_path)
+    checkpoint_paths = [model_path]
+    if use_ensemble:
+        checkpoint_paths += ([ema_model_path] if has_ema else []) + list(snapshot_paths or [])
 
     # default ensemble weights if not provided
     if ensemble_weights is None:
-        if ema_model:
+        if has_ema and len(checkpoint_paths) == 2:
             ensemble_weights = [0.4, 0.6]  # We give slightly more weight to EMA model
         else:
-            ensemble_weights = [1.0]
-
-    # competition test loader
-    test_loader = get_competition_test_loader(test_file_path)
+            ensemble_weights = [1.0 / len(checkpoint_paths)] * len(checkpoint_paths)
+    elif len(checkpoint_paths) == 1:
+        ensemble_weights = [1.0]  # no EMA checkpoint or ensemble: the regular model alone, whatever the weights
+    if len(ensemble_weights) != len(checkpoint_paths):
+        raise ValueError(f"Got {len(ensemble_weights)} ensemble weights for {len(checkpoint_paths)} checkpoints "
+                         f"({', '.join(os.path.basename(p) for p in checkpoint_paths)})")
+    ensemble_weights = list(ensemble_weights)
 
     #  predictions
     inference_type = "TTA" if use_tta else "standard inference"
-    ensemble_type = "ensemble" if use_ensemble and ema_model else "single model"
+    ensemble_type = f"ensemble of {len(checkpoint_paths)}" if len(checkpoint_paths) > 1 else "single model"
     print(f"Generating predictions with {inference_type} and {ensemble_type}...")
 
-    if use_ensemble and ema_model:
+    if has_ema:
         print(f"Using ensemble weights: Regular model: {ensemble_weights[0]}, EMA model: {ensemble_weights[1]}")
 
-    predictions = []
-    ids = []
+    if logit_store is not None:
+        assert logit_store.backend == backend, f"Logit store holds {logit_store.backend} logits, not {backend}"
+        outputs, ids = cached_predictions(logit_store, checkpoint_paths, ensemble_weights, use_tta)
+        predictions = outputs.argmax(1).tolist()
+    else:
+        # Load models
+        models, weights = [], []
+        for path, weight in zip(checkpoint_paths, ensemble_weights):
+            name = "EMA model" if path == ema_model_path else "Model" if path == model_path else "Snapshot"
+            member = load_resnet_checkpoint(path, device, name=name)
+            if member is None:
+                if path == model_path:
+                    return
+                print(f"Warning: leaving {os.path.basename(path)} out of the ensemble; "
+                      f"the remaining weights are renormalized")
+                continue
+            models.append(member)
+            weights.append(weight)
+        # Members that failed to load must not shrink the ensemble's total weight
+        weights = [w * sum(ensemble_weights) / sum(weights) for w in weights]
+
+        if backend != "fp32":
+            calib_loader = get_calibration_loader() if backend == "int8" else None
+            converted = [prepare_backend(m, backend, calib_loader) for m in models]
+            models, device = [m for m, _ in converted], converted[0][1]
+
+        # competition test loader
+        test_loader = get_competition_test_loader(test_file_path, memmap=True)
+
+        if compiled and backend != "int8":
+            views = len(DEFAULT_TTA_CONFIG["views"]) if use_tta else 1
+            models = [compile_model(m, loader_batch_sizes(test_loader, views))[0] for m in models]
+
+        if len(models) == 1:
+            predictor = models[0]
+        elif backend == "int8" or compiled:
+            predictor = SequentialEnsemble(models, weights)
+        else:
+            # All ensemble members run as one fused vmap forward with the weighted reduction applied inside
+            predictor = StackedEnsemble(models, weights)
 
-    with torch.no_grad():
-        for inputs, batch_ids in test_loader:
-            inputs = inputs.to(device)
+        predictions = []
+        ids = []
 
-            if use_tta:
-                # predictions with TTA
-                outputs = tta_predict(model, inputs)
-                if ema_model and use_ensemble:
-                    ema_outputs = tta_predict(ema_model, inputs)
-                    # Weighted ensemble
-                    outputs = outputs * ensemble_weights[0] + ema_outputs * ensemble_weights[1]
-            else:
-                # Standard inference
-                outputs = model(inputs)
-                if ema_model and use_ensemble:
-                    ema_outputs = ema_model(inputs)
-                    # Weighted ensemble
-                    outputs = outputs * ensemble_weights[0] + ema_outputs * ensemble_weights[1]
+        with torch.no_grad():
+            for inputs, batch_ids in test_loader:
+                inputs = inputs.to(device)
 
-            # softmax to get probabilities
-            probs = F.softmax(outputs, dim=1)
+                if use_tta:
+                    # predictions with TTA
+                    outputs = tta_predict(predictor, inputs)
+                else:
+                    # Standard inference
+                    outputs = predictor(inputs)
 
-            # argmax for final class prediction
-            pred_labels = probs.argmax(1).tolist()
-            predictions.extend(pred_labels)
-            ids.extend(batch_ids)
+                # argmax for final class prediction
+                pred_labels = outputs.argmax(1).tolist()
+                predictions.extend(pred_labels)
+                ids.extend(batch_ids)
 
     # Submission DataFrame with correct column names
     submission = pd.DataFrame({
-        "ID": ids,
-        "Labels": predictions
+        "ID": ids,  # Correct case as per competition requirements
+        "Labels": predictions  # Correct case as per competition requirements
     })
 
     # validation checks
@@ -648,53 +2683,1128 @@ def create_submission(test_file_path="cifar_test_nolabel.pkl", use_tta=True, use
     print(f"Sample of submission file:")
     print(submission.head())
 
+# SUBMISSION COMPARISON
+def _as_labeled_frame(source):
+    """Submission path, DataFrame, label vector or logit array -> DataFrame with ID/Labels."""
+    if isinstance(source, (str, Path)):
+        return pd.read_csv(source)
+    if isinstance(source, pd.DataFrame):
+        return source
+    arr = np.asarray(source)
+    labels = arr.argmax(1) if arr.ndim == 2 else arr
+    # Arrays follow the competition test file order, so the row index is the ID
+    return pd.DataFrame({"ID": np.arange(len(labels)), "Labels": labels})
+
+def align_predictions(sources):
+    """Align named prediction sources by ID once.
+
+    Returns the names, the IDs common to every source and an [M, N] int label matrix.
+    """
+    names = list(sources.keys())
+    frames = [_as_labeled_frame(sources[name]) for name in names]
+    ids = pd.Index(frames[0]["ID"])
+    for df in frames[1:]:
+        ids = ids.intersection(pd.Index(df["ID"]), sort=False)
+    labels = np.empty((len(frames), len(ids)), dtype=np.int64)
+    for m, df in enumerate(frames):
+        labels[m] = df["Labels"].to_numpy()[pd.Index(df["ID"]).get_indexer(ids)]
+    return names, ids.to_numpy(), labels
+
+def compare_predictions(labels, num_classes=10):
+    """Agreement statistics for an [M, N] label matrix using array ops only."""
+    num_models, num_samples = labels.shape
+    # Pairwise agreement, one row of the matrix at a time to keep memory at O(M * N)
+    agreement = np.empty((num_models, num_models))
+    for m in range(num_models):
+        agreement[m] = (labels[m] == labels).mean(1)
+
+    offsets = np.arange(num_models)[:, None] * num_classes
+    class_counts = np.bincount((labels + offsets).ravel(),
+                               minlength=num_models * num_classes).reshape(num_models, num_classes)
+
+    sample_offsets = np.arange(num_samples)[None, :] * num_classes
+    votes = np.bincount((labels + sample_offsets).ravel(),
+                        minlength=num_samples * num_classes).reshape(num_samples, num_classes)
+    disagreement = np.flatnonzero(votes.max(1) < num_models)
+
+    p = votes / num_models
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vote_entropy = -np.where(p > 0, p * np.log(p), 0.0).sum(1)
+
+    return {
+        "agreement": agreement,
+        "class_counts": class_counts,
+        "votes": votes,
+        "disagreement": disagreement,
+        "vote_entropy": vote_entropy,
+    }
+
+def print_comparison_report(names, ids, labels, stats, max_examples=10):
+    for name, counts in zip(names, stats["class_counts"]):
+        print(f"\n{name} class distribution:")
+        print(pd.Series(counts, name="count").rename_axis("Labels").to_string())
+
+    if len(names) > 1:
+        print("\n=== Agreement between methods ===")
+        for i in range(len(names)):
+            for j in range(i+1, len(names)):
+                print(f"{names[i]} vs {names[j]}: {stats['agreement'][i, j] * 100:.2f}% agreement")
+
+        disagreement = stats["disagreement"]
+        print(f"\nFound {len(disagreement)} samples with differing predictions")
+        if len(disagreement):
+            print(f"Mean vote entropy over disagreements: {stats['vote_entropy'][disagreement].mean():.4f}")
+            print(f"Sample disagreements (showing first {max_examples}):")
+            for idx in disagreement[:max_examples]:
+                pred_str = ", ".join([f"{name}: {p}" for name, p in zip(names, labels[:, idx])])
+                print(f"ID {ids[idx]}: {pred_str}")
+
+# PREDICTION SERVICE
+class ImagePredictor:
+    """ Checkpoints loaded once; __call__ maps uint8 [N, 3, 32, 32] images to class probabilities """
+    def __init__(self, checkpoint_paths=None, ensemble_weights=None, use_tta=True, tta_config=None, backend="fp32"):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if checkpoint_paths is None:
+            checkpoint_paths = [p for p in (os.path.join(DRIVE_PATH, "best_model.pth"),
+                                            os.path.join(DRIVE_PATH, "best_ema_model.pth")) if os.path.exists(p)]
+        if ensemble_weights is None:
+            ensemble_weights = [0.4, 0.6] if len(checkpoint_paths) == 2 else [1.0 / len(checkpoint_paths)] * len(checkpoint_paths)
+        models = [load_resnet_checkpoint(p, device, name=os.path.basename(p)) for p in checkpoint_paths]
+        if not models or any(m is None for m in models):
+            raise RuntimeError(f"Could not load checkpoints {checkpoint_paths}")
+        if backend != "fp32":
+            calib_loader = get_calibration_loader() if backend == "int8" else None
+            converted = [prepare_backend(m, backend, calib_loader) for m in models]
+            models, device = [m for m, _ in converted], converted[0][1]
+        if len(models) == 1:
+            self.model = models[0]
+        elif backend == "int8":
+            self.model = SequentialEnsemble(models, list(ensemble_weights))
+        else:
+            self.model = StackedEnsemble(models, list(ensemble_weights))
+        self.device = device
+        self.use_tta = use_tta
+        self.tta_config = tta_config
+        self.normalize = BatchAugment(train=False)
+        self.description = {"checkpoints": [os.path.basename(p) for p in checkpoint_paths],
+                            "weights": list(ensemble_weights), "tta": use_tta, "backend": backend}
+
+    def __call__(self, images):
+        x = self.normalize(images.to(self.device))
+        with torch.no_grad():
+            logits = tta_predict(self.model, x, tta_config=self.tta_config) if self.use_tta else self.model(x)
+        return F.softmax(logits.float(), dim=1).cpu()
+
+class ServiceMetrics:
+    """ Request latency window, queue depth and micro-batch size histogram of a PredictionService """
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.images = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+
+    def snapshot(self, queue_depth):
+        latencies = np.array(self.latencies) * 1e3 if self.latencies else np.zeros(1)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        return {"requests": self.requests, "images": self.images, "errors": self.errors,
+                "uptime_s": time.perf_counter() - self.started, "queue_depth": queue_depth,
+                "latency_ms": {"p50": p50, "p90": p90, "p99": p99, "max": float(latencies.max())},
+                "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())}}
+
+class MicroBatcher:
+    """ Coalesces concurrent predict() calls into batches of up to ``max_batch_size`` images
+
+    A batch closes when it is full or ``max_latency_ms`` after its first request arrived; the
+    model runs on a single worker thread so the event loop keeps accepting requests meanwhile.
+    Calls with more than ``max_batch_size`` images are split across batches. Requests whose
+    caller has gone away (cancelled future) are dropped from their batch.
+    """
+    def __init__(self, predict_fn, max_batch_size=64, max_latency_ms=5.0, metrics=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        self.metrics = metrics if metrics else ServiceMetrics()
+        self.queue = asyncio.Queue()
+        self.pending_images = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+        self.carry = None  # request that did not fit into the previous batch
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=False)
+
+    async def predict(self, images):
+        loop = asyncio.get_running_loop()
+        arrival = loop.time()
+        futures = []
+        for chunk in images.split(self.max_batch_size):
+            futures.append(loop.create_future())
+            self.pending_images += len(chunk)
+            await self.queue.put((chunk, futures[-1], arrival))
+        return torch.cat(await asyncio.gather(*futures))
+
+    async def _next_request(self, timeout=None):
+        if self.carry is not None:
+            item, self.carry = self.carry, None
+            return item
+        if timeout is None:
+            return await self.queue.get()
+        if timeout <= 0 or not self.queue.empty():
+            # Past the deadline only requests already waiting join the batch
+            try:
+                return self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                raise asyncio.TimeoutError from None
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._next_request()]
+            size = len(batch[0][0])
+            # Counted from arrival: a request that queued behind a running batch has already waited
+            deadline = batch[0][2] + self.max_latency
+            while size < self.max_batch_size:
+                try:
+                    item = await self._next_request(deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if size + len(item[0]) > self.max_batch_size:
+                    self.carry = item
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self.pending_images -= size
+            batch = [(images, future) for images, future, _ in batch if not future.done()]
+            if not batch:
+                continue
+            size = sum(len(images) for images, _ in batch)
+            self.metrics.batch_sizes[size] += 1
+            try:
+                probs = await loop.run_in_executor(self.executor, self.predict_fn, torch.cat([b[0] for b in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (images, future), chunk in zip(batch, probs.split([len(b[0]) for b in batch])):
+                if not future.done():
+                    future.set_result(chunk)
+
+def _http_response(status, body, content_type="application/json"):
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+    return (f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+class PredictionService:
+    """ Minimal asyncio HTTP/1.1 (keep-alive) scoring service over TCP or a Unix socket
+
+    POST /predict  body: N*3072 raw uint8 bytes (CIFAR row layout, like the test pickle), N <= max_request
+                   -> {"labels": [...], "probs": [[...], ...]}
+    GET  /metrics  -> ServiceMetrics.snapshot()
+    GET  /health   -> predictor description
+    """
+    def __init__(self, predictor, max_batch_size=64, max_latency_ms=5.0, max_request=64):
+        self.predictor = predictor
+        self.metrics = ServiceMetrics()
+        self.batcher = MicroBatcher(predictor, max_batch_size, max_latency_ms, self.metrics)
+        self.max_request = max_request
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=8080, unix_socket=None):
+        self.batcher.start()
+        if unix_socket:
+            self.server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                headers = {k.strip().lower(): v.strip() for k, _, v in (l.partition(":") for l in lines[1:] if l)}
+                try:
+                    method, path, _ = lines[0].split(" ", 2)
+                    length = int(headers.get("content-length", 0))
+                    if not 0 <= length <= self.max_request * 3072:
+                        raise ValueError(f"Content-Length {length} out of range")
+                except ValueError as e:
+                    # The body cannot be framed, so the connection is closed after the 400
+                    self.metrics.errors += 1
+                    writer.write(_http_response(400, json.dumps({"error": f"malformed request: {e}"}).encode()))
+                    await writer.drain()
+                    break
+                try:
+                    body = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                writer.write(await self._route(method, path, body))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            snapshot = self.metrics.snapshot(self.batcher.pending_images)
+            return _http_response(200, json.dumps(snapshot).encode())
+        if method == "GET" and path == "/health":
+            return _http_response(200, json.dumps(self.predictor.description).encode())
+        if method != "POST" or path != "/predict":
+            return _http_response(404, b'{"error": "not found"}')
+        if not body or len(body) % 3072 or len(body) // 3072 > self.max_request:
+            self.metrics.errors += 1
+            return _http_response(400, json.dumps({"error": f"body must be 1..{self.max_request} x 3072 uint8 bytes"}).encode())
+        start = time.perf_counter()
+        images = torch.frombuffer(bytearray(body), dtype=torch.uint8).view(-1, 3, 32, 32)
+        try:
+            probs = await self.batcher.predict(images)
+        except Exception as e:
+            self.metrics.errors += 1
+            return _http_response(500, json.dumps({"error": str(e)}).encode())
+        self.metrics.latencies.append(time.perf_counter() - start)
+        self.metrics.requests += 1
+        self.metrics.images += len(images)
+        return _http_response(200, json.dumps({"labels": probs.argmax(1).tolist(),
+                                               "probs": probs.round(decimals=5).tolist()}).encode())
+
+def serve(host="127.0.0.1", port=8080, unix_socket=None, max_batch_size=64, max_latency_ms=5.0, **predictor_kwargs):
+    """Run the prediction service until interrupted; ``predictor_kwargs`` go to ImagePredictor."""
+    async def main():
+        service = PredictionService(ImagePredictor(**predictor_kwargs), max_batch_size, max_latency_ms)
+        server = await service.start(host, port, unix_socket)
+        print(f"Serving {service.predictor.description} on {unix_socket or f'http://{host}:{port}'}")
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+async def _http_call(reader, writer, method, path, body=b""):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = int(next(l.split(b":")[1] for l in head.split(b"\r\n") if l.lower().startswith(b"content-length")))
+    return status, json.loads(await reader.readexactly(length))
+
+async def load_generator(host="127.0.0.1", port=8080, unix_socket=None, num_requests=1000, concurrency=32,
+                         images_per_request=1, seed=0):
+    """Closed-loop client: ``concurrency`` keep-alive connections send random images until
+    ``num_requests`` are done. Returns client-side latency percentiles, throughput and /metrics."""
+    rng = np.random.default_rng(seed)
+    payload = rng.integers(0, 256, (images_per_request, 3072), dtype=np.uint8).tobytes()
+    latencies, remaining = [], [num_requests]
+
+    async def connect():
+        if unix_socket:
+            return await asyncio.open_unix_connection(unix_socket)
+        return await asyncio.open_connection(host, port)
+
+    async def client():
+        reader, writer = await connect()
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                status, _ = await _http_call(reader, writer, "POST", "/predict", payload)
+                assert status == 200, f"/predict returned {status}"
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    reader, writer = await connect()
+    _, server_metrics = await _http_call(reader, writer, "GET", "/metrics")
+    writer.close()
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1e3, [50, 90, 99])
+    report = {"requests": len(latencies), "concurrency": concurrency, "images_per_request": images_per_request,
+              "requests_per_sec": len(latencies) / elapsed, "images_per_sec": len(latencies) * images_per_request / elapsed,
+              "latency_ms": {"p50": p50, "p90": p90, "p99": p99}, "server": server_metrics}
+    print(f"{report['requests_per_sec']:.0f} req/s ({report['images_per_sec']:.0f} img/s) at concurrency {concurrency} | "
+          f"latency p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms | "
+          f"batch sizes {server_metrics['batch_size_histogram']}")
+    return report
+
+def run_service_load_test(predictor=None, num_requests=500, concurrency=(1, 8, 32), max_batch_size=64,
+                          max_latency_ms=5.0, images_per_request=1):
+    """Start the service on an ephemeral localhost port and drive it with load_generator() per concurrency level."""
+    async def main():
+        service = PredictionService(predictor if predictor else ImagePredictor(), max_batch_size, max_latency_ms)
+        server = await service.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return [await load_generator(port=port, num_requests=num_requests, concurrency=c,
+                                         images_per_request=images_per_request) for c in concurrency]
+        finally:
+            await service.stop()
+    return asyncio.run(main())
+
+# KNOWLEDGE DISTILLATION
+def teacher_soft_targets(images, checkpoint_paths, ensemble_weights, tta_config=None, cache_dir=None,
+                         batch_size=256, device=None):
+    """Ensemble + TTA teacher logits for uint8 ``images`` [N, 3, 32, 32], computed once and cached.
+
+    The cache file is keyed by the checkpoint contents, the ensemble weights, the TTA config
+    and the images, so retraining the teacher or changing TTA invalidates it.
+    """
+    cfg = tta_config if tta_config is not None else DEFAULT_TTA_CONFIG
+    device = device if device else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    cache_dir = cache_dir if cache_dir else os.path.join(DRIVE_PATH, "distill_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha256(json.dumps({"checkpoints": [file_sha256(p) for p in checkpoint_paths],
+                                     "weights": list(ensemble_weights), "tta": cfg}, sort_keys=True).encode())
+    key.update(images.cpu().numpy().tobytes())
+    cache_path = os.path.join(cache_dir, f"teacher_{key.hexdigest()[:16]}.npy")
+    if os.path.exists(cache_path):
+        print(f"Teacher soft targets loaded from {cache_path}")
+        return torch.from_numpy(np.load(cache_path))
+
+    models = [load_resnet_checkpoint(p, device, name=os.path.basename(p)) for p in checkpoint_paths]
+    if any(m is None for m in models):
+        raise RuntimeError("Could not load every teacher checkpoint")
+    teacher = StackedEnsemble(models, list(ensemble_weights))
+    normalize = BatchAugment(train=False)
+    logits = torch.cat([tta_predict(teacher, normalize(images[start:start + batch_size].to(device)), tta_config=cfg).cpu()
+                        for start in range(0, len(images), batch_size)])
+    tmp_path = cache_path + ".tmp.npy"
+    np.save(tmp_path, logits.numpy())
+    os.replace(tmp_path, cache_path)
+    print(f"Teacher soft targets for {len(images)} images cached to {cache_path}")
+    return logits
+
+def distillation_loss(criterion, outputs, teacher_a, teacher_b, targets_a, targets_b, lam, temperature=4.0, kd_alpha=0.9):
+    """kd_alpha * T^2 * KL(mixed teacher distribution || student) + (1 - kd_alpha) * mixup CE."""
+    soft_targets = lam * F.softmax(teacher_a / temperature, dim=1) + (1 - lam) * F.softmax(teacher_b / temperature, dim=1)
+    soft_loss = F.kl_div(F.log_softmax(outputs / temperature, dim=1), soft_targets,
+                         reduction='batchmean') * temperature ** 2
+    return kd_alpha * soft_loss + (1 - kd_alpha) * mixup_criterion(criterion, outputs, targets_a, targets_b, lam)
+
+def distillation_report(teacher, student, images, targets, tta_config=None, batch_size=128):
+    """Accuracy, parameter count and per-image latency of the ensemble+TTA teacher vs. the student."""
+    device = images.device
+    teacher_fn = lambda x: tta_predict(teacher, x, tta_config=tta_config)
+    student.eval()
+    report = {}
+    for name, fn, num_params in [
+            ("teacher", teacher_fn, sum(p.numel() for p in teacher.params.values())),
+            ("student", student, sum(p.numel() for p in student.parameters()))]:
+        correct = 0
+        with torch.no_grad():
+            for start in range(0, len(targets), batch_size):
+                correct += fn(images[start:start + batch_size]).argmax(1).eq(targets[start:start + batch_size]).sum().item()
+        images_per_sec = measure_throughput(fn, device, batch_size=batch_size, num_batches=3, warmup=1)
+        report[name] = {"accuracy": 100. * correct / len(targets), "params": num_params,
+                        "ms_per_image": 1e3 / images_per_sec}
+    report["accuracy_retained"] = report["student"]["accuracy"] / max(report["teacher"]["accuracy"], 1e-8)
+    report["speedup"] = report["teacher"]["ms_per_image"] / report["student"]["ms_per_image"]
+    for name in ("teacher", "student"):
+        r = report[name]
+        print(f"{name:>8}: {r['accuracy']:.2f}% | {r['params'] / 1e6:.2f}M params | {r['ms_per_image']:.3f} ms/image")
+    print(f"Student keeps {report['accuracy_retained']:.1%} of the teacher accuracy at {report['speedup']:.1f}x less latency")
+    return report
+
+def train_distill(student_arch=(2, 2, 2), student_channels=32, num_epochs=100, temperature=4.0, kd_alpha=0.9,
+                  ensemble_weights=(0.4, 0.6), tta_config=None, config=None, eval_every=1, output_dir=None):
+    """Distill the regular+EMA ensemble with TTA into ResNet(``student_arch``, ``student_channels``).
+
+    Teacher logits for the (unaugmented) training images come from teacher_soft_targets(); the
+    student is trained by train_model() (TRAIN_DEFAULTS updated with ``config``) on augmented +
+    mixup inputs with the mixed teacher distribution as soft target. Checkpoints, logs and the
+    best EMA student (best_ema_model.pth) go to ``output_dir``. Returns distillation_report().
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    output_dir = output_dir if output_dir else os.path.join(DRIVE_PATH, "distill")
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_paths = [os.path.join(DRIVE_PATH, "best_model.pth"), os.path.join(DRIVE_PATH, "best_ema_model.pth")]
+
+    teacher_logits = teacher_soft_targets(InMemoryCIFAR10(train=True).images, checkpoint_paths, ensemble_weights,
+                                          tta_config, device=device)
+    student_config = {**(config or {}), "arch": tuple(student_arch), "num_channels": student_channels,
+                      "num_epochs": num_epochs}
+    train_model(eval_every=eval_every, config=student_config, output_dir=output_dir, batch_augment=True,
+                teacher_logits=teacher_logits, kd_temperature=temperature, kd_alpha=kd_alpha)
+
+    student = ResNet(list(student_arch), num_channels=student_channels).to(device)
+    student.load_state_dict(torch.load(os.path.join(output_dir, "best_ema_model.pth"), map_location=device))
+    test_set = InMemoryCIFAR10(train=False)
+    eval_images, eval_targets = cache_eval_set(
+        AugmentedLoader(FastLoader(test_set.images, test_set.targets), BatchAugment(train=False), device), device)
+    teacher = StackedEnsemble([load_resnet_checkpoint(p, device, name=os.path.basename(p)) for p in checkpoint_paths],
+                              list(ensemble_weights))
+    return distillation_report(teacher, student, eval_images, eval_targets, tta_config)
+
+# STRUCTURED CHANNEL PRUNING
+def se_channel_importance(model, calib_loader, num_batches=None):
+    """Per BasicBlock: mean SE gate over ``calib_loader`` times |bn1 scale|, one [mid_channels] tensor each."""
+    device = next(model.parameters()).device
+    blocks = [(name, m) for name, m in model.named_modules() if isinstance(m, BasicBlock) and m.se is not None]
+    gate_sums = {}
+    handles = []
+    for name, block in blocks:
+        def hook(module, inputs, output, name=name):
+            gate_sums[name] = gate_sums.get(name, 0) + output.detach().sum(dim=(0, 2, 3))
+        handles.append(block.se.se.register_forward_hook(hook))
     model.eval()
-    if ema_model:
-        ema_model.eval()
+    count = 0
+    try:
+        with torch.no_grad():
+            for i, (inputs, _) in enumerate(calib_loader):
+                if num_batches and i >= num_batches:
+                    break
+                model(inputs.to(device))
+                count += inputs.size(0)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return {name: (gate_sums[name] / count) * block.bn1.weight.detach().abs() for name, block in blocks}
+
+def _copy_pruned_block(src, dst, keep):
+    """Copy ``src`` into the narrower ``dst`` keeping inner channels ``keep``; residual path unchanged."""
+    with torch.no_grad():
+        dst.conv1.weight.copy_(src.conv1.weight[keep])
+        for attr in ("weight", "bias", "running_mean", "running_var"):
+            getattr(dst.bn1, attr).copy_(getattr(src.bn1, attr)[keep])
+        dst.bn1.num_batches_tracked.copy_(src.bn1.num_batches_tracked)
+        dst.se.se[1].weight.copy_(src.se.se[1].weight[:, keep])
+        dst.se.se[1].bias.copy_(src.se.se[1].bias)
+        dst.se.se[3].weight.copy_(src.se.se[3].weight[keep])
+        dst.se.se[3].bias.copy_(src.se.se[3].bias[keep])
+        dst.conv2.weight.copy_(src.conv2.weight[:, keep])
+    dst.bn2.load_state_dict(src.bn2.state_dict())
+    dst.shortcut.load_state_dict(src.shortcut.state_dict())
+
+def prune_resnet(model, importance, sparsity, min_channels=4, drop_blocks=False):
+    """Physically smaller copy of ``model`` without the ``sparsity`` fraction of least important inner channels.
+
+    Scores are normalized per block and ranked globally; every block keeps at least
+    ``min_channels``. With ``drop_blocks``, an identity-shortcut block left with fewer than
+    ``min_channels`` is removed instead. Returns (pruned model, plan); ResNet(**plan) rebuilds it.
+    """
+    layers = [model.layer1, model.layer2, model.layer3]
+    blocks = [(f"layer{i + 1}.{j}", block) for i, layer in enumerate(layers) for j, block in enumerate(layer)]
+    scores = [importance[name] / importance[name].max().clamp(min=1e-12) for name, _ in blocks]
+    flat = torch.cat(scores)
+    num_pruned = int(sparsity * flat.numel())
+    pruned = torch.zeros(flat.numel(), dtype=torch.bool)
+    pruned[flat.argsort()[:num_pruned].cpu()] = True
+
+    keep, dropped, offset = {}, set(), 0
+    for (name, block), score in zip(blocks, scores):
+        mask = ~pruned[offset:offset + len(score)]
+        offset += len(score)
+        identity = len(block.shortcut) == 0
+        if mask.sum() < min_channels and drop_blocks and identity:
+            dropped.add(name)
+            continue
+        if mask.sum() < min_channels:
+            mask[score.cpu().argsort(descending=True)[:min_channels]] = True
+        keep[name] = mask.nonzero().flatten().to(block.conv1.weight.device)
+
+    kept = [(name, block) for name, block in blocks if name not in dropped]
+    plan = {"num_blocks": [sum(name.startswith(f"layer{i + 1}.") for name, _ in kept) for i in range(3)],
+            "num_channels": model.conv1.out_channels, "num_classes": model.linear.out_features,
+            "mid_channels": [len(keep[name]) for name, _ in kept],
+            "se_hidden": [block.se.se[1].out_channels for _, block in kept]}
+    small = ResNet(**plan).to(model.conv1.weight.device)
+    small.conv1.load_state_dict(model.conv1.state_dict())
+    small.bn1.load_state_dict(model.bn1.state_dict())
+    small.linear.load_state_dict(model.linear.state_dict())
+    small_blocks = [block for layer in (small.layer1, small.layer2, small.layer3) for block in layer]
+    assert len(small_blocks) == len(kept), f"Rebuilt {len(small_blocks)} blocks for a plan of {len(kept)}"
+    for (name, block), dst in zip(kept, small_blocks):
+        _copy_pruned_block(block, dst, keep[name])
+    return small.eval(), plan
+
+def finetune(model, epochs=5, lr=0.01, train_loader=None):
+    """Short Lookahead(SGD) + cosine fine-tune with plain cross-entropy."""
+    device = next(model.parameters()).device
+    if train_loader is None:
+        train_loader, _ = get_cifar10_loaders(batch_augment=True, device=device)
+    optimizer = Lookahead(SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4, nesterov=True))
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer.optimizer, T_max=epochs * len(train_loader))
+    criterion = nn.CrossEntropyLoss()
+    for epoch in range(epochs):
+        model.train()
+        loss_sum = torch.zeros((), device=device)
+        for inputs, targets in train_loader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            loss = criterion(model(inputs), targets)
+            loss.backward()
+            nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad()
+            scheduler.step()
+            loss_sum += loss.detach()
+        print(f"  fine-tune epoch {epoch + 1}/{epochs}: loss {loss_sum.item() / len(train_loader):.4f}")
+    return model.eval()
 
-    # competition test loader
-    test_loader = get_competition_test_loader(test_file_path)
+def model_cost(model, device, batch_size=128):
+    """Forward FLOPs and parameters per image, and ms/image at ``batch_size``."""
+    model.eval()
+    with ModuleProfiler(model) as profiler:
+        with torch.no_grad():
+            model(torch.randn(1, 3, 32, 32, device=device))
+    flops = sum(entry["flops"] for entry in profiler.stats.values() if entry["leaf"])
+    return {"flops": flops, "params": sum(p.numel() for p in model.parameters()),
+            "ms_per_image": 1e3 / measure_throughput(model, device, batch_size=batch_size, num_batches=3, warmup=1)}
+
+def pruning_curve(model=None, sparsities=(0.0, 0.25, 0.5, 0.75), finetune_epochs=5, drop_blocks=False,
+                  calib_samples=1024, output_path=None):
+    """Prune the EMA model at each sparsity, fine-tune, and record FLOPs/params/latency vs. accuracy.
+
+    Pruned checkpoints ({"plan", "state_dict"}) go to DRIVE_PATH/pruned/ and the curve to
+    ``output_path`` (JSON). Returns the list of curve points.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if model is None:
+        model = load_resnet_checkpoint(os.path.join(DRIVE_PATH, "best_ema_model.pth"), device, name="EMA model")
+    model = model.to(device).eval()
+    output_path = output_path if output_path else os.path.join(DRIVE_PATH, "pruning_curve.json")
+    pruned_dir = os.path.join(DRIVE_PATH, "pruned")
+    os.makedirs(pruned_dir, exist_ok=True)
+    train_loader, test_loader = get_cifar10_loaders(batch_augment=True, device=device)
+    importance = se_channel_importance(model, get_calibration_loader(calib_samples))
+
+    curve = []
+    for sparsity in sparsities:
+        pruned, plan = prune_resnet(model, importance, sparsity, drop_blocks=drop_blocks)
+        point = {"sparsity": sparsity, "num_blocks": plan["num_blocks"],
+                 "accuracy_pruned": evaluate(pruned, test_loader, device)}
+        if sparsity > 0 and finetune_epochs:
+            finetune(pruned, finetune_epochs, train_loader=train_loader)
+        point["accuracy"] = evaluate(pruned, test_loader, device)
+        point.update(model_cost(pruned, device))
+        torch.save({"plan": plan, "state_dict": pruned.state_dict()},
+                   os.path.join(pruned_dir, f"pruned_{int(sparsity * 100):02d}.pth"))
+        curve.append(point)
+        print(f"sparsity {sparsity:.2f}: {point['flops'] / 1e6:8.1f}M FLOPs | {point['params'] / 1e6:.2f}M params | "
+              f"{point['ms_per_image']:.3f} ms/image | acc {point['accuracy_pruned']:.2f}% -> {point['accuracy']:.2f}%")
+
+    with open(output_path, 'w') as f:
+        json.dump(curve, f, indent=2)
+    print(f"Pruning curve written to {output_path}")
+    return curve
+
+# PROFILING AND FLOP INSTRUMENTATION
+def _output_tensors(output):
+    if isinstance(output, torch.Tensor):
+        return [output]
+    if isinstance(output, (tuple, list)):
+        return [t for t in output if isinstance(t, torch.Tensor)]
+    return []
+
+def module_flops(module, inputs, output):
+    """Forward FLOPs of one call (multiply-adds count as 2); ops outside nn.Modules are not seen."""
+    out = _output_tensors(output)
+    if not out:
+        return 0
+    numel = out[0].numel()
+    if isinstance(module, nn.Conv2d):
+        kh, kw = module.kernel_size
+        flops = 2 * numel * (module.in_channels // module.groups) * kh * kw
+        return flops + (numel if module.bias is not None else 0)
+    if isinstance(module, nn.Linear):
+        return 2 * numel * module.in_features + (numel if module.bias is not None else 0)
+    if isinstance(module, nn.BatchNorm2d):
+        return 2 * numel
+    if isinstance(module, (nn.SiLU, nn.Sigmoid, nn.ReLU)):
+        return numel
+    if isinstance(module, nn.AdaptiveAvgPool2d):
+        return inputs[0].numel()
+    return 0
+
+def module_category(name, module):
+    """(stage, kind) of a submodule name, e.g. ('layer2', 'se') or ('stem', 'conv')."""
+    parts = name.split('.')
+    stage = parts[0] if parts[0].startswith('layer') else ('head' if parts[0] in ('avgpool', 'linear') else 'stem')
+    if '.se' in name:
+        kind = 'se'
+    elif 'shortcut' in name:
+        kind = 'shortcut'
+    elif isinstance(module, nn.Conv2d):
+        kind = 'conv'
+    elif isinstance(module, nn.BatchNorm2d):
+        kind = 'bn'
+    else:
+        kind = type(module).__name__.lower()
+    return stage, kind
 
-    # predictions
-    print(f"Generating predictions with {'TTA' if use_tta else 'standard inference'} and {'ensemble' if use_ensemble and ema_model else 'single model'}...")
-    predictions = []
-    ids = []
+class ModuleProfiler:
+    """ Hook-based per-module profiler: wall time, FLOPs, parameters, activation bytes and call counts
 
-    with torch.no_grad():
-        for inputs, batch_ids in test_loader:
-            inputs = inputs.to(device)
+    Nothing is installed until attach() (or ``with ModuleProfiler(model):``), and detach() removes
+    every hook, so the model classes stay untouched and the disabled cost is zero.
+    Times of container modules are inclusive; stage/kind aggregates only sum leaf modules.
+    """
+    def __init__(self, model, backward=False, synchronize=None):
+        self.model = model
+        self.backward = backward
+        self.synchronize = torch.cuda.is_available() if synchronize is None else synchronize
+        self.handles = []
+        self.stats = {}
+        self.events = []
+        self._starts = {}
+        self._origin = None
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _entry(self, name, module):
+        if name not in self.stats:
+            stage, kind = module_category(name, module)
+            self.stats[name] = {"type": type(module).__name__, "stage": stage, "kind": kind,
+                                "leaf": len(list(module.children())) == 0,
+                                "params": sum(p.numel() for p in module.parameters()),
+                                "calls": 0, "forward_s": 0.0, "backward_s": 0.0, "flops": 0,
+                                "activation_bytes": 0}
+        return self.stats[name]
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._starts[name] = self._now()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            end = self._now()
+            start = self._starts.pop(name, end)
+            entry = self._entry(name, module)
+            entry["forward_s"] += end - start
+            entry["calls"] += 1
+            entry["flops"] += module_flops(module, inputs, output)
+            entry["activation_bytes"] += sum(t.numel() * t.element_size() for t in _output_tensors(output))
+            if self.backward and torch.is_grad_enabled():
+                self._hook_backward(name, module, inputs, output, entry["calls"])
+            self.events.append({"name": name, "cat": "forward", "ph": "X", "pid": 0, "tid": 0,
+                                "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6})
+        return hook
+
+    def _hook_backward(self, name, module, inputs, output, call):
+        # Tensor hooks instead of full module backward hooks, which reject the in-place SiLU and
+        # residual add: backward starts when the output gradient arrives and ends at the input's.
+        outs = [t for t in _output_tensors(output) if t.requires_grad]
+        ins = [t for t in inputs if isinstance(t, torch.Tensor) and t.requires_grad]
+        if not outs or not ins:
+            return
+        key = (name, "backward", call)
+
+        def start(grad):
+            self._starts[key] = self._now()
+
+        def end(grad):
+            stop = self._now()
+            begin = self._starts.pop(key, None)
+            if begin is not None:
+                self.stats[name]["backward_s"] += stop - begin
+                self.events.append({"name": name, "cat": "backward", "ph": "X", "pid": 0, "tid": 1,
+                                    "ts": (begin - self._origin) * 1e6, "dur": (stop - begin) * 1e6})
+
+        outs[0].register_hook(start)
+        ins[0].register_hook(end)
+
+    def attach(self):
+        self._origin = time.perf_counter()
+        for name, module in self.model.named_modules():
+            name = name or "model"
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._post_hook(name)))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def reset(self):
+        self.stats, self.events, self._starts = {}, [], {}
+        self._origin = time.perf_counter()
+
+    def aggregate(self, by=("stage", "kind")):
+        """Sum leaf-module statistics per group, e.g. by=("stage",) or by=("kind",)."""
+        groups = {}
+        for entry in self.stats.values():
+            if not entry["leaf"]:
+                continue
+            key = tuple(entry[k] for k in by)
+            group = groups.setdefault(key, {"calls": 0, "forward_s": 0.0, "backward_s": 0.0, "flops": 0,
+                                            "params": 0, "activation_bytes": 0})
+            for field in group:
+                group[field] += entry[field]
+        return groups
+
+    def table(self, sort_by="forward_s", top=None, by=None):
+        """Text table per module (``by=None``) or per aggregate group, sorted descending by ``sort_by``."""
+        if by is None:
+            rows = [(name,) + (entry["type"],) + tuple(entry[k] for k in self._columns()) for name, entry in self.stats.items()]
+            header = ("module", "type") + self._columns()
+        else:
+            rows = [("/".join(key), "") + tuple(group[k] for k in self._columns()) for key, group in self.aggregate(by).items()]
+            header = ("/".join(by), "") + self._columns()
+        idx = header.index(sort_by)
+        rows = sorted(rows, key=lambda r: r[idx], reverse=True)[:top]
+        lines = [f"{header[0]:<32} {header[1]:<18} " + " ".join(f"{h:>16}" for h in header[2:])]
+        for row in rows:
+            cells = [f"{v * 1e3:13.3f} ms" if k.endswith("_s") else f"{v / 1e6:14.2f} M" if k in ("flops", "activation_bytes")
+                     else f"{v:16d}" for k, v in zip(header[2:], row[2:])]
+            lines.append(f"{row[0]:<32} {row[1]:<18} " + " ".join(cells))
+        return "\n".join(lines)
+
+    def _columns(self):
+        return ("calls", "forward_s", "backward_s", "flops", "params", "activation_bytes")
+
+    def export_trace(self, path):
+        """Chrome trace (chrome://tracing, Perfetto) of every recorded module call."""
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": self.events}, f)
+        print(f"Trace with {len(self.events)} events written to {path}")
+
+def profile_model(model, inputs, backward=False, sort_by="forward_s", top=20):
+    """One instrumented forward (and backward) pass; prints per-module and per-stage tables."""
+    with ModuleProfiler(model, backward=backward) as profiler:
+        if backward:
+            model(inputs).float().sum().backward()
+        else:
+            with torch.no_grad():
+                model(inputs)
+    print(profiler.table(sort_by=sort_by, top=top))
+    print()
+    print(profiler.table(sort_by=sort_by, by=("stage", "kind")))
+    try:
+        import thop
+        macs, params = thop.profile(copy.deepcopy(model), inputs=(inputs[:1],), verbose=False)
+        print(f"\nthop cross-check (batch 1): {macs / 1e6:.2f}M MACs, {params / 1e6:.2f}M params")
+    except ImportError:
+        pass
+    return profiler
+
+# BENCHMARK SUITE
+class SyntheticCIFAR10(Dataset):
+    """ Random CIFAR-shaped PIL images for benchmarking the per-sample transform pipeline """
+    def __init__(self, num_samples=2048, transform=None, seed=0):
+        rng = np.random.default_rng(seed)
+        self.data = rng.integers(0, 256, (num_samples, 32, 32, 3), dtype=np.uint8)
+        self.targets = rng.integers(0, 10, num_samples).tolist()
+        self.transform = transform
 
-            if use_tta:
-                outputs = tta_predict(model, inputs)
-                if ema_model and use_ensemble:
-                    ema_outputs = tta_predict(ema_model, inputs)
-                    outputs = (outputs + ema_outputs) / 2
-            else:
-                outputs = model(inputs)
-                if ema_model and use_ensemble:
-                    ema_outputs = ema_model(inputs)
-                    outputs = (outputs + ema_outputs) / 2
+    def __len__(self):
+        return len(self.data)
 
-            pred_labels = outputs.argmax(1).tolist()
-            predictions.extend(pred_labels)
-            ids.extend(batch_ids)
+    def __getitem__(self, idx):
+        img = Image.fromarray(self.data[idx])
+        return (self.transform(img) if self.transform else img), self.targets[idx]
+
+def _bench(fn, warmup=1, repeat=5):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"median_s": float(np.median(times)), "min_s": float(np.min(times))}
+
+def bench_forward(arch=(4, 4, 3), batch_sizes=(1, 32, 128), thread_counts=None, repeat=5):
+    results = {}
+    thread_counts = thread_counts or sorted({1, torch.get_num_threads()})
+    default_threads = torch.get_num_threads()
+    model = ResNet(list(arch)).eval()
+    try:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for bs in batch_sizes:
+                x = torch.randn(bs, 3, 32, 32)
+                with torch.no_grad():
+                    r = _bench(lambda: model(x), repeat=repeat)
+                r["images_per_sec"] = bs / r["median_s"]
+                results[f"forward/bs{bs}/threads{threads}"] = r
+    finally:
+        torch.set_num_threads(default_threads)
+    return results
+
+def bench_train_step(arch=(4, 4, 3), batch_size=128, repeat=5, mixup_alpha=0.3):
+    """Forward, mixup loss, backward, clipping, Lookahead step and ModelEMA.update."""
+    model = ResNet(list(arch)).train()
+    optimizer = Lookahead(SGD(model.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True))
+    ema_model = ModelEMA(model, decay=0.999, device=torch.device('cpu'))
+    criterion = nn.CrossEntropyLoss()
+    x = torch.randn(batch_size, 3, 32, 32)
+    y = torch.randint(0, 10, (batch_size,))
+
+    def step():
+        inputs, targets_a, targets_b, lam = mixup_data(x, y, mixup_alpha)
+        loss = mixup_criterion(criterion, model(inputs), targets_a, targets_b, lam)
+        loss.backward()
+        nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        optimizer.zero_grad()
+        ema_model.update(model)
+
+    r = _bench(step, repeat=repeat)
+    r["images_per_sec"] = batch_size / r["median_s"]
+    return {f"train_step/bs{batch_size}": r}
+
+def bench_lookahead(arch=(4, 4, 3), repeat=20):
+    """Lookahead slow/fast weight sync: flat buffer + foreach ops vs. the per-tensor Python loop."""
+    model = ResNet(list(arch))
+    optimizer = Lookahead(SGD(model.parameters(), lr=0.1))
+    optimizer.sync()
+    slow_params = [p.detach().clone() for p in optimizer.params]
+
+    @torch.no_grad()
+    def per_tensor_sync():
+        for p, slow in zip(optimizer.params, slow_params):
+            slow.add_(p.data - slow, alpha=optimizer.alpha)
+            p.data.copy_(slow)
+
+    results = {}
+    for name, fn in [("lookahead_sync/per_tensor", per_tensor_sync), ("lookahead_sync/foreach", optimizer.sync)]:
+        r = _bench(fn, repeat=repeat)
+        r["tensors"] = len(optimizer.params)
+        results[name] = r
+    return results
+
+def _ddp_bench_worker(rank, world_size, port, arch, batch_size, steps, threads_per_rank, result_path):
+    init_distributed(rank, world_size, port, threads_per_rank)
+    try:
+        model = DistributedDataParallel(ResNet(list(arch)).train(), gradient_as_bucket_view=True)
+        optimizer = Lookahead(SGD(model.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True))
+        criterion = nn.CrossEntropyLoss()
+        x = torch.randn(batch_size, 3, 32, 32)
+        y = torch.randint(0, 10, (batch_size,))
+
+        def step():
+            criterion(model(x), y).backward()
+            nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad()
 
-    # submission DataFrame with correct column names
-    submission = pd.DataFrame({
-        "ID": ids,  # Correct case as per competition requirements
-        "Labels": predictions  # Correct case as per competition requirements
-    })
+        step()
+        dist.barrier()
+        start = time.perf_counter()
+        for _ in range(steps):
+            step()
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+        if rank == 0:
+            with open(result_path, 'w') as f:
+                json.dump({"median_s": elapsed / steps, "images_per_sec": world_size * batch_size * steps / elapsed,
+                           "threads_per_rank": torch.get_num_threads()}, f)
+    finally:
+        dist.destroy_process_group()
+
+def bench_ddp_scaling(arch=(4, 4, 3), batch_size=64, steps=10, max_procs=None, threads_per_rank=None, port=29510):
+    """Images/sec of gloo DDP training steps (per-rank batch ``batch_size``) for 1..max_procs processes."""
+    max_procs = max_procs or min(8, os.cpu_count() or 1)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for world_size in range(1, max_procs + 1):
+            result_path = os.path.join(tmp, f"ddp{world_size}.json")
+            mp.spawn(_ddp_bench_worker, args=(world_size, port + world_size, arch, batch_size, steps,
+                                              threads_per_rank, result_path), nprocs=world_size, join=True)
+            with open(result_path) as f:
+                r = json.load(f)
+            single = results.get("ddp_train_step/procs1", r)["images_per_sec"]
+            r["scaling_efficiency"] = r["images_per_sec"] / (world_size * single)
+            results[f"ddp_train_step/procs{world_size}"] = r
+    return results
+
+def bench_sweep(arch=(4, 4, 3), num_models=4, batch_size=128, repeat=3):
+    """One vmap training step for ``num_models`` stacked models vs. that many sequential train steps."""
+    x = torch.randn(batch_size, 3, 32, 32)
+    y = torch.randint(0, 10, (batch_size,))
+    criterion = nn.CrossEntropyLoss()
 
-    # Validation checks
-    assert len(submission) == len(ids), f"Submission has {len(submission)} rows but expected {len(ids)}"
-    assert list(submission.columns) == ['ID', 'Labels'], f"Invalid column names: {submission.columns}"
-    assert all(0 <= label <= 9 for label in submission.Labels), "Labels must be between 0-9"
+    models = [ResNet(list(arch)).train() for _ in range(num_models)]
+    optimizers = [Lookahead(SGD(m.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True))
+                  for m in models]
 
-    # submission to Google Drive
-    submission.to_csv(submission_path, index=False)
-    print(f"Submission file created successfully at {submission_path}")
-    print(f"Sample of submission file:")
-    print(submission.head())
+    def sequential_step():
+        for model, optimizer in zip(models, optimizers):
+            criterion(model(x), y).backward()
+            nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            optimizer.zero_grad()
+
+    stacked = StackedModels([ResNet(list(arch)) for _ in range(num_models)]).train()
+    stacked_optimizer = StackedLookahead(StackedSGD(stacked.params.values(), torch.ones(num_models)),
+                                         k=torch.full((num_models,), 5), alpha=torch.full((num_models,), 0.5))
+    params = list(stacked.params.values())
+
+    def stacked_step():
+        outputs = stacked(x, shared_input=True)
+        criterion(outputs.flatten(0, 1), y.repeat(num_models)).mul(num_models).backward()
+        grad_norm = torch.stack([p.grad.flatten(1).pow(2).sum(1) for p in params]).sum(0).sqrt()
+        clip = (1.0 / (grad_norm + 1e-6)).clamp(max=1.0)
+        torch._foreach_mul_([p.grad for p in params], [_per_model(clip, p) for p in params])
+        stacked_optimizer.step()
+        stacked_optimizer.zero_grad()
+
+    results = {}
+    for name, fn in [(f"sweep_step/sequential_m{num_models}", sequential_step),
+                     (f"sweep_step/stacked_m{num_models}", stacked_step)]:
+        r = _bench(fn, repeat=repeat)
+        r["images_per_sec"] = num_models * batch_size / r["median_s"]
+        results[name] = r
+    return results
+
+def bench_tta(arch=(4, 4, 3), batch_size=128, repeat=3):
+    model = ResNet(list(arch)).eval()
+    x = torch.randn(batch_size, 3, 32, 32)
+    r = _bench(lambda: tta_predict(model, x), repeat=repeat)
+    r["images_per_sec"] = batch_size / r["median_s"]
+    return {f"tta_predict/bs{batch_size}": r}
+
+def bench_loaders(batch_size=128, num_samples=4096, repeat=3):
+    """Per-sample PIL pipeline with workers vs. the in-memory batched pipeline, on synthetic data."""
+    transform_train = transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        Cutout(n_holes=1, length=16),
+        transforms.Normalize(CIFAR10_MEAN, CIFAR10_STD)
+    ])
+    dataset = SyntheticCIFAR10(num_samples, transform=transform_train)
+    worker_loader = DataLoader(dataset, batch_size, shuffle=True, num_workers=min(4, os.cpu_count() or 1))
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    targets = torch.as_tensor(dataset.targets)
+    fast_loader = AugmentedLoader(FastLoader(images, targets, batch_size, shuffle=True),
+                                  BatchAugment(train=True), torch.device('cpu'))
+
+    results = {}
+    for name, loader in [("loader/torchvision_workers", worker_loader), ("loader/in_memory", fast_loader)]:
+        r = _bench(lambda: [None for _ in loader], warmup=0, repeat=repeat)
+        r["images_per_sec"] = num_samples / r["median_s"]
+        results[name] = r
+    return results
+
+def bench_submission(num_samples=512, repeat=1):
+    """create_submission end to end (TTA + regular/EMA ensemble of ResNet([4, 4, 3])) on a synthetic test pickle."""
+    global DRIVE_PATH
+    saved_drive_path = DRIVE_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        rng = np.random.default_rng(0)
+        test_file = os.path.join(tmp, "bench_test.pkl")
+        with open(test_file, 'wb') as f:
+            pickle.dump({b'data': rng.integers(0, 256, (num_samples, 3072), dtype=np.uint8)}, f)
+        for name in ("best_model.pth", "best_ema_model.pth"):
+            torch.save(ResNet([4, 4, 3]).state_dict(), os.path.join(tmp, name))
+        DRIVE_PATH = tmp
+        try:
+            r = _bench(lambda: create_submission(test_file, use_tta=True, use_ensemble=True), warmup=0, repeat=repeat)
+        finally:
+            DRIVE_PATH = saved_drive_path
+    r["images_per_sec"] = num_samples / r["median_s"]
+    return {f"create_submission/n{num_samples}": r}
+
+def bench_artifact(batch_size=128, repeat=3, formats=ARTIFACT_FORMATS):
+    """Cold start and TTA throughput of exported regular+EMA artifacts vs ImagePredictor loading the checkpoints.
+
+    ``cold_start/*_process`` runs an artifact's loader.py in a fresh interpreter, so it includes the
+    torch import and none of this module.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, name) for name in ("best_model.pth", "best_ema_model.pth")]
+        for path in paths:
+            torch.save(ResNet([4, 4, 3]).state_dict(), path)
+        one = torch.zeros(1, 3, 32, 32, dtype=torch.uint8)
+        x = torch.randint(0, 256, (batch_size, 3, 32, 32), dtype=torch.uint8)
+
+        results = {"cold_start/checkpoints": _bench(lambda: ImagePredictor(paths)(one), warmup=0, repeat=repeat)}
+        predictors = {"checkpoints": ImagePredictor(paths)}
+        for fmt in formats:
+            artifact_dir = os.path.join(tmp, fmt)
+            export_inference_artifact(artifact_dir, paths, artifact_format=fmt)
+            results[f"cold_start/artifact_{fmt}"] = _bench(lambda: load_inference_artifact(artifact_dir)(one),
+                                                           warmup=0, repeat=repeat)
+            runs = []
+            for _ in range(repeat):
+                out = subprocess.run([sys.executable, os.path.join(artifact_dir, "loader.py")],
+                                     capture_output=True, text=True, check=True)
+                runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+            times = [run["cold_start_s"] for run in runs]
+            results[f"cold_start/artifact_{fmt}_process"] = {
+                "median_s": float(np.median(times)), "min_s": float(np.min(times)),
+                "import_s": float(np.median([run["import_s"] for run in runs]))}
+            predictors[f"artifact_{fmt}"] = load_inference_artifact(artifact_dir)
+
+        for name, predict in predictors.items():
+            r = _bench(lambda: predict(x), repeat=repeat)
+            r["images_per_sec"] = batch_size / r["median_s"]
+            results[f"predict_tta/{name}_bs{batch_size}"] = r
+    return results
+
+def compare_benchmarks(results, baseline, threshold=0.10):
+    """Names whose median time regressed by more than ``threshold`` relative to ``baseline``."""
+    regressions = []
+    for name, r in results.items():
+        if name in baseline and r["median_s"] > baseline[name]["median_s"] * (1 + threshold):
+            regressions.append((name, baseline[name]["median_s"], r["median_s"]))
+    return regressions
+
+def run_benchmarks(output_path="benchmarks.json", baseline_path=None, threshold=0.10, quick=False):
+    """Run the CPU benchmark suite on synthetic data, write JSON and flag regressions vs a baseline."""
+    arch = (1, 1, 1) if quick else (4, 4, 3)
+    repeat = 2 if quick else 5
+    results = {}
+    results.update(bench_forward(arch, batch_sizes=(1, 32) if quick else (1, 32, 128), repeat=repeat))
+    results.update(bench_train_step(arch, batch_size=32 if quick else 128, repeat=repeat))
+    results.update(bench_lookahead(arch, repeat=repeat * 4))
+    results.update(bench_sweep(arch, batch_size=32, repeat=repeat))
+    results.update(bench_tta(arch, batch_size=32 if quick else 128, repeat=repeat))
+    results.update(bench_loaders(num_samples=512 if quick else 4096, repeat=repeat))
+    results.update(bench_submission(num_samples=32 if quick else 512))
+    results.update(bench_artifact(batch_size=32 if quick else 128, repeat=repeat))
+    if not quick:
+        results.update(bench_ddp_scaling(arch))
+
+    for name, r in results.items():
+        print(f"{name:<40} {r['median_s'] * 1e3:10.2f} ms  {r.get('images_per_sec', 0):10.0f} img/s")
+
+    with open(output_path, 'w') as f:
+        json.dump({"torch": torch.__version__, "threads": torch.get_num_threads(),
+                   "created": datetime.now().isoformat(), "results": results}, f, indent=2)
+    print(f"Benchmark results written to {output_path}")
+
+    regressions = []
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_benchmarks(results, baseline, threshold)
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old * 1e3:.2f} ms -> {new * 1e3:.2f} ms ({new / old - 1:+.1%})")
+        if not regressions:
+            print(f"No regressions beyond {threshold:.0%} against {baseline_path}")
+    return results, regressions
 
 # MAIN EXECUTION FLOW
 if __name__ == "__main__":
@@ -710,14 +3820,25 @@ if __name__ == "__main__":
 
     # Training configuration
     FORCE_RETRAIN = False  # Set to True to force retraining
+    RUN_BENCHMARKS = False  # Set to True to run the CPU benchmark suite against the stored baseline
+    TRAIN_PROCESSES = 1  # > 1 trains data-parallel on that many CPU processes (gloo)
+    EXPORT_ARTIFACT = False  # Set to True to export the regular+EMA TTA ensemble for serving without this script
+
+    if RUN_BENCHMARKS:
+        run_benchmarks(os.path.join(DRIVE_PATH, "benchmarks.json"),
+                       baseline_path=os.path.join(DRIVE_PATH, "benchmark_baseline.json"))
 
     # Check if model exists in Google Drive
     if not os.path.exists(model_path) and not os.path.exists(ema_model_path) or FORCE_RETRAIN:
         print("Starting training with improved MixUp configuration...")
-        train_model()
+        # Without FORCE_RETRAIN an interrupted run continues from its latest checkpoint
+        train_distributed(TRAIN_PROCESSES, resume=not FORCE_RETRAIN)
     else:
         print(f"Found existing models in Google Drive")
 
+    if EXPORT_ARTIFACT:
+        export_inference_artifact(os.path.join(DRIVE_PATH, "inference_artifact"))
+
     # Check for competition test file
     test_file_path = "cifar_test_nolabel.pkl"
     if not os.path.exists(test_file_path):
@@ -727,12 +3848,14 @@ if __name__ == "__main__":
         exit(1)
 
     # Run multiple inference configurations and compare them
+    # Raw logits per (checkpoint, TTA view) are computed once and reused by every variant below
+    logit_store = LogitStore(test_file_path)
 
     # 1. Enhanced TTA with optimized ensemble weights
     print("\n=== Creating submission with enhanced TTA and optimized ensemble weights ===")
     submission_enhanced_path = os.path.join(DRIVE_PATH, "submission_enhanced.csv")
     globals()['DRIVE_PATH'] = os.path.dirname(submission_enhanced_path)
-    create_submission(test_file_path, use_tta=True, use_ensemble=True, ensemble_weights=[0.4, 0.6])
+    create_submission(test_file_path, use_tta=True, use_ensemble=True, ensemble_weights=[0.4, 0.6], logit_store=logit_store)
     if os.path.exists(os.path.join(DRIVE_PATH, "submission.csv")):
         os.rename(os.path.join(DRIVE_PATH, "submission.csv"), submission_enhanced_path)
 
@@ -740,7 +3863,7 @@ if __name__ == "__main__":
     print("\n=== Creating submission with standard inference and ensemble ===")
     submission_no_tta_path = os.path.join(DRIVE_PATH, "submission_no_tta.csv")
     globals()['DRIVE_PATH'] = os.path.dirname(submission_no_tta_path)
-    create_submission(test_file_path, use_tta=False, use_ensemble=True, ensemble_weights=[0.4, 0.6])
+    create_submission(test_file_path, use_tta=False, use_ensemble=True, ensemble_weights=[0.4, 0.6], logit_store=logit_store)
     if os.path.exists(os.path.join(DRIVE_PATH, "submission.csv")):
         os.rename(os.path.join(DRIVE_PATH, "submission.csv"), submission_no_tta_path)
 
@@ -749,7 +3872,7 @@ if __name__ == "__main__":
     submission_ema_only_path = os.path.join(DRIVE_PATH, "submission_ema_only.csv")
     globals()['DRIVE_PATH'] = os.path.dirname(submission_ema_only_path)
     # To use only EMA model, set ensemble weights to [0, 1]
-    create_submission(test_file_path, use_tta=True, use_ensemble=True, ensemble_weights=[0, 1])
+    create_submission(test_file_path, use_tta=True, use_ensemble=True, ensemble_weights=[0, 1], logit_store=logit_store)
     if os.path.exists(os.path.join(DRIVE_PATH, "submission.csv")):
         os.rename(os.path.join(DRIVE_PATH, "submission.csv"), submission_ema_only_path)
 
@@ -766,39 +3889,11 @@ if __name__ == "__main__":
                 ("EMA only + TTA", submission_ema_only_path)
             ]:
                 if os.path.exists(path):
-                    submissions[name] = pd.read_csv(path)
-
-            # Display class distribution for each method
-            for name, df in submissions.items():
-                print(f"\n{name} class distribution:")
-                print(df["Labels"].value_counts().sort_index())
-
-            # Calculate agreement between methods
-            if len(submissions) > 1:
-                print("\n=== Agreement between methods ===")
-                keys = list(submissions.keys())
-                for i in range(len(keys)):
-                    for j in range(i+1, len(keys)):
-                        name1, name2 = keys[i], keys[j]
-                        df1, df2 = submissions[name1], submissions[name2]
-                        agreement = (df1["Labels"] == df2["Labels"]).mean() * 100
-                        print(f"{name1} vs {name2}: {agreement:.2f}% agreement")
-
-                # Find samples where predictions differ
-                if len(submissions) >= 2:
-                    diff_samples = []
-                    for idx, row in submissions[keys[0]].iterrows():
-                        sample_id = row["ID"]
-                        predictions = [df.loc[df["ID"] == sample_id, "Labels"].values[0] for df in submissions.values()]
-                        if len(set(predictions)) > 1:
-                            diff_samples.append((sample_id, predictions))
-
-                    print(f"\nFound {len(diff_samples)} samples with differing predictions")
-                    if diff_samples:
-                        print("Sample disagreements (showing first 10):")
-                        for i, (sample_id, preds) in enumerate(diff_samples[:10]):
-                            pred_str = ", ".join([f"{keys[i]}: {p}" for i, p in enumerate(preds)])
-                            print(f"ID {sample_id}: {pred_str}")
+                    submissions[name] = path
+
+            if submissions:
+                names, ids, labels = align_predictions(submissions)
+                print_comparison_report(names, ids, labels, compare_predictions(labels))
     except Exception as e:
         print(f"Error comparing distributions: {str(e)}")
 
@@ -820,82 +3915,85 @@ if __name__ == "__main__":
 
     print("\nProcess complete.")
 
-import matplotlib.pyplot as plt
-import numpy as np
-import seaborn as sns
-
-# Set seaborn style for
-sns.set_style("whitegrid")
-plt.rcParams.update({
-    'font.family': 'serif',
-    'font.size': 10,
-    'axes.labelsize': 11,
-    'axes.titlesize': 12,
-    'xtick.labelsize': 9,
-    'ytick.labelsize': 9
-})
+def plot_inference_comparison(path="figure1.png"):
+    """Bar chart of the test accuracy of each inference strategy (values from the report)."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Set seaborn style for
+    sns.set_style("whitegrid")
+    plt.rcParams.update({
+        'font.family': 'serif',
+        'font.size': 10,
+        'axes.labelsize': 11,
+        'axes.titlesize': 12,
+        'xtick.labelsize': 9,
+        'ytick.labelsize': 9
+    })
 
-# Data for accuracy comparison
-methods = [
-    'Baseline\nInference',
-    'TTA',
-    'Ensemble\n(No TTA)',
-    'TTA +\nEnsemble',
-    'EMA Only\n+ TTA'
-]
+    # Data for accuracy comparison
+    methods = [
+        'Baseline\nInference',
+        'TTA',
+        'Ensemble\n(No TTA)',
+        'TTA +\nEnsemble',
+        'EMA Only\n+ TTA'
+    ]
 
-accuracies = [92.56, 92.87, 92.72, 92.99, 92.94]  # Refined accuracy values
-improvements = [0, 0.31, 0.16, 0.43, 0.38]  # Improvements over baseline
+    accuracies = [92.56, 92.87, 92.72, 92.99, 92.94]  # Refined accuracy values
+    improvements = [0, 0.31, 0.16, 0.43, 0.38]  # Improvements over baseline
 
 
-colors = sns.color_palette("Blues", len(methods))
-colors = [colors[0]] + [sns.color_palette("Greens")[3]] * 4  # First bar blue, others green
+    colors = sns.color_palette("Blues", len(methods))
+    colors = [colors[0]] + [sns.color_palette("Greens")[3]] * 4  # First bar blue, others green
 
 
-plt.figure(figsize=(7, 3.5))
+    plt.figure(figsize=(7, 3.5))
 
 
-bars = plt.bar(methods, accuracies, color=colors, width=0.6, edgecolor='black', linewidth=0.5)
-bars[0].set_color(sns.color_palette("Blues")[3])  # Set baseline to blue
+    bars = plt.bar(methods, accuracies, color=colors, width=0.6, edgecolor='black', linewidth=0.5)
+    bars[0].set_color(sns.color_palette("Blues")[3])  # Set baseline to blue
 
-# Customize the plot
-plt.ylabel('Test Accuracy (%)', fontweight='bold')
-plt.title('Performance Comparison of Inference Strategies', fontweight='bold')
-plt.ylim(92.4, 93.1)  # Focus on the relevant accuracy range
-plt.grid(axis='y', linestyle='--', alpha=0.7)
+    # Customize the plot
+    plt.ylabel('Test Accuracy (%)', fontweight='bold')
+    plt.title('Performance Comparison of Inference Strategies', fontweight='bold')
+    plt.ylim(92.4, 93.1)  # Focus on the relevant accuracy range
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
 
 
-for i, bar in enumerate(bars):
-    height = bar.get_height()
-    plt.text(bar.get_x() + bar.get_width()/2., height + 0.03,
-            f'{accuracies[i]:.2f}%', ha='center', va='bottom', fontsize=9, fontweight='bold')
+    for i, bar in enumerate(bars):
+        height = bar.get_height()
+        plt.text(bar.get_x() + bar.get_width()/2., height + 0.03,
+                f'{accuracies[i]:.2f}%', ha='center', va='bottom', fontsize=9, fontweight='bold')
 
-    if i > 0:  # Improvement labels (except for baseline)
-        plt.text(bar.get_x() + bar.get_width()/2., height - 0.1,
-                f'+{improvements[i]:.2f}%', ha='center', va='bottom',
-                fontsize=8, color='darkgreen', fontweight='bold')
+        if i > 0:  # Improvement labels (except for baseline)
+            plt.text(bar.get_x() + bar.get_width()/2., height - 0.1,
+                    f'+{improvements[i]:.2f}%', ha='center', va='bottom',
+                    fontsize=8, color='darkgreen', fontweight='bold')
 
-# Add a light horizontal line at baseline accuracy for reference
-plt.axhline(y=accuracies[0], color='navy', linestyle='-', alpha=0.2, linewidth=1)
+    # Add a light horizontal line at baseline accuracy for reference
+    plt.axhline(y=accuracies[0], color='navy', linestyle='-', alpha=0.2, linewidth=1)
 
-plt.annotate('Best performance', xy=(3, accuracies[3]), xytext=(3, accuracies[3] + 0.12),
-            arrowprops=dict(arrowstyle='->', color='black', linewidth=0.8),
-            ha='center', va='bottom', fontsize=8)
+    plt.annotate('Best performance', xy=(3, accuracies[3]), xytext=(3, accuracies[3] + 0.12),
+                arrowprops=dict(arrowstyle='->', color='black', linewidth=0.8),
+                ha='center', va='bottom', fontsize=8)
 
-sig_markers = ['', '*', '', '**', '*']
-for i, marker in enumerate(sig_markers):
-    if marker:
-        plt.text(i, accuracies[i] + 0.06, marker, ha='center', color='black', fontsize=12)
+    sig_markers = ['', '*', '', '**', '*']
+    for i, marker in enumerate(sig_markers):
+        if marker:
+            plt.text(i, accuracies[i] + 0.06, marker, ha='center', color='black', fontsize=12)
 
-# Legend explaining significance
-if any(sig_markers):
-    plt.text(0.02, 0.02, "* p < 0.05, ** p < 0.01", transform=plt.gca().transAxes,
-             fontsize=7, verticalalignment='bottom', horizontalalignment='left')
+    # Legend explaining significance
+    if any(sig_markers):
+        plt.text(0.02, 0.02, "* p < 0.05, ** p < 0.01", transform=plt.gca().transAxes,
+                 fontsize=7, verticalalignment='bottom', horizontalalignment='left')
 
-# Adjust layout and save
-plt.tight_layout()
-plt.savefig('figure1.png', dpi=300, bbox_inches='tight')
-plt.close()
+    # Adjust layout and save
+    plt.tight_layout()
+    plt.savefig(path, dpi=300, bbox_inches='tight')
+    plt.close()
 
-print("Enhanced figure saved as 'figure11.png'")
+    print(f"Enhanced figure saved as '{path}'")
 
+if __name__ == "__main__":
+    plot_inference_comparison()
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SAMResNet  # noqa: E402
+
+# Small enough for a few CPU epochs in seconds
+TINY_CONFIG = {"arch": (1, 1, 1), "num_epochs": 3, "batch_size": 16, "warmup_epochs": 1,
+               "mixup_ramp": ((1, 0.5),)}
+
+
+@pytest.fixture
+def tiny_cifar(monkeypatch):
+    """64 train / 32 test random images in place of CIFAR-10, served like get_cifar10_loaders.
+
+    The default path goes through torch DataLoaders, which draw their base seed from the global
+    RNG on every iteration just like the torchvision worker loaders.
+    """
+    g = torch.Generator().manual_seed(0)
+    train_images = torch.randint(0, 256, (64, 3, 32, 32), dtype=torch.uint8, generator=g)
+    train_targets = torch.randint(0, 10, (64,), generator=g)
+    test_images = torch.randint(0, 256, (32, 3, 32, 32), dtype=torch.uint8, generator=g)
+    test_targets = torch.randint(0, 10, (32,), generator=g)
+
+    def get_cifar10_loaders(batch_size=128, batch_augment=False, device=None, num_replicas=1, rank=0):
+        if batch_augment:
+            train = SAMResNet.FastLoader(train_images, train_targets, batch_size, shuffle=True,
+                                         num_replicas=num_replicas, rank=rank)
+            test = SAMResNet.FastLoader(test_images, test_targets, batch_size)
+            return (SAMResNet.AugmentedLoader(train, SAMResNet.BatchAugment(train=True), device),
+                    SAMResNet.AugmentedLoader(test, SAMResNet.BatchAugment(train=False), device))
+        normalize = SAMResNet.BatchAugment(train=False).normalize
+        train_set = TensorDataset(normalize(train_images), train_targets)
+        test_set = TensorDataset(normalize(test_images), test_targets)
+        return DataLoader(train_set, batch_size, shuffle=True), DataLoader(test_set, batch_size)
+
+    monkeypatch.setattr(SAMResNet, "get_cifar10_loaders", get_cifar10_loaders)
+    return train_images, train_targets
@@ -0,0 +1,39 @@
+import importlib.util
+import os
+
+import pytest
+import torch
+
+import SAMResNet
+
+
+def _checkpoint(path, seed):
+    torch.manual_seed(seed)
+    model = SAMResNet.ResNet([4, 4, 3])
+    # Non-trivial running statistics, so BN folding is actually exercised
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.normal_(0, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+    torch.save(model.state_dict(), path)
+    return str(path)
+
+
+@pytest.mark.parametrize("artifact_format", SAMResNet.ARTIFACT_FORMATS)
+def test_exported_artifact_predicts_like_the_eager_ensemble(tmp_path, artifact_format):
+    paths = [_checkpoint(tmp_path / f"model_{seed}.pth", seed) for seed in (0, 1)]
+    weights = [0.4, 0.6]
+    artifact_dir = str(tmp_path / "artifact")
+    SAMResNet.export_inference_artifact(artifact_dir, paths, weights, artifact_format=artifact_format)
+
+    images = torch.randint(0, 256, (5, 3, 32, 32), dtype=torch.uint8)
+    ensemble = SAMResNet.StackedEnsemble([SAMResNet.load_resnet_checkpoint(p, "cpu") for p in paths], weights)
+    with torch.no_grad():
+        expected = SAMResNet.tta_predict(ensemble, SAMResNet.BatchAugment(train=False).normalize(images))
+
+    torch.testing.assert_close(SAMResNet.load_inference_artifact(artifact_dir)(images), expected, rtol=1e-4, atol=1e-4)
+    # The standalone loader.py written next to the artifact gives the same predictions
+    spec = importlib.util.spec_from_file_location("artifact_loader", os.path.join(artifact_dir, "loader.py"))
+    loader = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loader)
+    torch.testing.assert_close(loader.load_inference_artifact(artifact_dir)(images), expected, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,28 @@
+import random
+
+import SAMResNet
+from conftest import TINY_CONFIG
+from test_training import _assert_same_state, _final_state
+
+
+def test_sample_config_tagged_ranges_and_fixed_values():
+    space = {"lr": ("log", 0.01, 1.0), "mixup_alpha": ("uniform", 0.1, 0.5), "lookahead_k": [5, 10],
+             "mixup_ramp": SAMResNet.TRAIN_DEFAULTS["mixup_ramp"], "arch": (2, 2, 2)}
+    for seed in range(20):
+        config = SAMResNet.sample_config(space, random.Random(seed))
+        assert 0.01 <= config["lr"] <= 1.0
+        assert 0.1 <= config["mixup_alpha"] <= 0.5
+        assert config["lookahead_k"] in (5, 10)
+        assert config["mixup_ramp"] == SAMResNet.TRAIN_DEFAULTS["mixup_ramp"]
+        assert config["arch"] == (2, 2, 2)
+
+
+def test_promoted_trial_matches_uninterrupted_trial(tiny_cifar, tmp_path):
+    config = {**TINY_CONFIG, "lr": 0.05}
+    straight = SAMResNet._run_trial(str(tmp_path / "straight"), config, 3, 1, seed=7)
+    SAMResNet._run_trial(str(tmp_path / "promoted"), config, 1, 1, seed=7)
+    promoted = SAMResNet._run_trial(str(tmp_path / "promoted"), config, 3, 1, seed=7)
+
+    assert promoted["epoch"] == straight["epoch"] == 3
+    assert promoted["ema_acc"] == straight["ema_acc"]
+    _assert_same_state(_final_state(tmp_path / "straight"), _final_state(tmp_path / "promoted"))
@@ -0,0 +1,58 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+import SAMResNet
+
+
+@pytest.fixture
+def checkpoints_and_test_file(tmp_path):
+    paths = []
+    for seed in (0, 1):
+        torch.manual_seed(seed)
+        path = tmp_path / f"model_{seed}.pth"
+        torch.save(SAMResNet.ResNet([4, 4, 3]).state_dict(), path)
+        paths.append(str(path))
+    data = np.random.default_rng(0).integers(0, 256, (20, 3072), dtype=np.uint8)
+    test_file = tmp_path / "test.pkl"
+    with open(test_file, "wb") as f:
+        pickle.dump({b"data": data}, f)
+    return paths, str(test_file)
+
+
+def test_cached_predictions_match_the_live_ensemble(checkpoints_and_test_file, tmp_path):
+    paths, test_file = checkpoints_and_test_file
+    weights = [0.4, 0.6]
+    # batch_size 8 leaves a partial last batch in the cache pass
+    store = SAMResNet.LogitStore(test_file, cache_dir=str(tmp_path / "cache"), device="cpu", batch_size=8)
+    for use_tta in (True, False):
+        cached, ids = SAMResNet.cached_predictions(store, paths, weights, use_tta=use_tta)
+
+        models = [SAMResNet.load_resnet_checkpoint(p, "cpu") for p in paths]
+        ensemble = SAMResNet.StackedEnsemble(models, weights)
+        loader = SAMResNet.get_competition_test_loader(test_file, batch_size=8, memmap=True)
+        with torch.no_grad():
+            live = torch.cat([SAMResNet.tta_predict(ensemble, x) if use_tta else ensemble(x) for x, _ in loader])
+        assert len(ids) == 20
+        np.testing.assert_allclose(cached, live.numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_logit_store_round_trip_only_computes_missing_views(checkpoints_and_test_file, tmp_path, monkeypatch):
+    paths, test_file = checkpoints_and_test_file
+    views = SAMResNet.DEFAULT_TTA_CONFIG["views"]
+    store = SAMResNet.LogitStore(test_file, cache_dir=str(tmp_path / "cache"), device="cpu", batch_size=8)
+    first = np.array(store.get(paths[0], views[:2]))
+
+    computed = []
+    compute = store._compute
+    monkeypatch.setattr(store, "_compute", lambda path, missing: computed.append(len(missing)) or compute(path, missing))
+    full = store.get(paths[0], views)
+    assert computed == [len(views) - 2]
+    np.testing.assert_array_equal(full[:2], first)
+
+    # A fresh store over the same files is served from disk alone
+    reopened = SAMResNet.LogitStore(test_file, cache_dir=str(tmp_path / "cache"), device="cpu", batch_size=8)
+    monkeypatch.setattr(reopened, "_compute", lambda *args: pytest.fail("cached views were recomputed"))
+    np.testing.assert_array_equal(reopened.get(paths[0], views), full)
@@ -0,0 +1,57 @@
+import copy
+import io
+
+import pytest
+import torch
+from torch import nn
+
+import SAMResNet
+
+
+def _step(model, optimizer, seed):
+    g = torch.Generator().manual_seed(seed)
+    x, y = torch.randn(8, 4, generator=g), torch.randint(0, 3, (8,), generator=g)
+    nn.functional.cross_entropy(model(x), y).backward()
+    optimizer.step()
+    optimizer.zero_grad()
+
+
+def _lookahead(model):
+    sgd = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True)
+    return SAMResNet.Lookahead(sgd, k=3, alpha=0.5)
+
+
+@pytest.mark.parametrize("steps_before_save", [2, 7])  # before the first sync, and mid-cycle after two
+def test_lookahead_state_dict_round_trip_continues_identically(steps_before_save):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 16), nn.ReLU(), nn.Linear(16, 3))
+    optimizer = _lookahead(model)
+    for step in range(steps_before_save):
+        _step(model, optimizer, step)
+
+    buffer = io.BytesIO()
+    torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict()}, buffer)
+    buffer.seek(0)
+    state = torch.load(buffer, weights_only=False)
+    restored = copy.deepcopy(model)
+    restored.load_state_dict(state["model"])
+    restored_optimizer = _lookahead(restored)
+    restored_optimizer.load_state_dict(state["optimizer"])
+
+    for step in range(steps_before_save, steps_before_save + 5):
+        _step(model, optimizer, step)
+        _step(restored, restored_optimizer, step)
+    for a, b in zip(model.parameters(), restored.parameters()):
+        assert torch.equal(a, b)
+    assert torch.equal(optimizer.slow, restored_optimizer.slow)
+    assert optimizer.counter == restored_optimizer.counter
+
+
+def test_lookahead_rejects_a_slow_buffer_of_another_model():
+    small, large = nn.Linear(4, 3), nn.Linear(4, 5)
+    optimizer = _lookahead(small)
+    for step in range(3):
+        _step(small, optimizer, step)
+    other = _lookahead(large)
+    with pytest.raises(ValueError, match="Slow-weight buffer"):
+        other.load_state_dict({**optimizer.state_dict(), "base": other.optimizer.state_dict()})
@@ -0,0 +1,41 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+import SAMResNet
+
+
+def test_drop_blocks_can_empty_a_layer():
+    torch.manual_seed(0)
+    model = SAMResNet.ResNet([2, 1, 1], num_channels=16).eval()
+    # Only one live channel per layer1 block: below min_channels, and layer1 blocks are identity-shortcut
+    importance = {}
+    for name, module in model.named_modules():
+        if isinstance(module, SAMResNet.BasicBlock):
+            score = torch.ones(module.conv1.out_channels)
+            if name.startswith("layer1."):
+                score = torch.zeros_like(score)
+                score[0] = 1.0
+            importance[name] = score
+    num_zero = sum(int((s == 0).sum()) for s in importance.values())
+    total = sum(s.numel() for s in importance.values())
+
+    pruned, plan = SAMResNet.prune_resnet(model, importance, num_zero / total, drop_blocks=True)
+
+    assert plan["num_blocks"] == [0, 1, 1]
+    assert len(pruned.layer1) == 0
+    for name in ("layer2.0", "layer3.0"):
+        src, dst = model.get_submodule(name), pruned.get_submodule(name)
+        for key, tensor in src.state_dict().items():
+            assert torch.equal(tensor, dst.state_dict()[key]), f"{name}.{key} not copied"
+    x = torch.randn(4, 3, 32, 32)
+    with torch.no_grad():
+        out = model.layer3(model.layer2(F.silu(model.bn1(model.conv1(x)))))
+        reference = model.linear(out.mean((2, 3)))
+        assert torch.allclose(pruned(x), reference, atol=1e-5)
+
+
+def test_empty_layer_must_preserve_shape():
+    # layer2 doubles the channels at stride 2, so it cannot be the identity
+    with pytest.raises(ValueError):
+        SAMResNet.ResNet([1, 0, 1], num_channels=16)
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import torch
+
+import SAMResNet
+
+
+class FakePredictor:
+    """Returns each image's first 10 pixel values, so every output row identifies its input."""
+    description = {"fake": True}
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def __call__(self, images):
+        time.sleep(self.delay)
+        self.batch_sizes.append(len(images))
+        return images.reshape(len(images), -1)[:, :10].float()
+
+
+def _images(n, offset=0):
+    return (torch.arange(n, dtype=torch.uint8) + offset).view(n, 1, 1, 1).expand(n, 3, 32, 32).contiguous()
+
+
+def test_batcher_survives_cancelled_requests_and_splits_large_ones():
+    async def main():
+        predictor = FakePredictor(delay=0.05)
+        batcher = SAMResNet.MicroBatcher(predictor, max_batch_size=4, max_latency_ms=1.0)
+        batcher.start()
+        try:
+            # Times out (cancelling its future) while its batch is still running
+            try:
+                await asyncio.wait_for(batcher.predict(_images(2)), 0.01)
+            except asyncio.TimeoutError:
+                pass
+            out = await asyncio.wait_for(batcher.predict(_images(10, offset=100)), 5)
+            assert torch.equal(out[:, 0], torch.arange(100, 110).float())
+            assert max(predictor.batch_sizes) <= 4
+        finally:
+            await batcher.stop()
+    asyncio.run(main())
+
+
+def test_malformed_requests_get_400():
+    async def request(port, raw):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(raw)
+        await writer.drain()
+        status = int((await reader.readuntil(b"\r\n")).split(b" ", 2)[1])
+        writer.close()
+        return status
+
+    async def main():
+        service = SAMResNet.PredictionService(FakePredictor(), max_batch_size=4, max_request=8)
+        server = await service.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            assert await request(port, b"GARBAGE\r\n\r\n") == 400
+            assert await request(port, b"POST /predict HTTP/1.1\r\nContent-Length: abc\r\n\r\n") == 400
+            assert await request(port, b"POST /predict HTTP/1.1\r\nContent-Length: -5\r\n\r\n") == 400
+            body = bytes(9 * 3072)  # above max_request
+            assert await request(port, f"POST /predict HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body) == 400
+            body = bytes(6 * 3072)
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            status, result = await SAMResNet._http_call(reader, writer, "POST", "/predict", body)
+            writer.close()
+            assert status == 200 and len(result["labels"]) == 6
+            assert service.metrics.errors == 4
+        finally:
+            await service.stop()
+    asyncio.run(main())
+
+
+def test_batch_deadline_counts_from_arrival():
+    async def main():
+        predictor = FakePredictor(delay=0.5)
+        batcher = SAMResNet.MicroBatcher(predictor, max_batch_size=4, max_latency_ms=500.0)
+        batcher.start()
+        try:
+            first = asyncio.ensure_future(batcher.predict(_images(1)))
+            await asyncio.sleep(0.55)  # the first batch is now running until ~1.0s
+            start = time.perf_counter()
+            await batcher.predict(_images(1, offset=1))
+            # Flushed at arrival + 500 ms, as soon as the running batch is done: ~1.0s including its own
+            # inference, against ~1.45s if the 500 ms only started once the batcher dequeued it
+            assert time.perf_counter() - start < 1.25
+            await first
+        finally:
+            await batcher.stop()
+    asyncio.run(main())
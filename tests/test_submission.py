@@ -0,0 +1,43 @@
+import os
+
+import pytest
+import torch
+
+import SAMResNet
+
+
+def test_create_submission_rejects_weights_not_matching_members(tmp_path, monkeypatch):
+    monkeypatch.setattr(SAMResNet, "DRIVE_PATH", str(tmp_path))
+    for name in ("best_model.pth", "best_ema_model.pth", "snapshot.pth"):
+        (tmp_path / name).write_bytes(b"")
+    with pytest.raises(ValueError, match="2 ensemble weights for 3 checkpoints"):
+        SAMResNet.create_submission(ensemble_weights=[0.4, 0.6],
+                                    snapshot_paths=[os.path.join(tmp_path, "snapshot.pth")])
+
+
+def test_create_submission_renormalizes_without_a_broken_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(SAMResNet, "DRIVE_PATH", str(tmp_path))
+    model = SAMResNet.ResNet([4, 4, 3])
+    for name in ("best_model.pth", "best_ema_model.pth"):
+        torch.save(model.state_dict(), tmp_path / name)
+    (tmp_path / "snapshot.pth").write_bytes(b"not a checkpoint")
+
+    class Built(Exception):
+        pass
+
+    def stacked_ensemble(models, weights):
+        raise Built(weights)
+
+    monkeypatch.setattr(SAMResNet, "StackedEnsemble", stacked_ensemble)
+    monkeypatch.setattr(SAMResNet, "get_competition_test_loader", lambda *args, **kwargs: None)
+    with pytest.raises(Built) as built:
+        SAMResNet.create_submission(ensemble_weights=[0.3, 0.3, 0.4],
+                                    snapshot_paths=[os.path.join(tmp_path, "snapshot.pth")])
+    assert built.value.args[0] == pytest.approx([0.5, 0.5])
+
+
+def test_ensembles_reject_mismatched_weights():
+    models = [SAMResNet.ResNet([1, 1, 1], num_channels=8) for _ in range(2)]
+    for ensemble in (SAMResNet.StackedEnsemble, SAMResNet.SequentialEnsemble):
+        with pytest.raises(ValueError, match="1 weights for 2 models"):
+            ensemble(models, [1.0])
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+import torch
+
+import SAMResNet
+from conftest import TINY_CONFIG
+
+
+def _final_state(output_dir):
+    return torch.load(SAMResNet.latest_checkpoint(str(output_dir / "checkpoints")), weights_only=False)
+
+
+def _assert_same_state(a, b):
+    assert a["epoch"] == b["epoch"]
+    for key in ("model", "ema"):
+        for name, tensor in a[key].items():
+            assert torch.equal(tensor, b[key][name]), f"{key}.{name} differs"
+    assert torch.equal(a["optimizer"]["slow"], b["optimizer"]["slow"])
+
+
+def test_resume_matches_uninterrupted_run(tiny_cifar, tmp_path):
+    SAMResNet.set_random_seeds(0)
+    SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path / "full"))
+
+    SAMResNet.set_random_seeds(0)
+    SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path / "resumed"), stop_epoch=2)
+    SAMResNet.set_random_seeds(1)  # the resumed process starts from unrelated RNG streams
+    SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path / "resumed"), resume=True)
+
+    _assert_same_state(_final_state(tmp_path / "full"), _final_state(tmp_path / "resumed"))
+
+
+def test_resume_is_opt_in_and_checks_the_config(tiny_cifar, tmp_path):
+    SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path), stop_epoch=2)
+    with pytest.raises(ValueError, match="different training config"):
+        SAMResNet.train_model(config={**TINY_CONFIG, "lr": 0.05}, output_dir=str(tmp_path), resume=True)
+
+    # Without resume the finished checkpoints are replaced, not continued
+    result = SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path), stop_epoch=1)
+    assert result["epoch"] == 1
+    assert os.path.basename(SAMResNet.latest_checkpoint(str(tmp_path / "checkpoints"))) == "checkpoint_epoch0000.pt"
+
+
+def test_distillation_without_soft_loss_matches_plain_training(tiny_cifar, tmp_path):
+    # kd_alpha=0 leaves only the mixup CE, so the index -> label lookup must reproduce the plain run exactly
+    teacher_logits = torch.randn(len(tiny_cifar[1]), 10)
+    SAMResNet.set_random_seeds(0)
+    SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path / "plain"), batch_augment=True)
+
+    SAMResNet.set_random_seeds(0)
+    SAMResNet.train_model(config=TINY_CONFIG, output_dir=str(tmp_path / "distill"), batch_augment=True,
+                          teacher_logits=teacher_logits, kd_alpha=0.0)
+
+    _assert_same_state(_final_state(tmp_path / "plain"), _final_state(tmp_path / "distill"))
+
+
+def test_compiled_run_only_evaluates_warmed_batch_sizes(tiny_cifar, tmp_path, monkeypatch):
+    warmed, evaluated = set(), set()
+
+    def fake_compile(model, mode=None, dynamic=None):
+        def forward(x):
+            if not model.training:
+                evaluated.add(x.size(0))
+            return model(x)
+        return forward
+
+    def compile_model(model, batch_sizes=(128,), **kwargs):
+        warmed.update(batch_sizes)
+        return compile_model_impl(model, batch_sizes, **kwargs)
+
+    compile_model_impl = SAMResNet.compile_model
+    monkeypatch.setattr(torch, "compile", fake_compile)
+    monkeypatch.setattr(SAMResNet, "compile_model", compile_model)
+    # The stratified subset (at most 10 images) exercises padding of a partial eval batch
+    SAMResNet.train_model(compiled=True, config=TINY_CONFIG, output_dir=str(tmp_path), subset_epochs=2,
+                          subset_per_class=1)
+    assert evaluated and evaluated <= warmed
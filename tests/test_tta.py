@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+import SAMResNet
+
+
+def _reference_tta(model, img):
+    """The original hand-written six-view TTA, one forward per view."""
+    views = [img, torch.flip(img, dims=[3]),
+             torch.nn.functional.pad(img[:, :, 1:, :], (0, 0, 0, 1), mode='replicate'),
+             torch.nn.functional.pad(img[:, :, :, 1:], (1, 0, 0, 0), mode='replicate'),
+             torch.clamp(img * 1.05, 0, 1), img * 0.95]
+    with torch.no_grad():
+        predictions = [model(v) / 1.2 for v in views]
+    weights = torch.tensor([1.5] + [1.0] * 5)
+    weights = weights / weights.sum()
+    return torch.stack([w * p for w, p in zip(weights, predictions)]).sum(0)
+
+
+@pytest.mark.parametrize("max_batch", [None, 7, 30])
+def test_default_tta_matches_the_original_six_views(max_batch):
+    torch.manual_seed(0)
+    model = SAMResNet.ResNet([1, 1, 1], num_channels=16).eval()
+    img = torch.randn(5, 3, 32, 32)  # normalized inputs, so the +5% view's clamp matters
+    expected = _reference_tta(model, img)
+    actual = SAMResNet.tta_predict(model, img, max_batch=max_batch)
+    torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_escalation_defaults_follow_each_criterion_scale():
+    # Margin ~0.86 and entropy ~0.48 nats: confident on both scales, yet above a margin-scale 0.3 entropy cut
+    confident = torch.tensor([[5.0, 2.0] + [0.0] * 8])
+    uniform = torch.zeros(1, 10)
+    for criterion in ("margin", "entropy"):
+        assert not SAMResNet.escalation_mask(confident, criterion).item()
+        assert SAMResNet.escalation_mask(uniform, criterion).item()
+    assert SAMResNet.escalation_mask(confident, "entropy", threshold=0.3).item()
+    with pytest.raises(ValueError):
+        SAMResNet.escalation_mask(uniform, "variance")
+
+
+def test_adaptive_tta_report_sweeps_entropy_on_its_own_scale(tiny_cifar):
+    model = SAMResNet.ResNet([1, 1, 1], num_channels=16)
+    report = SAMResNet.adaptive_tta_report(model, criterion="entropy", timing_batches=1)
+    adaptive = report[report["mode"] == "adaptive"]
+    expected = set(SAMResNet.ESCALATION_SWEEPS["entropy"]) | {SAMResNet.ESCALATION_THRESHOLDS["entropy"]}
+    assert list(adaptive["threshold"]) == sorted(expected)
+    assert adaptive["images_per_sec"].notna().sum() == 1
+
+
+def test_evaluate_scores_the_given_tta_config(tiny_cifar, monkeypatch):
+    torch.manual_seed(0)
+    model = SAMResNet.ResNet([1, 1, 1], num_channels=16).eval()
+    _, test_loader = SAMResNet.get_cifar10_loaders(batch_size=16, batch_augment=True)
+    inputs, targets = map(torch.cat, zip(*test_loader))
+    # Threshold 1.0 escalates every sample: adaptive then equals full TTA
+    cfg = dict(SAMResNet.ADAPTIVE_TTA_CONFIG, adaptive={"criterion": "margin", "threshold": 1.0})
+    expected = SAMResNet.tta_predict(model, inputs).argmax(1).eq(targets).float().mean().item() * 100
+    assert SAMResNet.evaluate(model, test_loader, "cpu", use_tta=True, tta_config=cfg) == pytest.approx(expected)
+
+    identity = {"views": [{"op": "identity", "weight": 1.0}]}
+    assert SAMResNet.evaluate(model, test_loader, "cpu", use_tta=True, tta_config=identity) == \
+        pytest.approx(SAMResNet.evaluate(model, test_loader, "cpu"))
+
+    # Compiled: every adaptive forward runs on (or pads up to) a warmed batch size
+    warmed, evaluated = set(), set()
+    compile_model = SAMResNet.compile_model
+
+    def record_compile(model, batch_sizes=(128,), **kwargs):
+        warmed.update(batch_sizes)
+        return compile_model(model, batch_sizes, **kwargs)
+
+    def fake_compile(model, mode=None, dynamic=None):
+        return lambda x: evaluated.add(x.size(0)) or model(x)
+
+    monkeypatch.setattr(torch, "compile", fake_compile)
+    monkeypatch.setattr(SAMResNet, "compile_model", record_compile)
+    SAMResNet.evaluate(model, test_loader, "cpu", use_tta=True, compiled=True, tta_config=SAMResNet.ADAPTIVE_TTA_CONFIG)
+    assert evaluated <= warmed